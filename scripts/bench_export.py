@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Time export_to_voteit4.py as a whole and each of its export_* functions. Meant to be run against a
+database created with generate_benchmark_db.py, see etc/benchmark.ini.
+
+Arguments that aren't handled here are passed on to the export, like --cache-size 5000.
+Function times include the functions they call, so export_meeting_content contains most of the others.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import shutil
+from tempfile import mkdtemp
+from timeit import default_timer
+
+import export_to_voteit4 as export
+
+
+class Timings:
+    """ Calls and total time for each wrapped function. """
+
+    def __init__(self):
+        self.calls = {}
+        self.seconds = {}
+
+    def wrap(self, name, fn):
+        def _inner(*args, **kwargs):
+            start = default_timer()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.calls[name] = self.calls.get(name, 0) + 1
+                self.seconds[name] = self.seconds.get(name, 0.0) + default_timer() - start
+        return _inner
+
+    def patch(self, module, prefix='export_'):
+        """ Wrap functions in module. They're looked up as globals when called, so all calls are counted. """
+        for name in dir(module):
+            fn = getattr(module, name)
+            if name.startswith(prefix) and callable(fn) and not isinstance(fn, type):
+                setattr(module, name, self.wrap(name, fn))
+
+    def as_dict(self):
+        return dict((name, {'calls': self.calls[name], 'seconds': self.seconds[name]}) for name in self.calls)
+
+
+def print_report(total, functions, baseline=None):
+    print("-" * 80)
+    print("Function".ljust(40), "Calls".rjust(9), "Total s".rjust(9), "ms/call".rjust(9), "Baseline".rjust(10))
+    print("=" * 80)
+    rows = sorted(functions.items(), key=lambda x: x[1]['seconds'], reverse=True)
+    rows.append(('TOTAL', {'calls': 1, 'seconds': total}))
+    for name, timing in rows:
+        compared = ""
+        if baseline:
+            before = baseline['functions'].get(name) if name != 'TOTAL' else {'seconds': baseline['total']}
+            if before and before['seconds']:
+                compared = "%+.1f%%" % ((timing['seconds'] / before['seconds'] - 1) * 100)
+        print(
+            name.ljust(40),
+            str(timing['calls']).rjust(9),
+            ("%.3f" % timing['seconds']).rjust(9),
+            ("%.3f" % (timing['seconds'] * 1000 / timing['calls'])).rjust(9),
+            compared.rjust(10),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_uri", help="Paster ini file to load settings from, like etc/benchmark.ini")
+    parser.add_argument("-s", "--save", help="Save timings as json to this file")
+    parser.add_argument("-b", "--baseline", help="Compare with timings saved by an earlier run")
+    args, export_args = parser.parse_known_args()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    timings = Timings()
+    timings.patch(export)
+    tmp_dir = mkdtemp()
+    start = default_timer()
+    try:
+        export.main([args.config_uri, '-o', os.path.join(tmp_dir, 'export.json')] + export_args)
+    except SystemExit as exc:
+        print("Export stopped: %s" % exc)
+    finally:
+        total = default_timer() - start
+        shutil.rmtree(tmp_dir)
+    functions = timings.as_dict()
+    print_report(total, functions, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'total': total, 'args': export_args, 'functions': functions}, f, indent=2, sort_keys=True)
+        print("Saved %s" % args.save)
+
+
+if __name__ == '__main__':
+    main()
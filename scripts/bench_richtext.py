@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Time the richtext conversion of the VoteIT4 export against the way it used to be done,
+on all proposals and discussion posts of a site. Also checks that both produce the same bodies.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import re
+from timeit import default_timer
+
+from pyramid.paster import bootstrap
+from voteit.core.helpers import AT_PATTERN
+from voteit.core.helpers import TAG_PATTERN
+
+import export_to_voteit4 as export
+
+
+# The way it was done before convert_richtext_body was a single pass
+def legacy_adjust_tags(text, tag_map):
+    if not tag_map:
+        return text
+    out = []
+    for item in text.split(" "):
+        # Hash sign first
+        tag = item[1:]
+        if tag in tag_map:
+            out.append("#" + tag_map[tag])
+        else:
+            out.append(item)
+    return " ".join(out)
+
+
+def legacy_text_to_v4_hashtag(text):
+
+    def handle_match(matchobj):
+        return export.mk_v4_hashtag(matchobj.group('tag'))
+
+    return re.sub(TAG_PATTERN, handle_match, text)
+
+
+def legacy_text_to_v4_mention(text):
+
+    def handle_match(matchobj):
+        userid = matchobj.group(2).lower()
+        try:
+            user_pk = export.get_pk_for_userid(userid)
+        except KeyError:
+            return " %s" % userid
+        name = export.ctx.user_pk_to_fullname[user_pk]
+        return " %s" % export.user_tag.format(userid=user_pk, name=name)
+
+    return re.sub(AT_PATTERN, handle_match, text)
+
+
+def legacy_add_paras(text):
+    if '<p>' in text.lower():
+        return text
+    text = text.strip()
+    text = re.sub(r"(\s*)[\n]{2,}", "</p>\n<p>", text)
+    reformatted = ""
+    for row in text.splitlines():
+        row = row.strip()
+        if not row.endswith(">"):
+            row += "<br/>"
+        reformatted += row + "\n"
+    text = "<p>" + reformatted + "</p>"
+    text = text.replace("<br/>\n</p>", "</p>")
+    text = re.sub(r"(<br/>\n){2,}", "</p>\n<p>", text, flags=re.DOTALL)
+    return text
+
+
+def legacy_body(text, tag_map, paras):
+    body = legacy_text_to_v4_hashtag(legacy_text_to_v4_mention(legacy_adjust_tags(text, tag_map)))
+    if paras:
+        body = legacy_add_paras(body)
+    return body
+
+
+def current_body(text, tag_map, paras):
+    return export.convert_richtext_body(text, tag_map, paras=paras)
+
+
+def read_corpus(root, request):
+    """
+    :return: list of (path, text, tag_map, add_paras)
+    """
+    corpus = []
+    query = "type_name in any(['Proposal', 'DiscussionPost'])"
+    docids = root.catalog.query(query)[1]
+    for obj in request.resolve_docids(docids, perm=None):
+        tag_map = export.adjust_object_richtext_tags(obj)
+        paras = obj.type_name == 'DiscussionPost' or obj.diff_text_para is None
+        corpus.append((export.resource_path(obj), obj.text, tag_map, paras))
+    return corpus
+
+
+def time_bodies(fn, corpus, rounds):
+    best = None
+    for i in range(rounds):
+        start = default_timer()
+        for (path, text, tag_map, paras) in corpus:
+            fn(text, tag_map, paras)
+        took = default_timer() - start
+        if best is None or took < best:
+            best = took
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_uri", help="Paster ini file to load settings from")
+    parser.add_argument("-r", "--rounds", type=int, default=3, help="Best of this many rounds is reported")
+    parser.add_argument("-d", "--diffs", type=int, default=5, help="Show this many differing bodies")
+    args = parser.parse_args()
+    env = bootstrap(args.config_uri)
+    root = env['root']
+    request = env['request']
+    for user_pk, user in enumerate(root['users'].values(), start=1):
+        export.ctx.add_user(user.userid, user_pk, user.title)
+    corpus = read_corpus(root, request)
+    print("Read %s texts, %s chars" % (len(corpus), sum(len(x[1]) for x in corpus)))
+
+    differs = 0
+    for (path, text, tag_map, paras) in corpus:
+        expected = legacy_body(text, tag_map, paras)
+        body = current_body(text, tag_map, paras)
+        if body != expected:
+            differs += 1
+            if differs <= args.diffs:
+                print("-" * 80)
+                print(path)
+                print("Before: %r" % expected)
+                print("Now:    %r" % body)
+    if differs:
+        # Truncated tags are replaced everywhere now, not only when surrounded by spaces
+        print("-" * 80)
+        print("!!! %s bodies differ" % differs)
+    else:
+        print("All bodies are the same")
+
+    legacy = time_bodies(legacy_body, corpus, args.rounds)
+    current = time_bodies(current_body, corpus, args.rounds)
+    print("Before:".ljust(10), "%.3fs" % legacy)
+    print("Now:".ljust(10), "%.3fs" % current)
+    if current:
+        print("Speedup:".ljust(10), "%.2fx" % (legacy / current))
+
+
+if __name__ == '__main__':
+    main()
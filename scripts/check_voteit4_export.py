@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Check that a VoteIT4 export from export_to_voteit4.py holds together: every foreign key points at
+a record within the export, and no model has the same pk twice. Users that weren't needed are
+left out of the export, so references to them show up as dangling.
+
+Reads the export a bit at a time in one pass, so it works on files too large to load.
+Only the pks of each model are kept, as one bit per pk, together with references
+to records that haven't been read yet.
+
+Doesn't need anything but the standard library, so it can run wherever the export is.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import gzip
+import json
+import os
+import sys
+from array import array
+
+
+# Field -> model it points at
+REFERENCES = {
+    'agenda_item': 'agenda.agendaitem',
+    'author': 'core.user',
+    'button': 'reactions.reactionbutton',
+    'context': 'meeting.meeting',
+    'electoral_register': 'poll.electoralregister',
+    'meeting': 'meeting.meeting',
+    'meeting_group': 'meeting.meetinggroup',
+    'organisation': 'organisation.organisation',
+    'paragraph': 'proposal.textparagraph',
+    'pns': 'participant_number.pnsystem',
+    'poll': 'poll.poll',
+    'register': 'poll.electoralregister',
+    'role': 'meeting.grouprole',
+    'speaker_list': 'speaker.speakerlist',
+    'speaker_system': 'speaker.speakerlistsystem',
+    'text_document': 'proposal.textdocument',
+    'user': 'core.user',
+}
+# Fields with lists of pks
+MANY_REFERENCES = {
+    'members': 'core.user',
+    'mentions': 'core.user',
+    'proposals': 'proposal.proposal',
+}
+# Models that extend another model, and share the pk of it
+PARENT_MODELS = {
+    'proposal.diffproposal': 'proposal.proposal',
+}
+# Bytes to read at a time
+READ_SIZE = 1024 * 1024
+
+
+class PKSet:
+    """ One bit per possible pk. """
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.count = 0
+
+    def __contains__(self, pk):
+        i = pk >> 3
+        return i < len(self.bits) and bool(self.bits[i] & (1 << (pk & 7)))
+
+    def add(self, pk):
+        i = pk >> 3
+        if i >= len(self.bits):
+            self.bits.extend(bytearray(i - len(self.bits) + 1 + len(self.bits) // 2))
+        self.bits[i] |= 1 << (pk & 7)
+        self.count += 1
+
+
+def read_text(stream, size):
+    """ Read and decode, without splitting characters that are more than one byte. """
+    chunk = stream.read(size)
+    for i in range(3):
+        try:
+            return chunk.decode('utf-8')
+        except UnicodeDecodeError:
+            more = stream.read(1)
+            if not more:
+                break
+            chunk += more
+    return chunk.decode('utf-8')
+
+
+def iter_json_array(stream, read_size=READ_SIZE):
+    """
+    Yield the items of a JSON array, reading a bit of it at a time.
+
+    :param stream: file opened in binary mode
+    """
+    decoder = json.JSONDecoder()
+    buf = read_text(stream, read_size).lstrip()
+    if not buf.startswith('['):
+        raise ValueError("Not a JSON array")
+    pos = 1
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buf):
+            buf = read_text(stream, read_size)
+            pos = 0
+            if not buf:
+                raise ValueError("The export ends before the array does")
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            # The item continues in what hasn't been read yet. Read more each time, for large items.
+            more = read_text(stream, max(read_size, len(buf)))
+            if not more:
+                raise
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        yield item
+        pos = end
+
+
+def iter_records(path, read_size=READ_SIZE):
+    """
+    Records of an export file, or of a directory written with --chunked.
+    """
+    if os.path.isdir(path):
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        for entry in manifest['models']:
+            for chunk in entry['chunks']:
+                if not chunk['file'].endswith('.json.gz'):
+                    raise ValueError("Only JSON chunks can be checked, not %s" % chunk['file'])
+                with gzip.open(os.path.join(path, chunk['file']), 'rb') as stream:
+                    for record in iter_json_array(stream, read_size):
+                        yield record
+    else:
+        with open(path, 'rb') as stream:
+            for record in iter_json_array(stream, read_size):
+                yield record
+
+
+class IntegrityChecker:
+    """
+    Feed it records in any order. References to pks that haven't been seen yet are kept until
+    check_pending, as arrays of numbers rather than records.
+    """
+
+    def __init__(self, examples=5):
+        self.examples = examples
+        self.pks = {}
+        self.records = 0
+        # (model, field, target) -> index used in the pending arrays
+        self.ref_types = []
+        self.ref_type_index = {}
+        # target model -> (ref type indexes, source pks, target pks)
+        self.pending = {}
+        # model -> [count, examples]
+        self.duplicates = {}
+        # (model, field, target) -> [count, examples]
+        self.dangling = {}
+
+    def get_pks(self, model):
+        pks = self.pks.get(model)
+        if pks is None:
+            pks = self.pks[model] = PKSet()
+        return pks
+
+    def add(self, record):
+        model = record['model']
+        pk = record['pk']
+        self.records += 1
+        pks = self.get_pks(model)
+        if pk in pks:
+            self._report(self.duplicates, model, pk)
+        else:
+            pks.add(pk)
+        fields = record['fields']
+        for (name, value) in fields.items():
+            if value is None:
+                continue
+            if name in REFERENCES and not isinstance(value, list):
+                self.reference(model, pk, name, REFERENCES[name], value)
+            elif name in MANY_REFERENCES:
+                for target_pk in value:
+                    self.reference(model, pk, name, MANY_REFERENCES[name], target_pk)
+        if 'content_type' in fields and 'object_id' in fields:
+            # Generic relation, like reactions
+            self.reference(model, pk, 'object_id', '.'.join(fields['content_type']), fields['object_id'])
+        if model in PARENT_MODELS:
+            self.reference(model, pk, 'pk', PARENT_MODELS[model], pk)
+
+    def reference(self, model, pk, field, target, target_pk):
+        if target_pk in self.get_pks(target):
+            return
+        key = (model, field, target)
+        index = self.ref_type_index.get(key)
+        if index is None:
+            index = self.ref_type_index[key] = len(self.ref_types)
+            self.ref_types.append(key)
+        pending = self.pending.get(target)
+        if pending is None:
+            pending = self.pending[target] = (array(str('i')), array(str('l')), array(str('l')))
+        pending[0].append(index)
+        pending[1].append(pk)
+        pending[2].append(target_pk)
+
+    def check_pending(self):
+        """ Everything is read, so whatever is still missing is dangling. """
+        for (target, (indexes, source_pks, target_pks)) in self.pending.items():
+            pks = self.get_pks(target)
+            for i in range(len(indexes)):
+                if target_pks[i] not in pks:
+                    model, field, target = self.ref_types[indexes[i]]
+                    self._report(self.dangling, (model, field, target), "%s -> %s" % (source_pks[i], target_pks[i]))
+        self.pending.clear()
+
+    def _report(self, found, key, example):
+        entry = found.get(key)
+        if entry is None:
+            entry = found[key] = [0, []]
+        entry[0] += 1
+        if len(entry[1]) < self.examples:
+            entry[1].append(example)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("export", help="Export file, or directory written with --chunked")
+    parser.add_argument("-e", "--examples", type=int, default=5, help="Show this many pks for each problem")
+    args = parser.parse_args()
+    checker = IntegrityChecker(examples=args.examples)
+    for record in iter_records(args.export):
+        checker.add(record)
+    checker.check_pending()
+
+    print("Read %s records" % checker.records)
+    for model in sorted(checker.pks):
+        if checker.pks[model].count:
+            print("  %s %s" % (model.ljust(40), checker.pks[model].count))
+    for (model, (count, examples)) in sorted(checker.duplicates.items()):
+        print("Duplicate pks in %s: %s, like %s" % (model, count, ", ".join(map(str, examples))))
+    for ((model, field, target), (count, examples)) in sorted(checker.dangling.items()):
+        print("Dangling %s.%s -> %s: %s, like %s" % (model, field, target, count, ", ".join(examples)))
+    if checker.duplicates or checker.dangling:
+        sys.exit("!!! The export has %s kinds of duplicates and %s kinds of dangling references" % (
+            len(checker.duplicates), len(checker.dangling)))
+    print("All references resolve and all pks are unique")
+
+
+if __name__ == '__main__':
+    main()
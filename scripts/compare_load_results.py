@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Compare results saved with --save by load_test.py, load_scenario.py or replay_access_log.py.
+Exits with an error if any endpoint got significantly slower or failed more often than in the baseline,
+so it can be run after upgrading packages in the buildout.
+
+Latencies are compared with a Mann-Whitney U test over the whole histograms, not only the percentiles.
+With many requests even tiny changes are significant, so p50 or p95 must also have grown more than
+the threshold.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import sys
+
+from load_test import LoadStats
+from load_test import REGRESSION_THRESHOLD
+from load_test import SIGNIFICANCE
+from load_test import compare
+from load_test import print_comparison
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("baseline", help="Results from an earlier run")
+    parser.add_argument("results", help="Results to check")
+    parser.add_argument("--significance", type=float, default=SIGNIFICANCE,
+                        help="Highest probability of the change being chance that counts")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="Part that p50 or p95 must grow with, 0.05 is 5%%")
+    args = parser.parse_args()
+    baseline, _ = LoadStats.load(args.baseline)
+    current, _ = LoadStats.load(args.results)
+    rows = compare(baseline, current, significance=args.significance, threshold=args.threshold)
+    missing = [x for x in current.endpoints if x not in baseline.endpoints]
+    if missing:
+        print("Not in the baseline: %s" % ", ".join(missing))
+    if print_comparison(rows):
+        sys.exit("!!! Slower or more errors than %s" % args.baseline)
+    print("No regressions")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,34 @@
 from __future__ import unicode_literals
 
 import argparse
+import gzip
+import linecache
+import os
 import re
+import shutil
 import sys
+from array import array
+from binascii import unhexlify
+from bisect import bisect_left
 from collections import Counter
+from collections import OrderedDict
 from datetime import datetime
+from hashlib import sha1
+from itertools import chain
+from itertools import repeat
 from json import dump
 from json import dumps
+from json import load
+from json import loads
+from multiprocessing import Pool
+from tempfile import TemporaryFile
+from tempfile import mkdtemp
+from tempfile import mkstemp
+from timeit import default_timer
+from uuid import UUID
 from uuid import uuid4
 
+import transaction
 from arche.security import ROLE_EDITOR
 from arche.security import ROLE_REVIEWER
 from arche.utils import resolve_uid
@@ -17,7 +37,11 @@ from arche_usertags.interfaces import IUserTags
 from pyramid.paster import bootstrap
 from pyramid.traversal import resource_path
 from pyramid.traversal import find_interface
+from pyramid.traversal import find_root
+from repoze.catalog.query import Eq
+from six import integer_types
 from six import string_types
+from six import text_type
 from voteit.core.helpers import AT_PATTERN
 from voteit.core.helpers import TAG_PATTERN
 from voteit.core.models.interfaces import IDiffText
@@ -37,6 +61,10 @@ from voteit.irl.models.interfaces import IElectoralRegister
 from voteit.irl.models.interfaces import IParticipantNumbers
 from voteit.multiple_votes import MEETING_NAMESPACE as MV_MEETING_NAMESPACE
 
+try:
+    import resource
+except ImportError:
+    resource = None
 try:
     from voteit.vote_groups.interfaces import ROLE_PRIMARY
     from voteit.vote_groups.interfaces import ROLE_STANDIN
@@ -45,10 +73,11 @@ except ImportError:
 
 
 # Settings
-SINGLE_ERROR = False
+# Errors with the same message are counted, and only this many of them kept with path and details
+ERROR_SAMPLES = 20
 ONLY_MEETING_NAMES=[]
 DIE_ON_CRITICAL = False
-DEBUG_ENCODE = False
+VALIDATE_RECORDS = True
 REPORT_NOT_CLOSED = False
 REPORT_TRUNCATED_TAGS_AS_ERROR = False
 REPORT_SCHULZE_STV = False
@@ -56,36 +85,473 @@ REPORT_EMPTY_POLLS = False
 REPORT_DUPLICATE_EMAIL = False
 VOTE_GROUPS_NAMESPACE = '_vote_groups'
 SFS_DELEGATIONS_NAMESPACE = '__delegations__'
-
-userid_to_pk = {}
-user_pk_to_fullname = {}
-meeting_name_to_pk = {}
-meeting_to_user_pks = {}
-reported_meeting_to_user_pks = {}
-ai_name_to_pk = {}
-ai_uid_to_pk = {}
-proposal_uid_to_pk = {}
-# key like f"{ai_pk}:{paragraph}"
-diff_text_ai_pk_and_paragraph_to_pk = {}
-needed_userids = set()
-long_tag_to_trunc = {}
-pns_pn_check = {}
-pk_to_old_pns = {}
+# Catalog index with the userids that like each object. If it doesn't exist, every object is checked for likes
+# and that's reported when export starts.
+LIKES_INDEX = 'like_userids'
+# Places that loaded most objects to show with --trace-loads
+TRACE_SUMMARY_ROWS = 40
 
 userid_force_swap_email = {}
 
-errors = {}
-unique_errors = set()
-critical_errors = set()
-email_to_userid = {}
-ai_prop_ids = {}
-meeting_groupids = {}
-meeting_role_check=set()
+
+class UIDMap:
+    """
+    Maps uid strings to pks. The uids are stored as 16 byte keys instead of 36 char strings.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    @staticmethod
+    def _key(uid):
+        # Same bytes as UUID(uid).bytes, without the overhead of creating a UUID for every lookup
+        hex_uid = uid.replace('-', '')
+        if len(uid) == 36 and len(hex_uid) == 32:
+            try:
+                return unhexlify(hex_uid)
+            except (TypeError, ValueError):
+                pass
+        # Not something we created, but let's not fail on it
+        return uid.encode('utf-8')
+
+    @staticmethod
+    def _uid(key):
+        if len(key) == 16:
+            return text_type(UUID(bytes=key))
+        return key.decode('utf-8')
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, uid):
+        return self._key(uid) in self.data
+
+    def __getitem__(self, uid):
+        return self.data[self._key(uid)]
+
+    def __setitem__(self, uid, pk):
+        self.data[self._key(uid)] = pk
+
+    def get(self, uid, default=None):
+        return self.data.get(self._key(uid), default)
+
+    def clear(self):
+        self.data.clear()
+
+    def as_dict(self):
+        return dict((self._uid(k), v) for (k, v) in self.data.items())
+
+
+class IntSet:
+    """
+    Read-only set of ints as a sorted array. Much smaller than a set, lookups are a binary search.
+    """
+
+    def __init__(self, items=()):
+        self.data = array(str('l'), sorted(set(items)))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, value):
+        i = bisect_left(self.data, value)
+        return i < len(self.data) and self.data[i] == value
+
+    def __iter__(self):
+        return iter(self.data)
+
+
+class PKBitmap:
+    """
+    Set of pks as a bitmap, one bit per possible pk. Good for dense pks like the ones of users.
+    """
+
+    def __init__(self, items=()):
+        self.bits = bytearray()
+        self.update(items)
+
+    def __contains__(self, pk):
+        i = pk >> 3
+        return i < len(self.bits) and bool(self.bits[i] & (1 << (pk & 7)))
+
+    def __iter__(self):
+        for i, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield (i << 3) | bit
+
+    def __len__(self):
+        return sum(1 for x in self)
+
+    def add(self, pk):
+        i = pk >> 3
+        if i >= len(self.bits):
+            self.bits.extend(bytearray(i + 1 - len(self.bits)))
+        self.bits[i] |= 1 << (pk & 7)
+
+    def update(self, items):
+        if isinstance(items, PKBitmap):
+            if len(items.bits) > len(self.bits):
+                self.bits.extend(bytearray(len(items.bits) - len(self.bits)))
+            for (i, byte) in enumerate(items.bits):
+                if byte:
+                    self.bits[i] |= byte
+        else:
+            for pk in items:
+                self.add(pk)
+
+    def clear(self):
+        del self.bits[:]
+
+
+class LoadCounter:
+    """
+    Bytes of object state loaded by connections. ZODB only counts loads, so the load method of the
+    storage each connection uses is wrapped.
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self.storages = set()
+
+    def install(self, conn):
+        storage = getattr(conn, '_storage', None)
+        if storage is None or id(storage) in self.storages:
+            return
+        load = storage.load
+
+        def _load(*args, **kwargs):
+            result = load(*args, **kwargs)
+            self.bytes += len(result[0])
+            return result
+
+        try:
+            storage.load = _load
+        except AttributeError:
+            return
+        self.storages.add(id(storage))
+
+
+load_counter = LoadCounter()
+
+
+class ActivationTracer:
+    """
+    Records each object the database connection loads, by its class and the function in this script
+    that caused it. Loads mostly happen within adapters and other helpers, so the line in this
+    script that called them is kept too.
+    """
+
+    def __init__(self):
+        # (function, line, class) -> [loads, bytes]
+        self.activations = {}
+        # To show the lines, __file__ may be the compiled file
+        self.filename = os.path.splitext(__file__)[0] + '.py'
+
+    def install(self, conn):
+        setstate = conn.setstate
+
+        def _setstate(obj):
+            loaded = load_counter.bytes
+            try:
+                return setstate(obj)
+            finally:
+                self.add(obj, load_counter.bytes - loaded, sys._getframe(1))
+
+        conn.setstate = _setstate
+
+    def add(self, obj, size, frame):
+        function, line = '(outside export)', 0
+        while frame is not None:
+            if frame.f_globals.get('__name__') == __name__:
+                function, line = frame.f_code.co_name, frame.f_lineno
+                break
+            frame = frame.f_back
+        cls = obj.__class__
+        key = (function, line, "%s.%s" % (cls.__module__, cls.__name__))
+        entry = self.activations.get(key)
+        if entry is None:
+            entry = self.activations[key] = [0, 0]
+        entry[0] += 1
+        entry[1] += size
+
+    def as_list(self):
+        """ Most loads first """
+        out = [
+            {'function': function, 'line': line, 'class': cls, 'loads': loads, 'bytes': size}
+            for ((function, line, cls), (loads, size)) in self.activations.items()
+        ]
+        out.sort(key=lambda x: (-x['loads'], -x['bytes'], x['function'], x['line']))
+        return out
+
+    def pop(self):
+        """ as_list and start over, for the results of meetings. """
+        out = self.as_list()
+        self.activations.clear()
+        return out
+
+    def merge(self, activations):
+        for x in activations:
+            entry = self.activations.setdefault((x['function'], x['line'], x['class']), [0, 0])
+            entry[0] += x['loads']
+            entry[1] += x['bytes']
+
+    def print_summary(self, rows=TRACE_SUMMARY_ROWS):
+        activations = self.as_list()
+        print("-" * 80)
+        print("Objects loaded from the database, by where it happened:")
+        print("Loads".rjust(9) + "KB".rjust(10) + "  " + "Function:line".ljust(40) + "Class")
+        print("=" * 80)
+        for x in activations[:rows]:
+            print(
+                str(x['loads']).rjust(9) + ("%.1f" % (x['bytes'] / 1024.0)).rjust(10) + "  " +
+                ("%s:%s" % (x['function'], x['line'])).ljust(40) + x['class']
+            )
+            if x['line']:
+                print(" " * 21 + linecache.getline(self.filename, x['line']).strip())
+        if len(activations) > rows:
+            print("... and %s more, see the stats file" % (len(activations) - rows))
+        print("Total: %s loads, %.1f KB" % (
+            sum(x['loads'] for x in activations), sum(x['bytes'] for x in activations) / 1024.0))
+
+
+class PhaseStats:
+    """
+    Wall time, exported objects and ZODB loads for each phase of an export.
+
+    One phase runs at a time, starting a phase stops the one before it. A phase that's started
+    again adds to what it had, so phases within a loop are summed. Objects are the pks used
+    during the phase, unless given when stopping.
+    """
+
+    def __init__(self, pks=None, conn=None):
+        self.pks = pks
+        self.conn = conn
+        self.phases = OrderedDict()
+        self.current = None
+        self.started = None
+
+    def _snapshot(self):
+        loads = self.conn.getTransferCounts()[0] if self.conn is not None else 0
+        objects = self.pks.total() if self.pks is not None else 0
+        return default_timer(), objects, loads, load_counter.bytes
+
+    def start(self, name):
+        self.stop()
+        self.current = name
+        self.started = self._snapshot()
+
+    def stop(self, objects=None):
+        if self.current is None:
+            return
+        now = self._snapshot()
+        phase = self.phases.setdefault(self.current, {'seconds': 0.0, 'objects': 0, 'loads': 0, 'load_bytes': 0})
+        phase['seconds'] += now[0] - self.started[0]
+        phase['objects'] += now[1] - self.started[1] if objects is None else objects
+        phase['loads'] += now[2] - self.started[2]
+        phase['load_bytes'] += now[3] - self.started[3]
+        self.current = None
+
+    def as_dict(self):
+        return add_phases(OrderedDict(), self.phases)
+
+
+def add_phases(total, phases):
+    """
+    Add phases from PhaseStats.as_dict to total, and recount objects per second.
+
+    :return: total
+    """
+    for (name, phase) in phases.items():
+        entry = total.setdefault(name, {'seconds': 0.0, 'objects': 0, 'loads': 0, 'load_bytes': 0})
+        for k in ('seconds', 'objects', 'loads', 'load_bytes'):
+            entry[k] += phase[k]
+        entry['objects_per_second'] = entry['seconds'] and entry['objects'] / entry['seconds'] or None
+    return total
+
+
+class ErrorLog:
+    """
+    Errors from add_error, counted per message before it's formatted. Only the first few of each
+    message are kept as samples with path and formatted text, so repeated errors cost a counter.
+
+    With a filename, samples are written as one json object per line when they're added or merged,
+    and close adds a line with the total for each message. Errors within meetings are collected by
+    ErrorLogs without a file, so the file grows by one meeting at a time as results are merged.
+    """
+
+    def __init__(self, filename=None, max_samples=ERROR_SAMPLES):
+        self.filename = filename
+        self.max_samples = max_samples
+        # message -> count
+        self.counts = Counter()
+        # message -> [[path, text]]
+        self.samples = OrderedDict()
+        self.critical = set()
+        self.stream = filename and open(filename, 'wb') or None
+
+    def add(self, msg, critical=False):
+        """ Count msg. :return: True if a sample of it should be added. """
+        self.counts[msg] += 1
+        if critical:
+            self.critical.add(msg)
+        return len(self.samples.get(msg, ())) < self.max_samples
+
+    def add_sample(self, msg, path, text):
+        self.samples.setdefault(msg, []).append([path, text])
+        self._write({'message': msg, 'path': path, 'text': text, 'critical': msg in self.critical})
+
+    def merge(self, other):
+        """ Add errors from another ErrorLog, like one from a worker. """
+        self.counts.update(other.counts)
+        self.critical.update(other.critical)
+        for (msg, samples) in other.samples.items():
+            for (path, text) in samples[:self.max_samples - len(self.samples.get(msg, ()))]:
+                self.add_sample(msg, path, text)
+        if self.stream is not None:
+            self.stream.flush()
+
+    def iter_summary(self):
+        """ (message, count, samples), critical first and then the most common. """
+        for (msg, count) in sorted(self.counts.items(), key=lambda x: (x[0] not in self.critical, -x[1], x[0])):
+            yield msg, count, self.samples.get(msg, [])
+
+    def as_dict(self):
+        return {'counts': dict(self.counts), 'samples': self.samples, 'critical': sorted(self.critical)}
+
+    @classmethod
+    def from_dict(cls, data):
+        errors = cls()
+        errors.counts.update(data['counts'])
+        errors.samples.update(data['samples'])
+        errors.critical.update(data['critical'])
+        return errors
+
+    def close(self):
+        if self.stream is None:
+            return
+        for (msg, count, samples) in self.iter_summary():
+            self._write({'message': msg, 'count': count, 'samples': len(samples), 'critical': msg in self.critical})
+        self.stream.close()
+        self.stream = None
+
+    def _write(self, entry):
+        if self.stream is not None:
+            self.stream.write((dumps(entry) + '\n').encode('utf-8'))
+
+    def __getstate__(self):
+        # Only the main process writes a file
+        state = self.__dict__.copy()
+        state['stream'] = None
+        return state
+
+
+class ExportContext:
+    """
+    Lookups and things collected during export.
+    """
+
+    def __init__(self):
+        # Users
+        self.userid_to_pk = {}
+        self.user_pk_to_fullname = {}
+        # user pk -> rendered mention
+        self.usertags = {}
+        self.email_to_userid = {}
+        self.needed_user_pks = PKBitmap()
+        # Meetings
+        self.meeting_name_to_pk = {}
+        self.meeting_pk_to_name = {}
+        # proposal pk -> meeting pk, see add_proposal. Proposal pks are unique across meetings so it's kept.
+        self.proposal_pk_to_meeting_pk = array(str('l'))
+        # Only valid within a meeting
+        self.meeting_to_user_pks = {}
+        self.reported_meeting_to_user_pks = {}
+        self.ai_name_to_pk = {}
+        self.ai_uid_to_pk = UIDMap()
+        self.proposal_uid_to_pk = UIDMap()
+        # uid -> meeting (None if deleted) of proposals that polls refer to but can't be exported
+        self.skipped_proposal_uids = {}
+        # key like (ai_pk, paragraph)
+        self.diff_text_ai_pk_and_paragraph_to_pk = {}
+        self.pns_pn_check = {}
+        self.pk_to_old_pns = {}
+        self.ai_prop_ids = {}
+        self.meeting_groupids = {}
+        self.meeting_role_check = set()
+        # Timing of the export being run, see PhaseStats
+        self.phases = PhaseStats()
+        # ActivationTracer when loads are traced
+        self.tracer = None
+        # Collected
+        self.long_tag_to_trunc = {}
+        self.errors = ErrorLog()
+
+    def add_user(self, userid, user_pk, fullname):
+        self.userid_to_pk[userid] = user_pk
+        self.user_pk_to_fullname[user_pk] = fullname
+
+    def add_meeting(self, name, meeting_pk):
+        self.meeting_name_to_pk[name] = meeting_pk
+        self.meeting_pk_to_name[meeting_pk] = name
+
+    def add_proposal(self, uid, proposal_pk, meeting_pk):
+        self.proposal_uid_to_pk[uid] = proposal_pk
+        if proposal_pk >= len(self.proposal_pk_to_meeting_pk):
+            self.proposal_pk_to_meeting_pk.extend([0] * (proposal_pk + 1 - len(self.proposal_pk_to_meeting_pk)))
+        self.proposal_pk_to_meeting_pk[proposal_pk] = meeting_pk
+
+    def need_userid(self, userid):
+        if userid in self.userid_to_pk:
+            self.needed_user_pks.add(self.userid_to_pk[userid])
+
+    def reset_meeting(self):
+        """
+        Lookups that are only valid within a meeting. Clearing them between meetings makes the export
+        of a meeting independent of which meetings were exported before it in the same process.
+        """
+        self.meeting_to_user_pks.clear()
+        self.reported_meeting_to_user_pks.clear()
+        self.ai_name_to_pk.clear()
+        self.ai_uid_to_pk.clear()
+        self.proposal_uid_to_pk.clear()
+        self.skipped_proposal_uids.clear()
+        self.diff_text_ai_pk_and_paragraph_to_pk.clear()
+        self.pns_pn_check.clear()
+        self.pk_to_old_pns.clear()
+        self.ai_prop_ids.clear()
+        self.meeting_groupids.clear()
+        self.meeting_role_check.clear()
+
+    def reset_collected(self):
+        """ Things collected during export that the main process needs from workers. """
+        self.errors = ErrorLog()
+        self.needed_user_pks.clear()
+        self.long_tag_to_trunc.clear()
+
+    def get_collected(self):
+        return {
+            'errors': self.errors,
+            'needed_user_pks': PKBitmap(self.needed_user_pks),
+            'long_tag_to_trunc': dict(self.long_tag_to_trunc),
+        }
+
+    def merge_collected(self, result):
+        """
+        Add what was collected while exporting a meeting, see get_collected.
+        Errors are merged into the ErrorLog of the main process as results arrive.
+        """
+        self.needed_user_pks.update(result['needed_user_pks'])
+        self.long_tag_to_trunc.update(result['long_tag_to_trunc'])
+
+
+ctx = ExportContext()
+
 
 def get_pk_for_userid(userid, context=None, msg=None, ck_meeting_pk=None):
-    needed_userids.add(userid)
     try:
-        user_pk = userid_to_pk[userid]
+        user_pk = ctx.userid_to_pk[userid]
     except KeyError:
         if context:
             if msg is None:
@@ -94,17 +560,15 @@ def get_pk_for_userid(userid, context=None, msg=None, ck_meeting_pk=None):
             return
         else:
             raise
+    ctx.needed_user_pks.add(user_pk)
     if ck_meeting_pk:
-        if user_pk not in meeting_to_user_pks[ck_meeting_pk]:
-            already_reported = reported_meeting_to_user_pks.setdefault(ck_meeting_pk, set())
+        if user_pk not in ctx.meeting_to_user_pks[ck_meeting_pk]:
+            already_reported = ctx.reported_meeting_to_user_pks.setdefault(ck_meeting_pk, set())
             if user_pk in already_reported:
                 return user_pk
-            # Figure out meeting name
-            meeting_name = "(Unknown meeting with export pk %s)" % ck_meeting_pk
-            for (k, v) in meeting_name_to_pk.items():
-                if v == ck_meeting_pk:
-                    meeting_name = k
-                    break
+            meeting_name = ctx.meeting_pk_to_name.get(
+                ck_meeting_pk, "(Unknown meeting with export pk %s)" % ck_meeting_pk
+            )
             add_error(context, "ck_meeting_pk failed for meeting {meeting_name}, userid {userid} not part of meeting", meeting_name=meeting_name, userid=userid)
             already_reported.add(user_pk)
     return user_pk
@@ -118,45 +582,32 @@ def truncate_tag(tag):
     num = items[-1]
     text = "-".join(items[:-1])
     new_tag = text[:49-len(num)] + "-" + num
-    long_tag_to_trunc[tag] = new_tag
+    if len(new_tag) > 50:
+        # Doesn't end with a short number
+        new_tag = tag[:50]
+    ctx.long_tag_to_trunc[tag] = new_tag
     return new_tag
 
 
 def adjust_object_richtext_tags(obj):
     """
-    Takes a proposal or a discussion post and replaces the tag in the text body and in tags.
+    Takes a proposal or a discussion post and truncates tags that are too long.
     Adjust object in place since we won't save anything anyway.
+
+    :return: dict with long tag -> truncated tag, to replace them in the text body with convert_richtext_body
     """
-    tags_to_adjust = set()
+    tag_map = {}
     if obj.type_name == 'Proposal':
         if len(obj.aid) > 50:
             if REPORT_TRUNCATED_TAGS_AS_ERROR:
                 add_error(obj, "AID tag too long, will be truncated: {tag}", tag=obj.aid)
             obj.aid = truncate_tag(obj.aid)
-            tags_to_adjust.add(obj.aid)
     for tag in obj.tags:  # new copy!
         if len(tag) > 50:
-            truncate_tag(tag)
+            tag_map[tag] = truncate_tag(tag)
             if REPORT_TRUNCATED_TAGS_AS_ERROR:
                 add_error(obj, "Tag too long: {tag}", tag=tag)
-            tags_to_adjust.add(tag)
-    # Silly version of replace i guess
-    if tags_to_adjust:
-        out = []
-        for item in obj.text.split(" "):
-            # Hash sign first
-            tag = item[1:]
-            if tag in tags_to_adjust:
-                out.append("#" + long_tag_to_trunc[tag])
-            else:
-                out.append(item)
-        # print("ORIG TEXT:")
-        # print(obj.text)
-        obj.text = " ".join(out)
-        # print("NEW TEXT:")
-        # print(obj.text)
-        # print("-"*80)
-    return obj
+    return tag_map
 
 # VoteIT3 as key
 poll_method_mapping = {
@@ -197,6 +648,8 @@ model_map = {
 def add_error(obj, msg, critical=False, **kwargs):
 
     def _get_path(obj):
+        if isinstance(obj, string_types):
+            return obj
         try:
             return resource_path(obj)
         except AttributeError:
@@ -204,40 +657,14 @@ def add_error(obj, msg, critical=False, **kwargs):
 
 
     if critical:
-        critical_errors.add(msg.format(**kwargs))
         msg = "CRIT: " + msg
         if DIE_ON_CRITICAL:
 
             raise Exception(_get_path(obj) + "   " + msg.format(**kwargs))
-    if SINGLE_ERROR and msg in unique_errors:
-        return
-    errs = errors.setdefault(_get_path(obj), [])
-    errs.append(msg.format(**kwargs))
-    unique_errors.add(msg)
-
-
-def debugencode(fn):
-    def _inner(*args,**kwargs):
-        result = fn(*args, **kwargs)
-        if not DEBUG_ENCODE:
-            return result
-        try:
-            if not result:
-                return
-            dumps(result)
-        except Exception as exc:
-            print("fn %s cased exc with data:" % fn.__name__)
-            print(result)
-            raise
-        if {'pk', 'fields', 'model'} != set(result):
-            raise ValueError("Wrong keys in result: %s" % result.keys())
-        # Crude text check
-        for (k, v) in result['fields'].items():
-            if isinstance(v, string_types) and '\x00' in v:
-                raise ValueError("Null char in result:\n%s" % result)
-        return result
+    # Paths and formatting are only needed for samples
+    if ctx.errors.add(msg, critical):
+        ctx.errors.add_sample(msg, _get_path(obj), msg.format(**kwargs))
 
-    return _inner
 
 hashtag_tag = """<span class="mention" data-index="0" data-denotation-char="#" data-id="{tag}" data-value="{tag}"><span contenteditable="false"><span class="ql-mention-denotation-char">#</span>{tag}</span></span>
 """
@@ -250,8 +677,13 @@ user_tag = """<span class="mention" data-index="0" data-denotation-char="@" data
 
 def mk_v4_usertag(user_pk):
     assert isinstance(user_pk, int)
-    name = user_pk_to_fullname[user_pk]
-    return user_tag.format(userid=user_pk, name=name)
+    try:
+        return ctx.usertags[user_pk]
+    except KeyError:
+        pass
+    name = ctx.user_pk_to_fullname[user_pk]
+    html = ctx.usertags[user_pk] = user_tag.format(userid=user_pk, name=name)
+    return html
 
 
 def text_to_v4_hashtag(text):
@@ -265,46 +697,208 @@ def text_to_v4_hashtag(text):
     return re.sub(TAG_PATTERN, handle_match, text)
 
 
-def text_to_v4_mention(text):
+# Mentions and hashtags in one pass. Groups from AT_PATTERN come first, TAG_PATTERN is used by group name.
+RICHTEXT_PATTERN = re.compile("(?:%s)|(?:%s)" % (AT_PATTERN.pattern, TAG_PATTERN.pattern), flags=re.UNICODE)
+# What str.splitlines splits on
+LINE_BREAK_CHARS = "\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+LINE_BREAK_SEARCH = re.compile("[%s]" % LINE_BREAK_CHARS).search
+# The same, and whitespace with line breaks for add_paras
+RICHTEXT_PARAS_PATTERN = re.compile(
+    "%s|(?P<lines>\\s*[%s]\\s*)" % (RICHTEXT_PATTERN.pattern, LINE_BREAK_CHARS), flags=re.UNICODE
+)
 
-    def handle_match(matchobj):
+
+def convert_richtext_body(text, tag_map=None, paras=False):
+    """
+    Convert mentions and hashtags to VoteIT4 markup.
+
+    The result is the same as converting mentions first and then hashtags in the converted text.
+
+    :param tag_map: dict with tags to replace, see adjust_object_richtext_tags
+    :param paras: add paragraphs and line breaks within the same pass, the result is the same as
+        with add_paras afterwards. Texts with html of their own go through add_paras.
+    """
+    if tag_map is None:
+        tag_map = {}
+    if paras and '<' in text:
+        return add_paras(convert_richtext_body(text, tag_map))
+    out = RichtextOut(paras)
+    pos = 0
+    search = (paras and RICHTEXT_PARAS_PATTERN or RICHTEXT_PATTERN).search
+    while True:
+        m = search(text, pos)
+        if m is None:
+            break
+        out.append(text[pos:m.start()])
+        pos = m.end()
+        if paras and m.group('lines') is not None:
+            lines = m.group('lines')
+            if pos < len(text) and text[pos] in '@#' and RICHTEXT_PATTERN.match(text, pos - 1):
+                # The last whitespace belongs to the mention or tag after it
+                pos -= 1
+                lines = lines[:-1]
+            out.append_lines(lines)
+            continue
+        tag = m.group('tag')
+        if tag is not None:
+            # Note that the character in front of the tag is replaced too
+            out.append_html(mk_v4_hashtag(tag_map.get(tag, tag)))
+            continue
         # The pattern contains a space, we only find usernames that
-        # has a whitespace in front, we save the space so we can put
-        # it back after the transformation
-        # space, userid = matchobj.group(1, 2)
-        userid = matchobj.group(2)
-        userid = userid.lower()
+        # has a whitespace in front, we put it back after the transformation
+        userid = m.group(2).lower()
         try:
             user_pk = get_pk_for_userid(userid)
         except KeyError:
             # Mentioned user may have been deleted
-            return " %s" % userid
-        return " %s" % mk_v4_usertag(user_pk)
+            out.append(" %s" % userid)
+            continue
+        html = mk_v4_usertag(user_pk)
+        if '#' in html:
+            # A tag within the name
+            html = text_to_v4_hashtag(html)
+        if paras and not is_plain_html(html):
+            return add_paras(convert_richtext_body(text, tag_map))
+        out.append(" ")
+        if text.startswith('#', pos):
+            # The converted mention ends with a newline, so a tag right after it is a tag too
+            tag_match = TAG_PATTERN.match("\n" + text[pos:])
+            if tag_match:
+                tag = tag_match.group('tag')
+                out.append(html[:-1])
+                out.append_html(mk_v4_hashtag(tag_map.get(tag, tag)))
+                pos += tag_match.end() - 1
+                continue
+        out.append_html(html)
+    out.append(text[pos:])
+    return out.get_body()
+
+
+def is_plain_html(html):
+    """ Html that ends with its only line break and has nothing that add_paras would change. """
+    return html.endswith("\n") and len(html.splitlines()) == 1 and \
+        '<p>' not in html.lower() and '</p>' not in html and '<br/>' not in html
+
+
+class RichtextOut:
+    """
+    Output of convert_richtext_body. With paras, whitespace with line breaks is kept aside until the
+    next text, to be converted as add_paras would. Html that's added is expected to end with a newline,
+    which is a line break too.
+    """
+
+    def __init__(self, paras):
+        self.paras = paras
+        self.parts = []
+        if not paras:
+            # Parts are only joined
+            self.append = self.append_html = self.parts.append
+        # Whitespace with line breaks since the last text
+        self.lines = None
+        # Leading whitespace is stripped, like in add_paras
+        self.started = False
+        self.after_tag = False
+
+    def append(self, text):
+        if not text:
+            return
+        if self.lines is not None:
+            stripped = text.lstrip()
+            if not stripped:
+                self.lines += text
+                return
+            if self.started:
+                self.parts.append(convert_line_breaks(self.lines + text[:len(text) - len(stripped)], self.after_tag))
+            self.lines = None
+            text = stripped
+        elif not self.started:
+            text = text.lstrip()
+            if not text:
+                return
+        self.started = True
+        self.parts.append(text)
+        self.after_tag = text.endswith(">")
+
+    def append_html(self, html):
+        self.append(html[:-1])
+        self.append_lines("\n")
+
+    def append_lines(self, lines):
+        if self.lines is not None or LINE_BREAK_SEARCH(lines):
+            self.lines = (self.lines or "") + lines
+        else:
+            self.append(lines)
+
+    def get_body(self):
+        body = "".join(self.parts)
+        if not self.paras:
+            return body
+        # Trailing line breaks are dropped, like in add_paras
+        body = body.rstrip()
+        if body.endswith(">"):
+            return "<p>" + body + "\n</p>"
+        return "<p>" + body + "</p>"
+
+
+# (whitespace, after_tag) -> converted, for convert_line_breaks
+LINE_BREAKS_CACHE = {}
+
+
+def convert_line_breaks(lines, after_tag):
+    """
+    Whitespace with line breaks between two texts, converted as add_paras would.
+    Short whitespace is the same over and over again, so it's converted once.
+
+    :param after_tag: the text before ends with >, so the row it ends doesn't get a <br/>
+    """
+    try:
+        return LINE_BREAKS_CACHE[(lines, after_tag)]
+    except KeyError:
+        pass
+    out = _convert_line_breaks(lines, after_tag)
+    if len(lines) < 10:
+        LINE_BREAKS_CACHE[(lines, after_tag)] = out
+    return out
+
+
+def _convert_line_breaks(lines, after_tag):
+    lines = PARA_BREAK_PATTERN.sub("</p>\n<p>", lines)
+    # Placeholders for the texts around, so rows are split and stripped the same way
+    rows = [x.strip() for x in ((after_tag and ">" or "x") + lines + "x").splitlines()]
+    first = rows[0][1:]
+    out = [first]
+    if not (first or after_tag and ">" or "x").endswith(">"):
+        out.append("<br/>")
+    for row in rows[1:-1]:
+        out.append("\n")
+        out.append(row)
+        if not row.endswith(">"):
+            out.append("<br/>")
+    out.append("\n")
+    out.append(rows[-1][:-1])
+    return BR_BREAK_PATTERN.sub("</p>\n<p>", "".join(out).replace("<br/>\n</p>", "</p>"))
 
-    return re.sub(AT_PATTERN, handle_match, text)
 
+PARA_BREAK_PATTERN = re.compile(r"(\s*)[\n]{2,}")
+BR_BREAK_PATTERN = re.compile(r"(<br/>\n){2,}", flags=re.DOTALL)
 
-def convert_richtext_body(text):
-    return text_to_v4_hashtag(text_to_v4_mention(text))
 
 def add_paras(text):
     if '<p>' in text.lower():
         return text
-    text = text.strip()
-    text = re.sub(r"(\s*)[\n]{2,}", "</p>\n<p>", text)
-    reformatted = ""
+    text = PARA_BREAK_PATTERN.sub("</p>\n<p>", text.strip())
+    rows = []
     for row in text.splitlines():
         row = row.strip()
         if not row.endswith(">"):
             row += "<br/>"
-        reformatted += row + "\n"
-    text = "<p>" + reformatted + "</p>"
+        rows.append(row)
+    rows.append("</p>")
+    text = "<p>" + "\n".join(rows)
     text = text.replace("<br/>\n</p>", "</p>")
-    text = re.sub(r"(<br/>\n){2,}", "</p>\n<p>", text, flags=re.DOTALL)
-    return text
+    return BR_BREAK_PATTERN.sub("</p>\n<p>", text)
 
 
-@debugencode
 def export_root(obj):
     # root -> organisation
     body = obj.body
@@ -322,7 +916,6 @@ def export_root(obj):
     }
 
 
-@debugencode
 def export_user(user, pk):
     #if user.userid != user.userid.lower():
     #    raise ValueError("Uppercase userid: %s" % user.userid)
@@ -333,17 +926,17 @@ def export_user(user, pk):
         if user.userid in userid_force_swap_email:
             print("Force-swapping email %s -> %s" % (email, userid_force_swap_email[user.userid]))
             email = userid_force_swap_email[user.userid]
-        if email in email_to_userid and REPORT_DUPLICATE_EMAIL:
-            add_error(user, 'Duplicate email: {email} also used by userid {userid}',  userid=email_to_userid[email], email=email)
-        email_to_userid[email] = user.userid
+        if email in ctx.email_to_userid and REPORT_DUPLICATE_EMAIL:
+            add_error(user, 'Duplicate email: {email} also used by userid {userid}',  userid=ctx.email_to_userid[email], email=email)
+        ctx.email_to_userid[email] = user.userid
     else:
         email = ""
     return {
         'pk': pk,
         'model':'core.user',
         'fields': {
-            'first_name': user.first_name,
-            'last_name': user.last_name,
+            'first_name': user.first_name or '',
+            'last_name': user.last_name or '',
             'date_joined': django_format_datetime(user.created),
             'last_login': django_format_datetime(user.modified),
             'email': email,
@@ -354,13 +947,12 @@ def export_user(user, pk):
     }
 
 def check_groupid(groupid, meeting_pk, meeting):
-    groupids = meeting_groupids.setdefault(meeting_pk, set())
+    groupids = ctx.meeting_groupids.setdefault(meeting_pk, set())
     if groupid in groupids:
         add_error(meeting, "{groupid} not unique for meeting", groupid=groupid, critical=True)
     groupids.add(groupid)
 
 
-@debugencode
 def export_meeting_group_system_user_like(user, pk, meeting_pk, meeting):
     check_groupid(user.userid, meeting_pk, meeting)
     return {
@@ -369,13 +961,12 @@ def export_meeting_group_system_user_like(user, pk, meeting_pk, meeting):
         'fields': {
             'created': django_format_datetime(user.created),
             'modified': django_format_datetime(user.modified),
-            'title': user.title,
+            'title': (user.title or '')[:100],
             'meeting': meeting_pk,
             'groupid': user.userid,
         }
     }
 
-@debugencode
 def export_meeting_group_sfs_origin(delegation, pk, meeting_pk, meeting):
     check_groupid(delegation.name, meeting_pk, meeting)
     return {
@@ -384,7 +975,7 @@ def export_meeting_group_sfs_origin(delegation, pk, meeting_pk, meeting):
         'fields': {
             'created': django_format_datetime(meeting.created),
             'modified': django_format_datetime(meeting.modified),
-            'title': delegation.title,
+            'title': (delegation.title or '')[:100],
             'body': add_paras(delegation.description),
             'meeting': meeting_pk,
             'groupid': delegation.name,
@@ -392,7 +983,6 @@ def export_meeting_group_sfs_origin(delegation, pk, meeting_pk, meeting):
         }
     }
 
-@debugencode
 def export_meeting_group_mv_origin(va, pk, meeting_pk, meeting):
     check_groupid(va.__name__, meeting_pk, meeting)
     members=[]
@@ -407,7 +997,7 @@ def export_meeting_group_mv_origin(va, pk, meeting_pk, meeting):
         'fields': {
             'created': django_format_datetime(va.created),
             'modified': django_format_datetime(va.created),  # modified doesn't exist
-            'title': va.title,
+            'title': (va.title or '')[:100],
             'meeting': meeting_pk,
             'groupid': va.__name__,
             'votes': va.votes,
@@ -419,7 +1009,6 @@ def export_meeting_group_mv_origin(va, pk, meeting_pk, meeting):
 
 
 
-@debugencode
 def export_meeting_group_vg_origin(vg, pk, meeting_pk, meeting):
     check_groupid(vg.name, meeting_pk, meeting)
     return {
@@ -428,7 +1017,7 @@ def export_meeting_group_vg_origin(vg, pk, meeting_pk, meeting):
         'fields': {
             'created': django_format_datetime(meeting.created), # No clue what to do otherwise
             'modified': django_format_datetime(meeting.modified),
-            'title': vg.title,
+            'title': (vg.title or '')[:100],
             'body': add_paras(vg.description),
             'meeting': meeting_pk,
             'groupid': vg.name,
@@ -436,7 +1025,6 @@ def export_meeting_group_vg_origin(vg, pk, meeting_pk, meeting):
         }
     }
 
-@debugencode
 def export_group_role(pk, meeting_pk, role_id='', title='', roles=()):
     if len(role_id) > 100:
         raise ValueError("role_id more than 100 chars: %s" % role_id)
@@ -453,7 +1041,6 @@ def export_group_role(pk, meeting_pk, role_id='', title='', roles=()):
         }
     }
 
-@debugencode
 def export_group_membership(pk, user_pk, meeting_group_pk, role_pk=None, votes=None):
     return {
         'pk': pk,
@@ -467,7 +1054,6 @@ def export_group_membership(pk, user_pk, meeting_group_pk, role_pk=None, votes=N
     }
 
 
-@debugencode
 def export_meeting(meeting, pk):
     return {
         'pk': pk,
@@ -486,8 +1072,14 @@ def export_meeting(meeting, pk):
     }
 
 
-@debugencode
 def export_ai(ai, pk, meeting_pk):
+    tags = []
+    for tag in ai.tags:
+        if len(tag) > 50:
+            if REPORT_TRUNCATED_TAGS_AS_ERROR:
+                add_error(ai, "Tag too long: {tag}", tag=tag)
+            tag = truncate_tag(tag)
+        tags.append(tag)
     return {
         'pk': pk,
         'model': 'agenda.agendaitem',
@@ -500,7 +1092,7 @@ def export_ai(ai, pk, meeting_pk):
             #FIXME: These aren't valid for the new AIs,
             # 'start_time': ai.start_time and django_format_datetime(ai.start_time) or None,
             # 'end_time': ai.end_time and django_format_datetime(ai.end_time) or None,
-            'tags': list(ai.tags),
+            'tags': tags,
             'meeting': meeting_pk,
             'block_discussion': ai.discussion_block,
             'block_proposals': ai.proposal_block,
@@ -512,31 +1104,46 @@ def export_ai(ai, pk, meeting_pk):
 
 
 def reformat_schulze_round(result):
-    result['winner'] = proposal_uid_to_pk[result['winner']]
+    result['winner'] = ctx.proposal_uid_to_pk[result['winner']]
     if len(result) == 1:
         # All other candidates were exhausted so there's nothing else left
         # V4 expects candidates though
         result['candidates'] = [result['winner']]
         return
-    result['pairs'] = [[[proposal_uid_to_pk[x] for x in k], v] for k, v in result['pairs'].items()]
-    result['candidates'] = [proposal_uid_to_pk[x] for x in result['candidates']]
-    result['strong_pairs'] = [[[proposal_uid_to_pk[x] for x in k], v] for k, v in result['strong_pairs'].items()]
+    result['pairs'] = [[[ctx.proposal_uid_to_pk[x] for x in k], v] for k, v in result['pairs'].items()]
+    result['candidates'] = [ctx.proposal_uid_to_pk[x] for x in result['candidates']]
+    result['strong_pairs'] = [[[ctx.proposal_uid_to_pk[x] for x in k], v] for k, v in result['strong_pairs'].items()]
     if 'tied_winners' in result:
-        result['tied_winners'] = [proposal_uid_to_pk[x] for x in result['tied_winners']]
+        result['tied_winners'] = [ctx.proposal_uid_to_pk[x] for x in result['tied_winners']]
     if 'tie_breaker' in result:
-        result['tie_breaker'] = [proposal_uid_to_pk[x] for x in result['tie_breaker']]
+        result['tie_breaker'] = [ctx.proposal_uid_to_pk[x] for x in result['tie_breaker']]
     #A set with nodes and edges for historic tie breaks - we're not going to care about this level of detail.
     result.pop('actions', None)
 
 
 def get_proposal_with_check(referencing_obj, uid, request):
+    """
+    :return: pk of the proposal, or None if it's deleted or in another meeting. Both are critical errors.
+    """
     meeting = find_interface(referencing_obj, IMeeting)
-    prop = request.resolve_uid(uid, perm=None)
-    maybe_other_meeting = find_interface(prop, IMeeting)
-    if maybe_other_meeting != meeting:
+    pk = ctx.proposal_uid_to_pk.get(uid)
+    if pk is not None and ctx.proposal_pk_to_meeting_pk[pk] == ctx.meeting_name_to_pk.get(meeting.__name__):
+        return pk
+    try:
+        maybe_other_meeting = ctx.skipped_proposal_uids[uid]
+    except KeyError:
+        # Not exported yet, or not from this meeting
+        prop = request.resolve_uid(uid, perm=None)
+        maybe_other_meeting = prop and find_interface(prop, IMeeting)
+        if maybe_other_meeting == meeting:
+            return ctx.proposal_uid_to_pk[uid]
+        ctx.skipped_proposal_uids[uid] = maybe_other_meeting
+    if maybe_other_meeting is None:
+        add_error(referencing_obj, "Must skip export: Proposal {uid} doesn't exist", critical=True, uid=uid)
+    else:
+        # Proposals of other meetings have no pks here
         add_error(referencing_obj, "Must skip export: Proposal from another meeting: {meeting}", critical=True,
                   meeting=resource_path(maybe_other_meeting))
-    return proposal_uid_to_pk[uid]
 
 def reformat_stv_like_result(poll, request, result):
     result['winners'] = result['approved'] = [get_proposal_with_check(poll, x, request) for x in result['winners']]
@@ -570,7 +1177,6 @@ def reformat_stv_like_result(poll, request, result):
     #                                         {u'cf555e02-dab9-4520-84fe-6fe3da786105': Decimal('2')}),
     #  u'selected': (u'cf555e02-dab9-4520-84fe-6fe3da786105',), u'method': u'Direct'},), u'empty_ballot_count': 0}
 
-@debugencode
 def export_poll(poll, pk, meeting_pk, ai_pk, request, er_pk=None):
     state = poll.get_workflow_state()
     is_closed = state == 'closed'
@@ -715,9 +1321,9 @@ def export_poll(poll, pk, meeting_pk, ai_pk, request, er_pk=None):
                 # Only clear results!
                 # No need to double-check here
                 if res['approve'] > res['deny']:
-                    approved.append(proposal_uid_to_pk[k])
+                    approved.append(ctx.proposal_uid_to_pk[k])
                 elif res['deny'] > res['approve'] :
-                    denied.append(proposal_uid_to_pk[k])
+                    denied.append(ctx.proposal_uid_to_pk[k])
             result = {'results': reformed_result, 'approved': approved, 'denied': denied}
         elif poll_plugin == 'dutt_poll':
             # [{'num': 4, 'percent': u'57.1%', 'uid': u'f9635154-68f5-4a17-9940-59a179af6a49'},
@@ -789,68 +1395,131 @@ def export_poll(poll, pk, meeting_pk, ai_pk, request, er_pk=None):
     return data
 
 
-def reverse_schulze_vote(poll, vote_data):
-    """ This changes the old schulze vote data to the v4 format.
-        VoteIT3 used ballot ranking where a low number was a good thing.
-        V4 has 0 for "not ranked" and then points instead
+class ProposalPKs(dict):
+    """ Proposal uid -> pk, looked up once per uid. """
 
-        Example:
-            Ranking [[10, 6], [20, 1]] -> [[10, 0], [20, 5]]
-    """
-    # print('Settings: %s ' % poll.poll_settings.get('max_stars'))
-    max_stars = poll.poll_settings.get('max_stars', 5) + 1
-    try:
-        assert all(x[1] <= max_stars for x in vote_data)
-    except AssertionError:
+    def __missing__(self, uid):
+        pk = self[uid] = ctx.proposal_uid_to_pk[uid]
+        return pk
+
+
+def check_schulze_max_vote(poll, max_vote):
+    """ :param max_vote: highest VoteIT3 ranking in any vote of the poll """
+    if max_vote > poll.poll_settings.get('max_stars', 5) + 1:
         add_error(poll, "Poll contained setting max_stars {max_stars} but has votes with {max_vote}",
-                  critical=True, max_stars=poll.poll_settings.get('max_stars'), max_vote=max(x[1] for x in vote_data))
-    return sorted([[x[0], max_stars-x[1]] for x in vote_data], key=lambda x: x[0])
+                  critical=True, max_stars=poll.poll_settings.get('max_stars'), max_vote=max_vote)
 
 
-@debugencode
-def export_vote(vote, pk, poll_pk, user_pk):
-    if vote.__name__ not in userid_to_pk:
-        add_error(vote, "Duplicate vote or deleted user", critical=True)
-        return
-    orig_vote_data = vote.get_vote_data()
-    poll = vote.__parent__
-    if poll.poll_plugin == 'majority_poll':
-        # Vote data like: '{"choice": 1}'
-        vote_data = dumps({'choice': proposal_uid_to_pk[orig_vote_data['proposal']]})
-    elif poll.poll_plugin in ('schulze_pr', 'schulze', 'schulze_stv', 'sorted_schulze'):
-        items = []
-        for uid, ranking in orig_vote_data.items():
-            items.append(
-                [proposal_uid_to_pk[uid], int(ranking)]
-            )
-        reversed = reverse_schulze_vote(poll, items)
-        vote_data = dumps(reversed)
-    elif poll.poll_plugin == 'combined_simple':
-        data = {'yes': [], 'no': [], 'abstain': []}
-        for uid, choice in orig_vote_data.items():
-            if choice == 'approve':
-                data['yes'].append(proposal_uid_to_pk[uid])
-            elif choice == 'deny':
-                data['no'].append(proposal_uid_to_pk[uid])
-            elif choice in ('abstain', ''):
-                data['abstain'].append(proposal_uid_to_pk[uid])
-            else:
-                raise ValueError("Corrupt data within vote_data: %s" % orig_vote_data)
-        vote_data = dumps(data)
-    elif poll.poll_plugin == 'dutt_poll':
-        vote_data = dumps(sorted([proposal_uid_to_pk[x] for x in orig_vote_data['proposals']]))
-        # Malformed previous export data:
-        # vote_data = dumps({'choices': sorted([proposal_uid_to_pk[x] for x in orig_vote_data['proposals']])})
-    elif poll.poll_plugin in ('scottish_stv','irv', 'repeated_irv'):
-        vote_data = ",".join([str(proposal_uid_to_pk[x]) for x in orig_vote_data['proposals']])
-        # Malformed previous export data:
-        # vote_data = dumps({'ranking': [proposal_uid_to_pk[x] for x in orig_vote_data['proposals']]})
+def get_vote_converter(poll):
+    """
+    Pick how vote data is converted, once per poll.
+
+    :return: function that converts a list of VoteIT3 vote data to a list of VoteIT4 vote data,
+        or None if the poll method can't be handled. Call its check function when all votes are
+        converted, for checks of the poll as a whole.
+    """
+    uid_to_pk = ProposalPKs()
+    poll_plugin = poll.poll_plugin
+    if poll_plugin == 'majority_poll':
+
+        def convert(vote_datas):
+            # Vote data like: '{"choice": 1}'
+            return ['{"choice": %d}' % uid_to_pk[x['proposal']] for x in vote_datas]
+
+    elif poll_plugin in ('schulze_pr', 'schulze', 'schulze_stv', 'sorted_schulze'):
+        # VoteIT3 used ballot ranking where a low number was a good thing.
+        # V4 has 0 for "not ranked" and then points instead
+        # Example:
+        #     Ranking [[10, 6], [20, 1]] -> [[10, 0], [20, 5]]
+        max_stars = poll.poll_settings.get('max_stars', 5) + 1
+        # Highest ranking over all batches
+        seen = {'max_vote': 0}
+
+        def convert(vote_datas):
+            out = []
+            max_vote = seen['max_vote']
+            for vote_data in vote_datas:
+                items = sorted([uid_to_pk[uid], int(ranking)] for (uid, ranking) in vote_data.items())
+                for (pk, ranking) in items:
+                    if ranking > max_vote:
+                        max_vote = ranking
+                out.append("[%s]" % ", ".join(["[%d, %d]" % (pk, max_stars - ranking) for (pk, ranking) in items]))
+            seen['max_vote'] = max_vote
+            return out
+
+        convert.check = lambda: check_schulze_max_vote(poll, seen['max_vote'])
+
+    elif poll_plugin == 'combined_simple':
+
+        def convert(vote_datas):
+            out = []
+            for orig_vote_data in vote_datas:
+                data = {'yes': [], 'no': [], 'abstain': []}
+                for uid, choice in orig_vote_data.items():
+                    if choice == 'approve':
+                        data['yes'].append(uid_to_pk[uid])
+                    elif choice == 'deny':
+                        data['no'].append(uid_to_pk[uid])
+                    elif choice in ('abstain', ''):
+                        data['abstain'].append(uid_to_pk[uid])
+                    else:
+                        raise ValueError("Corrupt data within vote_data: %s" % orig_vote_data)
+                out.append(dumps(data))
+            return out
+
+    elif poll_plugin == 'dutt_poll':
+
+        def convert(vote_datas):
+            # Malformed previous export data:
+            # vote_data = dumps({'choices': sorted([proposal_uid_to_pk[x] for x in orig_vote_data['proposals']])})
+            return [
+                "[%s]" % ", ".join(["%d" % pk for pk in sorted([uid_to_pk[x] for x in vote_data['proposals']])])
+                for vote_data in vote_datas
+            ]
+
+    elif poll_plugin in ('scottish_stv','irv', 'repeated_irv'):
+
+        def convert(vote_datas):
+            # Malformed previous export data:
+            # vote_data = dumps({'ranking': [proposal_uid_to_pk[x] for x in orig_vote_data['proposals']]})
+            return [",".join(["%d" % uid_to_pk[x] for x in vote_data['proposals']]) for vote_data in vote_datas]
+
     else:
-        add_error(poll, "Must handle vote data for method {poll_plugin}", critical=True, poll_plugin=poll.poll_plugin)
+        add_error(poll, "Must handle vote data for method {poll_plugin}", critical=True, poll_plugin=poll_plugin)
         return
-        #import pdb;pdb.set_trace()
-        #print(vote.get_vote_data())
-        #sys.exit("Must handle vote data")
+    if not hasattr(convert, 'check'):
+        convert.check = lambda: None
+    return convert
+
+
+# Votes are converted this many at a time
+VOTE_BATCH_SIZE = 1000
+
+
+def export_votes(votes, convert, pk, poll_pk, meeting_pk):
+    """
+    Export votes of a poll.
+
+    :param convert: vote data converter from get_vote_converter
+    :param pk: pk of the first vote, the others follow in sequence
+    :return: list of vote records
+    """
+    valid = []
+    for vote in votes:
+        user_pk = get_pk_for_userid(vote.creator[0], ck_meeting_pk=meeting_pk, context=vote)
+        if vote.__name__ not in ctx.userid_to_pk:
+            add_error(vote, "Duplicate vote or deleted user", critical=True)
+            continue
+        valid.append((vote, user_pk))
+    out = []
+    vote_datas = convert([vote.get_vote_data() for (vote, user_pk) in valid])
+    for (vote, user_pk), vote_data in zip(valid, vote_datas):
+        out.append(export_vote(vote, pk, poll_pk, user_pk, vote_data))
+        pk += 1
+    return out
+
+
+def export_vote(vote, pk, poll_pk, user_pk, vote_data):
     return {
         'pk': pk,
         'model': 'poll.vote',
@@ -864,19 +1533,16 @@ def export_vote(vote, pk, poll_pk, user_pk):
     }
 
 
-@debugencode
 def export_proposal(proposal, pk, ai_pk, author_pk=None, meeting_group_pk=None, meeting_pk=None):
     if bool(author_pk) == bool(meeting_group_pk):
         add_error(proposal, "Proposal userid error, either author_pk or meeting_group_pk needed. Author was: {author}",
                   author=proposal.creator[0], critical=True)
         return
-    adjust_object_richtext_tags(proposal)
+    tag_map = adjust_object_richtext_tags(proposal)
     if '\x00' in proposal.text:
         add_error(proposal, "Proposal contains invalid unicode NULL char", critical=True)
-    body = convert_richtext_body(proposal.text)
-    if proposal.diff_text_para is None:
-        body = add_paras(body)
-    prop_ids = ai_prop_ids.setdefault(ai_pk, set())
+    body = convert_richtext_body(proposal.text, tag_map, paras=proposal.diff_text_para is None)
+    prop_ids = ctx.ai_prop_ids.setdefault(ai_pk, set())
     if proposal.aid in prop_ids:
         add_error(proposal, "Duplicate aid / prop_id: {prop_id}", prop_id = proposal.aid, critical=True)
     prop_ids.add(proposal.aid)
@@ -890,7 +1556,7 @@ def export_proposal(proposal, pk, ai_pk, author_pk=None, meeting_group_pk=None,
             'state': proposal.get_workflow_state(),
             'prop_id': proposal.aid,
             'agenda_item': ai_pk,
-            'tags': proposal.tags,
+            'tags': [tag_map.get(x, x) for x in proposal.tags],
             'mentions': [get_pk_for_userid(x, context=proposal, ck_meeting_pk=meeting_pk, msg="Missing user '{userid}' in mentions") for x in IMentioned(proposal).keys()]
         },
     }
@@ -901,29 +1567,25 @@ def export_proposal(proposal, pk, ai_pk, author_pk=None, meeting_group_pk=None,
     return data
 
 
-@debugencode
 def export_diff_proposal(pk, diff_text_para, ai_pk):
-    diff_key = "{}:{}".format(ai_pk, diff_text_para)
     return {
         'pk': pk,
         'model': 'proposal.diffproposal',
         'fields': {
-            'paragraph': diff_text_ai_pk_and_paragraph_to_pk[diff_key],
+            'paragraph': ctx.diff_text_ai_pk_and_paragraph_to_pk[(ai_pk, diff_text_para)],
             # 'proposal_ptr': pk,  #ptr = 'pointer'
         },
     }
 
 
-@debugencode
 def export_discussion_post(discussion_post, pk, ai_pk, author_pk = None, meeting_group_pk = None, meeting_pk = None):
     if bool(author_pk) == bool(meeting_group_pk):
         add_error(discussion_post, "DiscussionPost userid error, either author_pk or meeting_group_pk needed. "
                                    "Author was: {author}", critical=True, author=discussion_post.creator[0])
         #import pdb;pdb.set_trace()
         return
-    adjust_object_richtext_tags(discussion_post)
-    body = convert_richtext_body(discussion_post.text)
-    body = add_paras(body)
+    tag_map = adjust_object_richtext_tags(discussion_post)
+    body = convert_richtext_body(discussion_post.text, tag_map, paras=True)
     data = {
         'pk': pk,
         'model': 'discussion.discussionpost',
@@ -931,7 +1593,7 @@ def export_discussion_post(discussion_post, pk, ai_pk, author_pk = None, meeting
             'modified': django_format_datetime(discussion_post.modified),
             'created': django_format_datetime(discussion_post.created),
             'body': body,
-            'tags': discussion_post.tags,
+            'tags': [tag_map.get(x, x) for x in discussion_post.tags],
             'mentions': [get_pk_for_userid(x, context=discussion_post, ck_meeting_pk=meeting_pk, msg="Missing user '{userid}' in mentions") for x in IMentioned(discussion_post).keys()],
             'agenda_item': ai_pk,
         },
@@ -943,7 +1605,6 @@ def export_discussion_post(discussion_post, pk, ai_pk, author_pk = None, meeting
     return data
 
 
-@debugencode
 def export_text_document(diff_text, pk, ai_pk):
     if len(diff_text.hashtag) > 40:
         #We can't transform these!
@@ -962,7 +1623,6 @@ def export_text_document(diff_text, pk, ai_pk):
     }
 
 
-@debugencode
 def export_text_paragraph(text, pk, ts, paragraph_id, text_document_pk, ai_pk):
     assert isinstance(ts, datetime)
     assert isinstance(paragraph_id, int)
@@ -980,9 +1640,8 @@ def export_text_paragraph(text, pk, ts, paragraph_id, text_document_pk, ai_pk):
     }
 
 
-@debugencode
 def export_pn_system(pk, meeting_pk):
-    pns_pn_check[pk] = set()
+    ctx.pns_pn_check[pk] = set()
     return {
         'pk': pk,
         'model': 'participant_number.pnsystem',
@@ -992,15 +1651,18 @@ def export_pn_system(pk, meeting_pk):
     }
 
 
-@debugencode
-def export_pn(pk, number, user_pk, pns_pk, created_ts):
-    if number in pns_pn_check[pns_pk]:
-        add_error(pk_to_old_pns[pns_pk].context, "Duplicate participant number?", critical=True)
-    pns_pn_check[pns_pk].add(number)
+def check_pn(number, pns_pk):
+    if number in ctx.pns_pn_check[pns_pk]:
+        add_error(ctx.pk_to_old_pns[pns_pk].context, "Duplicate participant number?", critical=True)
+    ctx.pns_pn_check[pns_pk].add(number)
     if number < 1:
-        add_error(pk_to_old_pns[pns_pk].context, "<1 PN", critical=True)
+        add_error(ctx.pk_to_old_pns[pns_pk].context, "<1 PN", critical=True)
     if number > 2**15:
-        add_error(pk_to_old_pns[pns_pk].context, "Over small-int PN", critical=True)
+        add_error(ctx.pk_to_old_pns[pns_pk].context, "Over small-int PN", critical=True)
+
+
+def export_pn(pk, number, user_pk, pns_pk, created_ts):
+    check_pn(number, pns_pk)
     return {
         'pk': pk,
         'model': 'participant_number.participantnumber',
@@ -1013,7 +1675,6 @@ def export_pn(pk, number, user_pk, pns_pk, created_ts):
     }
 
 
-@debugencode
 def export_electoral_register(pk, created_ts, meeting_pk, was_er=True):
     return {
         'pk': pk,
@@ -1026,7 +1687,6 @@ def export_electoral_register(pk, created_ts, meeting_pk, was_er=True):
     }
 
 
-@debugencode
 def export_voter_weight(pk, register_pk, user_pk, weight=1):
     return {
         'pk': pk,
@@ -1039,7 +1699,6 @@ def export_voter_weight(pk, register_pk, user_pk, weight=1):
     }
 
 
-@debugencode
 def export_speaker_list_system(pk, meeting_pk, method_name, settings, safe_positions):
     return {
         'pk': pk,
@@ -1056,7 +1715,6 @@ def export_speaker_list_system(pk, meeting_pk, method_name, settings, safe_posit
     }
 
 
-@debugencode
 def export_speaker(pk, user_pk, speaker_list_pk, created_ts, seconds):
     assert isinstance(seconds, int)
     if seconds > 30000:
@@ -1075,7 +1733,6 @@ def export_speaker(pk, user_pk, speaker_list_pk, created_ts, seconds):
     }
 
 
-@debugencode
 def export_speaker_list(pk, speaker_system_pk, agenda_item_pk, sl_title):
     return {
         'pk': pk,
@@ -1089,7 +1746,12 @@ def export_speaker_list(pk, speaker_system_pk, agenda_item_pk, sl_title):
     }
 
 
-@debugencode
+def check_meeting_role(meeting_pk, user_pk, meeting):
+    if (meeting_pk, user_pk) in ctx.meeting_role_check:
+        add_error(meeting, "Duplicate role assignment for user_pk {user_pk}", user_pk=user_pk, critical=True)
+    ctx.meeting_role_check.add((meeting_pk, user_pk))
+
+
 def export_meeting_roles(pk, entry, meeting_pk, meeting):
     # No duplicates
     try:
@@ -1102,9 +1764,7 @@ def export_meeting_roles(pk, entry, meeting_pk, meeting):
     else:
         # Don't export empty assigned. This will cause admins to be blanked, but no problem they can gain access again
         return
-    if (meeting_pk, user_pk) in meeting_role_check:
-        add_error(meeting, "Duplicate role assignment for user_pk {user_pk}", user_pk=user_pk, critical=True)
-    meeting_role_check.add((meeting_pk, user_pk))
+    check_meeting_role(meeting_pk, user_pk, meeting)
     return {
         'pk': pk,
         'model': 'meeting.meetingroles',
@@ -1117,7 +1777,6 @@ def export_meeting_roles(pk, entry, meeting_pk, meeting):
 
 
 
-@debugencode
 def export_reaction_button(pk, meeting, meeting_pk, title="Gilla", icon='mdi-thumb-up', color='primary'):
     """
     The v4 object that holds the information for reactions. We'll mostly create "like"-buttons
@@ -1144,15 +1803,14 @@ def export_reaction_button(pk, meeting, meeting_pk, title="Gilla", icon='mdi-thu
     }
 
 
-@debugencode
-def export_reaction(pk, context, object_id, button_pk, ai_pk, userid, meeting_pk = None):
+def export_reaction(pk, context, object_id, button_pk, ai_pk, user_pk):
     """
     :param pk: reactions pk
     :param context: what's reacted on
     :param object_id: The proposal or discussion post pk
     :param button_pk:
     :param ai_pk:
-    :param userid:
+    :param user_pk: from MeetingLikes
     :return: maybe return data if there are reactions
 
     A specific users click on a like-button or similar
@@ -1171,12 +1829,31 @@ def export_reaction(pk, context, object_id, button_pk, ai_pk, userid, meeting_pk
             "content_type":content_type,
             'object_id': object_id,
             'button': button_pk,
-            'user': get_pk_for_userid(userid, ck_meeting_pk=meeting_pk, context=context),
+            'user': user_pk,
             'agenda_item': ai_pk,
         },
     }
 
 
+def adjust_meeting_dialect(meeting, meeting_out):
+    """ Meeting settings depending on which plugins were used. Must be done before the meeting is written. """
+    if MV_MEETING_NAMESPACE in meeting:
+        meeting_out['fields']['er_policy_name'] = 'group_auto_eq_rnd_bf'
+        meeting_out['fields']['group_votes_active'] = True
+        meeting_out['fields']['installed_dialect'] = 'groupvotes'
+    if hasattr(meeting, VOTE_GROUPS_NAMESPACE):
+        meeting_out['fields']['er_policy_name'] = 'main_subst_active'
+        meeting_out['fields']['installed_dialect'] = 'ordinarie_och_ersattare'
+        meeting_out['fields']['group_roles_active'] = True
+        meeting_out['fields']['group_votes_active'] = True
+    if hasattr(meeting, SFS_DELEGATIONS_NAMESPACE):
+        import sfs_ga  # This is just a guard to avoid broken objects!
+        meeting_out['fields']['er_policy_name'] = 'gv_auto_before_p'
+        meeting_out['fields']['installed_dialect'] = 'sfsfum'
+        meeting_out['fields']['group_roles_active'] = True
+        meeting_out['fields']['group_votes_active'] = True
+
+
 def django_format_datetime(dt, force=False):
     if force and not isinstance(dt, datetime):
         raise ValueError("%s is not a datetime instance" % dt)
@@ -1185,584 +1862,2115 @@ def django_format_datetime(dt, force=False):
 
 
 class ERHandler:
+    """
+    Reuses electoral registers with the same voters and weights.
+
+    Registers are found by a digest of the voter weights that doesn't depend on order. Only the pk of each
+    register is kept with a function that rebuilds its voters, see get_userids_roll and get_poll_roll. When
+    digests match the voters are compared as sorted arrays, so reuse is exact. Those arrays are only built
+    on a match and kept for the registers that matched.
+    """
 
     def __init__(self):
-        self.cmp_vw_to_er = {}
+        # digest -> list of [er pk, function that returns (user pk, weight) pairs, compact form once needed]
+        self.digest_to_ers = {}
 
-    def track_original_er(self, er_data, vw_data):
-        key = self.get_cmp_key(vw_data)
-        if key not in self.cmp_vw_to_er:
+    def track_original_er(self, er_data, vw_data, get_roll):
+        digest = self.get_digest(vw_data)
+        if self.find_er_pk(digest, vw_data) is None:
             # Only save first key, they may be identical when using v3 ERs
-            self.cmp_vw_to_er[key] = er_data['pk']
+            self.digest_to_ers.setdefault(digest, []).append([er_data['pk'], get_roll, None])
 
-    def create_or_reuse(self, poll_data, er_data, vw_data, out_data):
+    def create_or_reuse(self, poll_data, er_data, vw_data, out_data, get_roll):
         """
         :param poll_data: dict
         :param er_data: dict
         :param vw_data: list[dict]
         :param out_data: list[dict]
+        :param get_roll: function that returns the (user pk, weight) pairs of vw_data again
         :return: bool
         """
-        key = self.get_cmp_key(vw_data)
+        digest = self.get_digest(vw_data)
         # Reuse data
-        reused_pk = self.cmp_vw_to_er.get(key)
+        reused_pk = self.find_er_pk(digest, vw_data)
         if reused_pk:
             poll_data['fields']['electoral_register'] = reused_pk
             return False
         # Append new ER to data instead, we can't reuse
-        self.cmp_vw_to_er[key] = er_data['pk']
+        self.digest_to_ers.setdefault(digest, []).append([er_data['pk'], get_roll, None])
         poll_data['fields']['electoral_register'] = er_data['pk']
         out_data.append(er_data)
         out_data.extend(vw_data)
         return True
 
-    def get_cmp_key(self, vw_data):
-        return tuple(sorted(
-            [(x['fields']['user'], x['fields']['weight']) for x in vw_data]
-        ))
+    def get_digest(self, vw_data):
+        """ Number of voters, sum and xor of each (user, weight) hash. """
+        total = 0
+        xor = 0
+        for x in vw_data:
+            h = hash((x['fields']['user'], x['fields']['weight']))
+            total = (total + h) & 0xFFFFFFFFFFFFFFFF
+            xor ^= h
+        return (len(vw_data), total, xor)
+
+    def get_compact(self, roll):
+        """ :return: (users, weights) of (user pk, weight) pairs as arrays sorted by user """
+        # Missing users are None, no user has pk 0
+        pairs = sorted([(user or 0, weight) for (user, weight) in roll])
+        return array(str('l'), [x[0] for x in pairs]), array(str('l'), [x[1] for x in pairs])
+
+    def find_er_pk(self, digest, vw_data):
+        entries = self.digest_to_ers.get(digest)
+        if not entries:
+            return
+        compact = self.get_compact([(x['fields']['user'], x['fields']['weight']) for x in vw_data])
+        for entry in entries:
+            if entry[2] is None:
+                entry[2] = self.get_compact(entry[1]())
+                entry[1] = None
+            if entry[2] == compact:
+                return entry[0]
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("config_uri", help="Paster ini file to load settings from")
-    args = parser.parse_args()
-    env = bootstrap(args.config_uri)
-    root = env['root']
-    request = env['request']
-    users = root['users']
-    print("Exporting %s" % root.title)
 
-    data = []
-    data.append(export_root(root))
-    maybe_export_users = {}  # Userid to export
+def get_userids_roll(userids):
+    """ :return: function for ERHandler that rebuilds a register where each of userids has weight 1 """
+    return lambda: [(ctx.userid_to_pk.get(x), 1) for x in userids]
 
-    print("Exporting %s users" % len(users))
-    # Export users and map userids
-    user_pk = 1
-    for user in users.values():
-        userid_to_pk[user.userid] = user_pk
-        user_pk_to_fullname[user_pk] = user.title
-        maybe_export_users[user.userid] = export_user(user, user_pk)
-        user_pk += 1
 
-    # Walk meetings and export contents
-    ai_pk = 1
-    meeting_group_pk = 1
-    group_role_pk = 1
-    group_membership_pk = 1
-    poll_pk = 1
-    vote_pk = 1
-    proposal_pk = 1
-    discussion_post_pk = 1
-    text_document_pk = 1
-    text_paragraph_pk = 1
-    pn_system_pk = 1
-    pn_pk = 1
-    electoral_register_pk = 1
-    voter_weight_pk = 1
-    speaker_system_pk = 1
-    speaker_list_pk = 1
-    speaker_pk = 1
-    meeting_roles_pk = 1
-    reaction_button_pk = 1
-    reaction_pk = 1
+def get_poll_roll(poll):
+    """ :return: function for ERHandler that rebuilds the register of a closed poll from its votes """
+    return lambda: [(ctx.userid_to_pk.get(k), v) for (k, v) in get_poll_voter_weights(poll, poll.values())[1].items()]
 
-    meetings = [x for x in root.values() if x.type_name == 'Meeting']
-    print("Exporting %s meetings" % len(meetings))
-    for meeting_pk, meeting in enumerate(meetings, start=1):
-        # Limit to a few meetings?
-        if ONLY_MEETING_NAMES:
-            if meeting.__name__ not in ONLY_MEETING_NAMES:
-                print("SKIPPING: %s" % meeting.__name__)
-                continue
+
+def get_poll_voter_weights(poll, votes):
+    """
+    Voters of a closed poll with their weights. VoteIT3 clones votes of users with more than one vote. If there
+    are no clones, users who could vote when the poll closed are voters too.
+
+    :return: (votes that aren't clones, userid -> weight, votes without a creator)
+    """
+    non_cloned_votes = []
+    clone_weight = Counter()
+    no_creator = []
+    for vote in votes:
+        if vote.__name__ == vote.creator[0]:
+            non_cloned_votes.append(vote)
+        elif vote.creator[0]:
+            clone_weight[vote.creator[0]] += 1
         else:
-            print("Exporting: %s" % meeting.__name__)
-
-        # In case we need to adjust data
-        meeting_out = export_meeting(meeting, meeting_pk)
-        data.append(meeting_out)
-        meeting_name_to_pk[meeting.__name__] = meeting_pk
-        # Meeting groups are meeting local objects within VoteIT4
-        # System users are global within VoteIT3, so if we convert sys users -> meeting group
-        # we need to create several of them and replace them differently within meetings.
-        userid_to_meeting_group_pk = {}
-        for userid in meeting.system_userids:
-            userid_to_meeting_group_pk[userid] = meeting_group_pk
-            needed_userids.add(userid)
-            sys_user = users[userid]
-            data.append(
-                export_meeting_group_system_user_like(sys_user, meeting_group_pk, meeting_pk, meeting)
-            )
-            # End meeting group loop
-            meeting_group_pk += 1
-
-        if meeting.system_userids:
-            print(meeting.__name__ + ' has system users that will be groups: ' + ", ".join(meeting.system_userids))
-
-        # keep track of users in meeting
-        meeting_to_user_pks[meeting_pk] = set()
-
-        # Export meeting roles
-        maybe_new_er_userids = set()  # In case there's no ER, create one with these
-        for entry in meeting.get_security():
-            if entry['userid'].lower() != entry['userid']:
-                add_error(meeting, 'UserID with uppercase in get_security(): {userid}', userid=entry['userid'])
-            if not entry['userid']:
-                add_error(meeting, 'Empty userid in get_security()')
+            no_creator.append(vote)
+    er_userids = set([x.__name__ for x in non_cloned_votes])
+    if clone_weight:
+        # We have to settle with the votes we've got
+        return non_cloned_votes, dict((x, 1 + clone_weight[x]) for x in er_userids), no_creator
+    # We can create an ER from the users who had voting permission when the poll closed +
+    # any others that may have added a vote
+    if poll.voters_mark_closed:
+        er_userids.update(poll.voters_mark_closed)
+    return non_cloned_votes, dict.fromkeys(er_userids, 1), no_creator
+
+
+# Fields of VoteIT4 models as type, max length after a colon and ? if it may be null.
+# Records are checked against these as they're encoded. Fields that aren't listed aren't checked.
+RECORD_SCHEMAS = {
+    'agenda.agendaitem': {
+        'title': 'str:100', 'body': 'str?', 'state': 'str', 'created': 'dt?', 'modified': 'dt?', 'tags': 'tags',
+        'meeting': 'pk', 'block_discussion': 'bool', 'block_proposals': 'bool', 'order': 'int',
+    },
+    'core.user': {
+        'first_name': 'str', 'last_name': 'str', 'email': 'str', 'userid': 'str', 'username': 'str',
+        'date_joined': 'dt?', 'last_login': 'dt?', 'organisation': 'pk',
+    },
+    'discussion.discussionpost': {
+        'body': 'str', 'created': 'dt?', 'modified': 'dt?', 'tags': 'tags', 'mentions': 'pks',
+        'agenda_item': 'pk', 'author': 'pk', 'meeting_group': 'pk',
+    },
+    'meeting.grouprole': {'title': 'str:100', 'role_id': 'str:100', 'meeting': 'pk', 'roles': 'strs?'},
+    'meeting.groupmembership': {'user': 'pk', 'meeting_group': 'pk', 'role': 'pk?', 'votes': 'int?'},
+    'meeting.meeting': {
+        'title': 'str:100', 'body': 'str?', 'state': 'str', 'created': 'dt?', 'modified': 'dt?',
+        'start_time': 'dt?', 'end_time': 'dt?', 'er_policy_name': 'str?', 'organisation': 'pk',
+        'installed_dialect': 'str', 'group_votes_active': 'bool', 'group_roles_active': 'bool',
+    },
+    'meeting.meetinggroup': {
+        'title': 'str:100', 'body': 'str?', 'groupid': 'str', 'created': 'dt?', 'modified': 'dt?',
+        'meeting': 'pk', 'votes': 'int?', 'members': 'pks',
+    },
+    'meeting.meetingroles': {'context': 'pk', 'user': 'pk', 'assigned': 'strs'},
+    'organisation.organisation': {'title': 'str', 'body': 'str?', 'created': 'dt?', 'modified': 'dt?'},
+    'participant_number.participantnumber': {'number': 'int', 'user': 'pk', 'pns': 'pk', 'created': 'dt'},
+    'participant_number.pnsystem': {'meeting': 'pk'},
+    'poll.electoralregister': {'created': 'dt', 'meeting': 'pk', 'source': 'str'},
+    'poll.poll': {
+        'title': 'str:70', 'body': 'str?', 'state': 'str', 'created': 'dt?', 'modified': 'dt?', 'started': 'dt?',
+        'closed': 'dt?', 'meeting': 'pk', 'agenda_item': 'pk', 'method_name': 'str', 'proposals': 'pks',
+        'electoral_register': 'pk?', 'abstains': 'int',
+    },
+    'poll.vote': {'user': 'pk', 'poll': 'pk', 'created': 'dt', 'changed': 'dt', 'vote_data': 'str'},
+    'poll.voterweight': {'register': 'pk', 'user': 'pk', 'weight': 'int'},
+    'proposal.diffproposal': {'paragraph': 'pk'},
+    'proposal.proposal': {
+        'body': 'str', 'state': 'str', 'prop_id': 'str', 'created': 'dt?', 'modified': 'dt?', 'tags': 'tags',
+        'mentions': 'pks', 'agenda_item': 'pk', 'author': 'pk', 'meeting_group': 'pk',
+    },
+    'proposal.textdocument': {
+        'title': 'str:100', 'body': 'str', 'base_tag': 'str:40', 'created': 'dt?', 'modified': 'dt?',
+        'agenda_item': 'pk',
+    },
+    'proposal.textparagraph': {
+        'body': 'str', 'paragraph_id': 'int', 'created': 'dt?', 'modified': 'dt?', 'text_document': 'pk',
+        'agenda_item': 'pk',
+    },
+    'reactions.reaction': {
+        'content_type': 'strs', 'object_id': 'pk', 'button': 'pk', 'user': 'pk', 'agenda_item': 'pk',
+    },
+    'reactions.reactionbutton': {
+        'title': 'str', 'icon': 'str', 'color': 'str', 'meeting': 'pk', 'active': 'bool',
+        'change_roles': 'strs', 'list_roles': 'strs', 'allowed_models': 'strs',
+    },
+    'speaker.speaker': {'user': 'pk', 'speaker_list': 'pk', 'created': 'dt', 'started': 'dt', 'seconds': 'int'},
+    'speaker.speakerlist': {'title': 'str:200', 'state': 'str', 'speaker_system': 'pk', 'agenda_item': 'pk'},
+    'speaker.speakerlistsystem': {'state': 'str', 'meeting': 'pk', 'method_name': 'str', 'safe_positions': 'int'},
+}
+# Max length of each tag
+TAG_MAX_LENGTH = 50
+# type in schema -> (types of value, types of items for lists, max length of items)
+SCHEMA_TYPES = {
+    'str': (string_types, None, None),
+    'dt': (string_types, None, None),
+    'int': (integer_types, None, None),
+    'pk': (integer_types, None, None),
+    'bool': (bool, None, None),
+    'pks': ((list, tuple), integer_types, None),
+    'strs': ((list, tuple), string_types, None),
+    'tags': ((list, tuple), string_types, TAG_MAX_LENGTH),
+}
+
+
+def compile_schemas(schemas):
+    """
+    :return: dict model -> list of (field, types, nullable, max length, item types, item max length)
+    """
+    compiled = {}
+    for (model, fields) in schemas.items():
+        checks = compiled[model] = []
+        for (name, spec) in sorted(fields.items()):
+            nullable = spec.endswith('?')
+            spec = spec.rstrip('?')
+            max_length = None
+            if ':' in spec:
+                spec, max_length = spec.split(':')
+                max_length = int(max_length)
+            types, item_types, item_max_length = SCHEMA_TYPES[spec]
+            checks.append((name, types, nullable, max_length, item_types, item_max_length))
+    return compiled
+
+
+COMPILED_SCHEMAS = compile_schemas(RECORD_SCHEMAS)
+# Model that each pk field of RECORD_SCHEMAS refers to, None for generic relations
+REFERENCE_FIELDS = {
+    'agenda_item': 'agenda.agendaitem',
+    'author': 'core.user',
+    'button': 'reactions.reactionbutton',
+    'context': 'meeting.meeting',
+    'electoral_register': 'poll.electoralregister',
+    'meeting': 'meeting.meeting',
+    'meeting_group': 'meeting.meetinggroup',
+    'members': 'core.user',
+    'mentions': 'core.user',
+    'object_id': None,
+    'organisation': 'organisation.organisation',
+    'paragraph': 'proposal.textparagraph',
+    'pns': 'participant_number.pnsystem',
+    'poll': 'poll.poll',
+    'proposals': 'proposal.proposal',
+    'register': 'poll.electoralregister',
+    'role': 'meeting.grouprole',
+    'speaker_list': 'speaker.speakerlist',
+    'speaker_system': 'speaker.speakerlistsystem',
+    'text_document': 'proposal.textdocument',
+    'user': 'core.user',
+}
+# Models that have the pk of the model they inherit
+PARENT_MODELS = {
+    'proposal.diffproposal': 'proposal.proposal',
+}
+
+
+def get_references(model):
+    """ Models that records of model refer to. """
+    found = set()
+    for (name, spec) in RECORD_SCHEMAS.get(model, {}).items():
+        if spec.rstrip('?') in ('pk', 'pks') and REFERENCE_FIELDS[name]:
+            found.add(REFERENCE_FIELDS[name])
+    if model in PARENT_MODELS:
+        found.add(PARENT_MODELS[model])
+    found.discard(model)
+    return found
+
+
+def order_by_references(models):
+    """
+    Models in an order where each one comes after the models it refers to, so they can be imported one
+    at a time. Otherwise they're kept in the order given.
+    """
+    left = list(OrderedDict.fromkeys(models))
+    present = set(left)
+    ordered = []
+    while left:
+        for model in left:
+            if not (get_references(model) & present) - set(ordered):
+                ordered.append(model)
+                left.remove(model)
+                break
+        else:
+            raise ValueError("Models refer to each other: %s" % ", ".join(left))
+    return ordered
+
+
+def validate_record(record, encoded=None):
+    """
+    Check a record against RECORD_SCHEMAS.
+
+    :param encoded: the record as json, if it's encoded already. Searching it for NUL chars is
+        quicker than going through the fields.
+    :return: list of problems, empty when the record is fine
+    """
+    if not isinstance(record, dict) or len(record) != 3 or 'pk' not in record or 'fields' not in record:
+        return ["Wrong keys in record"]
+    checks = COMPILED_SCHEMAS.get(record.get('model'))
+    if checks is None:
+        return ["No schema for model"]
+    fields = record['fields']
+    problems = []
+    for (name, types, nullable, max_length, item_types, item_max_length) in checks:
+        if name not in fields:
+            continue
+        value = fields[name]
+        if value is None:
+            if not nullable:
+                problems.append("%s is null" % name)
+            continue
+        if not isinstance(value, types):
+            problems.append("%s is %s" % (name, type(value).__name__))
+            continue
+        if max_length is not None and len(value) > max_length:
+            problems.append("%s longer than %s chars" % (name, max_length))
+        if item_types is not None:
+            for item in value:
+                if not isinstance(item, item_types):
+                    problems.append("%s has %s" % (name, type(item).__name__))
+                elif item_max_length is not None and len(item) > item_max_length:
+                    problems.append("%s has an item longer than %s chars: %s" % (name, item_max_length, item))
+    if encoded is None:
+        encoded = dumps(record)
+    # As json NUL is always escaped. Only look closer if there's a chance.
+    if '\\u0000' in encoded and has_null_char(fields):
+        problems.append("NUL char in text")
+    return problems
+
+
+def has_null_char(value):
+    if isinstance(value, string_types):
+        return '\x00' in value
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return any(has_null_char(x) for x in value)
+    return False
+
+
+def check_record(record, encoded=None):
+    """ Report problems from validate_record as critical errors. """
+    for problem in validate_record(record, encoded):
+        path = "%s pk %s" % (record.get('model'), record.get('pk'))
+        add_error(path, "Invalid record: {problem}", critical=True, problem=problem)
+
+
+def encode_record(record):
+    """
+    As json bytes. Checked with validate_record unless VALIDATE_RECORDS is off, problems are critical errors.
+    """
+    out = dumps(record)
+    if VALIDATE_RECORDS and record is not None:
+        check_record(record, out)
+    if isinstance(out, text_type):
+        out = out.encode('utf-8')
+    return out
+
+
+class RecordSpool:
+    """
+    Serialized records in a temporary file, one per line. Only the models of the records are kept in
+    memory, as runs of [model, number of records], so it's safe to use for things like all reactions or
+    all users of a site. Writers use the models to tell records apart without decoding them.
+
+    :param models: runs of models for the records already in stream, if any
+    """
+
+    def __init__(self, dir=None, stream=None, models=None):
+        if stream is None:
+            stream = TemporaryFile(dir=dir)
+        self.stream = stream
+        self.count = 0
+        self.models = models or []
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """ Yields encoded records. """
+        self.stream.flush()
+        self.stream.seek(0)
+        for line in self.stream:
+            yield line[:-1]
+        self.stream.seek(0, os.SEEK_END)
+
+    def iter_models(self):
+        """ Model of each record, in the same order as the records. """
+        return chain.from_iterable(repeat(model, count) for (model, count) in self.models)
+
+    def add_model(self, model, count=1):
+        if self.models and self.models[-1][0] == model:
+            self.models[-1][1] += count
+        else:
+            self.models.append([model, count])
+
+    def append(self, record):
+        self.append_encoded(encode_record(record))
+        # Failed exports can add None, those are never written anyway
+        self.add_model(record is not None and record['model'] or None)
+
+    def append_encoded(self, line):
+        """ Doesn't keep track of the model, see add_model """
+        self.stream.write(line + b"\n")
+        self.count += 1
+
+    def extend(self, records):
+        if isinstance(records, RecordSpool):
+            for line in records:
+                self.append_encoded(line)
+            for (model, count) in records.models:
+                self.add_model(model, count)
+        else:
+            lines = []
+            for record in records:
+                lines.append(encode_record(record) + b"\n")
+                self.add_model(record is not None and record['model'] or None)
+            self.stream.write(b"".join(lines))
+            self.count += len(lines)
+
+    def close(self):
+        self.stream.close()
+
+
+class ExportWriter:
+    """
+    Streams the export to disk as records are created.
+
+    Users are kept in their own spool and written as a leading section when the export is finished,
+    since we won't know which users are needed until all meetings have been walked.
+    The output is the same JSON array a plain json.dump of all records would produce.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        out_dir = os.path.dirname(os.path.abspath(filename))
+        self.users = RecordSpool(out_dir)
+        self.user_pks = array(str('l'))
+        self.content = RecordSpool(out_dir)
+
+    def add_user(self, record):
+        self.users.append(record)
+        self.user_pks.append(record['pk'])
+
+    def append(self, record):
+        self.content.append(record)
+
+    def extend(self, records):
+        self.content.extend(records)
+
+    def iter_lines(self, needed_user_pks):
+        """
+        Encoded records in export order. Users that aren't needed are counted in self.skipped.
+
+        :param needed_user_pks: set of user pks to include
+        """
+        for (model, line) in self.iter_records(needed_user_pks):
+            yield line
+
+    def iter_records(self, needed_user_pks):
+        """ Like iter_lines, but yields (model, encoded record) """
+        self.skipped = 0
+        for i, line in enumerate(self.users):
+            if self.user_pks[i] not in needed_user_pks:
+                self.skipped += 1
                 continue
-            out = export_meeting_roles(meeting_roles_pk, entry, meeting_pk, meeting)
-            if out:
-                data.append(out)
-                if ROLE_VOTER in entry['groups']:
-                    maybe_new_er_userids.add(entry['userid'])
-                meeting_to_user_pks[meeting_pk].add(get_pk_for_userid(entry['userid'], context=meeting))
-                # End roles loop
-                meeting_roles_pk += 1
+            yield 'core.user', line
+        models = self.content.iter_models()
+        for line in self.content:
+            yield next(models), line
+
+    def write(self, needed_user_pks):
+        """
+        :param needed_user_pks: set of user pks to include
+        :return: number of skipped users
+        """
+        with open(self.filename, 'wb') as stream:
+            stream.write(b'[')
+            sep = b''
+            for line in self.iter_lines(needed_user_pks):
+                stream.write(sep + line)
+                sep = b', '
+            stream.write(b']')
+        return self.skipped
+
+    def close(self):
+        self.users.close()
+        self.content.close()
+
+
+class ChunkedExportWriter(ExportWriter):
+    """
+    Writes the export to a directory as gzipped chunks, each with at most chunk_size records of one model.
+    Every chunk is a JSON array like the full export, so chunks can be loaded on their own and in parallel.
+
+    The manifest lists models in the order to import them in, with record counts and the chunks of each
+    model. Models come after the models they refer to, see order_by_references, and otherwise in the
+    order they first appear in the export.
+    """
+    manifest_name = 'manifest.json'
+    extension = '.json.gz'
+
+    def __init__(self, directory, chunk_size=100000):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.chunk_size = chunk_size
+        ExportWriter.__init__(self, os.path.join(directory, self.manifest_name))
+
+    def iter_rows(self, needed_user_pks):
+        """
+        :return: iterator of (key, encoded row). Rows with the same key go to the same series of chunks.
+        """
+        return self.iter_records(needed_user_pks)
+
+    def describe(self, key, prefixes):
+        """
+        Manifest entry for a series of chunks, with the file name prefix to use for them.
+
+        :param prefixes: file name prefixes already in use
+        """
+        return {'model': key, 'prefix': key}
+
+    def open_chunk(self, filename):
+        stream = gzip.open(filename, 'wb')
+        stream.write(b'[')
+        return {'stream': stream, 'sep': b''}
+
+    def write_row(self, chunk, row):
+        chunk['stream'].write(chunk['sep'] + row)
+        chunk['sep'] = b', '
+
+    def close_chunk(self, chunk):
+        chunk['stream'].write(b']')
+        chunk['stream'].close()
+
+    def write(self, needed_user_pks):
+        series = OrderedDict()
+        prefixes = set()
+        open_chunks = {}
+        for key, row in self.iter_rows(needed_user_pks):
+            if key not in series:
+                entry = series[key] = self.describe(key, prefixes)
+                entry.update(count=0, chunks=[])
+                prefixes.add(entry['prefix'])
+            entry = series[key]
+            if key not in open_chunks:
+                name = "%s.%04d%s" % (entry['prefix'], len(entry['chunks']) + 1, self.extension)
+                open_chunks[key] = self.open_chunk(os.path.join(self.directory, name))
+                entry['chunks'].append({'file': name, 'count': 0})
+            self.write_row(open_chunks[key], row)
+            entry['count'] += 1
+            entry['chunks'][-1]['count'] += 1
+            if entry['chunks'][-1]['count'] >= self.chunk_size:
+                self.close_chunk(open_chunks.pop(key))
+        for chunk in open_chunks.values():
+            self.close_chunk(chunk)
+        order = dict((model, i) for (i, model) in enumerate(order_by_references(x['model'] for x in series.values())))
+        entries = sorted(series.values(), key=lambda x: order[x['model']])
+        for entry in entries:
+            del entry['prefix']
+        with open(self.filename, 'w') as stream:
+            dump({'chunk_size': self.chunk_size, 'models': entries}, stream, indent=2)
+        return self.skipped
+
+
+# For the CSV output. Foreign keys are named like Django names their columns,
+# many to many fields go to the auto created through tables and are keyed on the model they point to.
+CSV_FOREIGN_KEYS = frozenset([
+    'agenda_item',
+    'author',
+    'button',
+    'context',
+    'electoral_register',
+    'meeting',
+    'meeting_group',
+    'organisation',
+    'paragraph',
+    'pns',
+    'poll',
+    'register',
+    'role',
+    'speaker_list',
+    'speaker_system',
+    'text_document',
+    'user',
+])
+CSV_MANY_TO_MANY = {
+    'members': 'user',
+    'mentions': 'user',
+    'proposals': 'proposal',
+}
+# PostgreSQL arrays, other lists and dicts are JSON
+CSV_ARRAY_FIELDS = frozenset([
+    'allowed_models',
+    'assigned',
+    'change_roles',
+    'list_roles',
+    'roles',
+    'tags',
+])
+# Stored as app_label.model, the id of the content type has to be looked up when importing
+CSV_NATURAL_KEYS = frozenset(['content_type'])
+# Models that inherit another model have the parent pointer as primary key
+CSV_PK_COLUMNS = {
+    'proposal.diffproposal': 'proposal_ptr_id',
+}
+
+
+def csv_value(value):
+    """ Format a decoded JSON value for PostgreSQL COPY with FORMAT csv. An unquoted empty value is NULL. """
+    if value is None:
+        return ''
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, integer_types + (float,)):
+        return repr(value).rstrip('L')
+    if not isinstance(value, string_types):
+        value = dumps(value)
+    return '"%s"' % value.replace('"', '""')
+
+
+def csv_array(values):
+    """ PostgreSQL array literal """
+    items = []
+    for value in values:
+        if isinstance(value, string_types):
+            value = '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+        else:
+            value = csv_value(value)
+        items.append(value)
+    return '{%s}' % ','.join(items)
+
+
+def csv_row(values):
+    return (','.join(values) + '\n').encode('utf-8')
+
+
+class CSVExportWriter(ChunkedExportWriter):
+    """
+    Writes one gzipped CSV series per table instead, to be loaded with PostgreSQL COPY rather than the
+    Django fixture loader. Field mapping is still done by the export_* functions, records are only flattened here.
+
+    Rows of a model that don't have the same fields get a series of their own, so no value is made up.
+    The manifest has the table and columns of each series, for a statement like:
+        COPY poll_vote (id, changed, created, poll_id, user_id, vote_data) FROM STDIN WITH (FORMAT csv)
+    Load everything in one transaction, Django foreign keys are deferred until commit.
+    """
+    extension = '.csv.gz'
+
+    def iter_rows(self, needed_user_pks):
+        for line in self.iter_lines(needed_user_pks):
+            record = loads(line)
+            model = record['model']
+            fields = record['fields']
+            names = tuple(sorted(x for x in fields if x not in CSV_MANY_TO_MANY))
+            row = [csv_value(record['pk'])]
+            for name in names:
+                value = fields[name]
+                if name in CSV_ARRAY_FIELDS and value is not None:
+                    row.append(csv_value(csv_array(value)))
+                elif name in CSV_NATURAL_KEYS and value is not None:
+                    row.append(csv_value('.'.join(value)))
+                else:
+                    row.append(csv_value(value))
+            yield (model, names), csv_row(row)
+            for name in sorted(fields):
+                if name in CSV_MANY_TO_MANY:
+                    for pk in fields[name] or ():
+                        yield (model, name), csv_row([csv_value(record['pk']), csv_value(pk)])
+
+    def describe(self, key, prefixes):
+        model, names = key
+        table = model.replace('.', '_')
+        if isinstance(names, string_types):
+            # Through table of a many to many field
+            table = "%s_%s" % (table, names)
+            columns = ["%s_id" % model.split('.')[1], "%s_id" % CSV_MANY_TO_MANY[names]]
+        else:
+            columns = [CSV_PK_COLUMNS.get(model, 'id')]
+            columns.extend(name in CSV_FOREIGN_KEYS and "%s_id" % name or name for name in names)
+        prefix = table
+        variant = 1
+        while prefix in prefixes:
+            variant += 1
+            prefix = "%s-%s" % (table, variant)
+        return {'model': model, 'table': table, 'columns': columns, 'prefix': prefix}
+
+    def open_chunk(self, filename):
+        return {'stream': gzip.open(filename, 'wb')}
+
+    def write_row(self, chunk, row):
+        chunk['stream'].write(row)
+
+    def close_chunk(self, chunk):
+        chunk['stream'].close()
+
+
+class NullWriter:
+    """ Discards records. Used when we only check data. """
+
+    def append(self, record):
+        pass
+
+    def extend(self, records):
+        pass
+
+    def add_user(self, record):
+        pass
+
+    def close(self):
+        pass
+
+
+class PKCounters:
+    """ The next pk to use for each kind of object that's exported within meetings. """
+    names = (
+        'ai_pk',
+        'meeting_group_pk',
+        'group_role_pk',
+        'group_membership_pk',
+        'poll_pk',
+        'vote_pk',
+        'proposal_pk',
+        'discussion_post_pk',
+        'text_document_pk',
+        'text_paragraph_pk',
+        'pn_system_pk',
+        'pn_pk',
+        'electoral_register_pk',
+        'voter_weight_pk',
+        'speaker_system_pk',
+        'speaker_list_pk',
+        'speaker_pk',
+        'meeting_roles_pk',
+        'reaction_button_pk',
+        'reaction_pk',
+    )
+
+    def __init__(self, **kwargs):
+        for name in self.names:
+            setattr(self, name, kwargs.get(name, 1))
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.names)
+
+    def total(self):
+        """ Sum of all pks, grows by one for each object exported. """
+        return sum(getattr(self, name) for name in self.names)
+
+    def advance(self, start, end):
+        """ Move forward as many pks as were used between start and end (dicts). """
+        for name in self.names:
+            setattr(self, name, getattr(self, name) + end[name] - start[name])
+
+
+# Fields of records within meetings that refer to other objects within the meeting, as
+# model -> (pks counter of the record itself, {field: pks counter}). Used to move the pks of a meeting
+# that was exported with pks of its own, see iter_meeting_parts_parallel. Proposal pks are never moved,
+# since they're also found within vote and result data.
+MEETING_PK_FIELDS = {
+    'meeting.meeting': (None, {}),
+    'meeting.meetinggroup': ('meeting_group_pk', {}),
+    'meeting.grouprole': ('group_role_pk', {}),
+    'meeting.groupmembership': ('group_membership_pk', {'meeting_group': 'meeting_group_pk', 'role': 'group_role_pk'}),
+    'meeting.meetingroles': ('meeting_roles_pk', {}),
+    'agenda.agendaitem': ('ai_pk', {'order': 'ai_pk'}),
+    'proposal.proposal': (None, {'agenda_item': 'ai_pk', 'meeting_group': 'meeting_group_pk'}),
+    'proposal.diffproposal': (None, {'paragraph': 'text_paragraph_pk'}),
+    'proposal.textdocument': ('text_document_pk', {'agenda_item': 'ai_pk'}),
+    'proposal.textparagraph': ('text_paragraph_pk', {'text_document': 'text_document_pk', 'agenda_item': 'ai_pk'}),
+    'discussion.discussionpost': ('discussion_post_pk', {'agenda_item': 'ai_pk', 'meeting_group': 'meeting_group_pk'}),
+    'poll.poll': ('poll_pk', {'agenda_item': 'ai_pk', 'electoral_register': 'electoral_register_pk'}),
+    'poll.vote': ('vote_pk', {'poll': 'poll_pk'}),
+    'poll.electoralregister': ('electoral_register_pk', {}),
+    'poll.voterweight': ('voter_weight_pk', {'register': 'electoral_register_pk'}),
+    'participant_number.pnsystem': ('pn_system_pk', {}),
+    'participant_number.participantnumber': ('pn_pk', {'pns': 'pn_system_pk'}),
+    'speaker.speakerlistsystem': ('speaker_system_pk', {}),
+    'speaker.speakerlist': ('speaker_list_pk', {'speaker_system': 'speaker_system_pk', 'agenda_item': 'ai_pk'}),
+    'speaker.speaker': ('speaker_pk', {'speaker_list': 'speaker_list_pk'}),
+    'reactions.reactionbutton': ('reaction_button_pk', {}),
+    'reactions.reaction': ('reaction_pk', {'button': 'reaction_button_pk', 'agenda_item': 'ai_pk'}),
+}
+
+
+def move_record_pks(record, offsets):
+    """
+    Add offsets to the pks of a record and the fields that refer to other objects within the meeting.
+
+    :param offsets: dict with pks counter name -> number to add
+    """
+    pk_name, field_names = MEETING_PK_FIELDS[record['model']]
+    if pk_name:
+        record['pk'] += offsets[pk_name]
+    fields = record['fields']
+    for (field, name) in field_names.items():
+        if fields.get(field) is not None:
+            fields[field] += offsets[name]
+    # Reactions to proposals refer to pks that don't move
+    if record['model'] == 'reactions.reaction' and fields['content_type'] == ['discussion', 'discussionpost']:
+        fields['object_id'] += offsets['discussion_post_pk']
+
+
+def move_meeting_part(result, pks):
+    """
+    Move a meeting that was exported with pks of its own to start at pks, and advance pks past it.
+    The part file and result are changed in place.
+    """
+    offsets = dict((name, getattr(pks, name) - result['start'][name]) for name in PKCounters.names)
+    offsets['proposal_pk'] = 0
+    fn = result['part'] + '.tmp'
+    part = RecordSpool(stream=open(result['part'], 'rb'))
+    moved = RecordSpool(stream=open(fn, 'wb'))
+    for line in part:
+        # Keeps the order of keys, so the records are the same as if they were exported where they end up
+        record = loads(line.decode('utf-8'), object_pairs_hook=OrderedDict)
+        move_record_pks(record, offsets)
+        line = dumps(record)
+        if isinstance(line, text_type):
+            line = line.encode('utf-8')
+        moved.append_encoded(line)
+    part.close()
+    moved.close()
+    os.rename(fn, result['part'])
+    for key in ('start', 'end'):
+        result[key] = dict((k, v + offsets[k]) for (k, v) in result[key].items())
+    result['ai_uid_to_pk'] = dict((k, v + offsets['ai_pk']) for (k, v) in result['ai_uid_to_pk'].items())
+    for name in PKCounters.names:
+        if name != 'proposal_pk':
+            setattr(pks, name, result['end'][name])
+
+def release_objects(obj, minimize=False):
+    """
+    Let the connection of obj release loaded objects. Changed objects can't be released, so changes are
+    aborted first. Nothing is saved during export anyway.
+
+    :param minimize: release as much as possible, otherwise down to the cache size of the connection.
+    """
+    transaction.abort()
+    if minimize:
+        obj._p_jar.cacheMinimize()
+    else:
+        obj._p_jar.cacheGC()
+
+
+def get_rss():
+    """ Resident memory in MB, or None where it can't be read. """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, ValueError):
+        return None
+    return pages * os.sysconf(str('SC_PAGE_SIZE')) / 1024.0 / 1024.0
+
+
+def get_peak_rss():
+    """ Highest resident memory of this process in MB, or None where it can't be read. """
+    if resource is None:
+        return None
+    # Kilobytes on Linux, bytes on Mac
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024.0
+    return peak / 1024.0
+
+
+def get_memory_stats(obj):
+    """ Resident memory and number of loaded (non-ghost) objects in the connection of obj. """
+    return {'rss': get_rss(), 'cache': obj._p_jar.cacheSize()}
+
+
+def print_memory_stats(result):
+    before = result['memory']
+    after = result['released_memory']
+    rss = "unknown"
+    if before['rss'] is not None:
+        rss = "%.1f MB, %.1f MB after release" % (before['rss'], after['rss'])
+    print("Memory after %s: RSS %s - cache %s objects, %s after release" % (
+        result['name'], rss, before['cache'], after['cache']))
+
+
+def export_meeting_part(root, request, task):
+    """
+    Export a meeting to a part file of its own. Anything collected before is cleared.
+
+    :param task: tuple with meeting name, meeting pk, dict with start pks and the directory to write the
+        part file to.
+    :return: dict with pks, the part filename and what was collected during export.
+    """
+    meeting_name, meeting_pk, start, part_dir = task
+    ctx.reset_meeting()
+    ctx.reset_collected()
+    pks = PKCounters(**start)
+    fd, part_fn = mkstemp(dir=part_dir, suffix='.part')
+    data = RecordSpool(stream=os.fdopen(fd, 'w+b'))
+    meeting = root[meeting_name]
+    started = default_timer()
+    ctx.phases = PhaseStats(pks, meeting._p_jar)
+    try:
+        export_meeting_content(meeting, meeting_pk, pks, request, root['users'], data, spool_dir=part_dir)
+    except:
+        # Like a critical error with DIE_ON_CRITICAL
+        data.close()
+        os.remove(part_fn)
+        raise
+    ctx.phases.stop()
+    data.close()
+    memory = get_memory_stats(meeting)
+    release_objects(meeting, minimize=True)
+    result = ctx.get_collected()
+    result.update(
+        name=meeting_name,
+        pk=meeting_pk,
+        start=start,
+        end=pks.as_dict(),
+        part=part_fn,
+        models=data.models,
+        ai_uid_to_pk=ctx.ai_uid_to_pk.as_dict(),
+        proposal_uid_to_pk=ctx.proposal_uid_to_pk.as_dict(),
+        memory=memory,
+        released_memory=get_memory_stats(meeting),
+        seconds=default_timer() - started,
+        phases=ctx.phases.as_dict(),
+        peak_rss=get_peak_rss(),
+        activations=ctx.tracer.pop() if ctx.tracer else None,
+    )
+    return result
+
+
+def iter_meeting_parts(root, request, meeting_tasks, pks, part_dir):
+    """
+    Export meetings one at a time.
+
+    :param meeting_tasks: list of (meeting name, meeting pk)
+    :param pks: PKCounters, will be advanced past all meetings
+    :return: generator with results from export_meeting_part in meeting order
+    """
+    for (name, meeting_pk) in meeting_tasks:
+        print("Exporting: %s" % name)
+        start = pks.as_dict()
+        result = export_meeting_part(root, request, (name, meeting_pk, start, part_dir))
+        pks.advance(start, result['end'])
+        yield result
+
+
+# Only used within worker processes
+_worker_env = {}
+
+
+def _init_worker(config_uri, cache_size, worker_userid_to_pk, worker_user_pk_to_fullname, trace=False):
+    # Each worker needs its own connection
+    _worker_env.update(bootstrap(config_uri))
+    load_counter.install(_worker_env['root']._p_jar)
+    if trace:
+        ctx.tracer = ActivationTracer()
+        ctx.tracer.install(_worker_env['root']._p_jar)
+    if cache_size:
+        _worker_env['root']._p_jar.db().setCacheSize(cache_size)
+    ctx.userid_to_pk.update(worker_userid_to_pk)
+    ctx.user_pk_to_fullname.update(worker_user_pk_to_fullname)
+
+
+def _export_meeting_task(task):
+    return export_meeting_part(_worker_env['root'], _worker_env['request'], task)
+
+
+def count_meeting_proposals(root, meeting_name):
+    """ Proposals within a meeting according to the catalog. """
+    query = Eq('path', resource_path(root[meeting_name])) & Eq('type_name', 'Proposal')
+    return root.catalog.query(query)[0].total
+
+
+def _count_proposals_task(meeting_name):
+    return count_meeting_proposals(_worker_env['root'], meeting_name)
+
+
+def iter_meeting_parts_parallel(config_uri, meeting_tasks, pks, part_dir, workers, cache_size=None, trace=False):
+    """
+    Export meetings with a pool of worker processes.
+
+    Since pks are numbered in sequence over all meetings, each meeting is exported with pks that start
+    at 1, and moved to where it belongs when it's merged, see move_meeting_part. Results are returned
+    in meeting order, so the merged parts are the same as a sequential export.
+
+    Proposal pks are found within vote and result data too, so they can't be moved. Instead they're
+    decided before export, from the number of proposals in each meeting according to the catalog.
+    If a meeting has another number of proposals than the catalog says, export stops since the pks
+    wouldn't be the same as in a sequential export.
+
+    Same arguments and result as iter_meeting_parts.
+
+    Part files are written to a directory of their own within part_dir, that's removed when done.
+    If export stops, the parts of meetings that other workers finished are removed with it.
+
+    :param cache_size: object cache size of the connection within each worker
+    :param trace: trace object loads within each worker, see ActivationTracer
+    """
+    part_dir = mkdtemp(dir=part_dir, suffix='.parts')
+    pool = Pool(workers, initializer=_init_worker,
+                initargs=(config_uri, cache_size, ctx.userid_to_pk, ctx.user_pk_to_fullname, trace))
+    try:
+        print("Exporting %s meetings with %s workers" % (len(meeting_tasks), workers))
+        counted = pool.map(_count_proposals_task, [name for (name, meeting_pk) in meeting_tasks])
+        export_tasks = []
+        proposal_end = {}
+        for (name, meeting_pk), count in zip(meeting_tasks, counted):
+            export_tasks.append((name, meeting_pk, PKCounters(proposal_pk=pks.proposal_pk).as_dict(), part_dir))
+            pks.proposal_pk += count
+            proposal_end[name] = pks.proposal_pk
+        for result in pool.imap(_export_meeting_task, export_tasks, chunksize=1):
+            print("Exporting: %s" % result['name'])
+            if result['end']['proposal_pk'] != proposal_end[result['name']]:
+                raise Exception("Meeting %s has %s proposals but the catalog has %s. Update the catalog?" % (
+                    result['name'], result['end']['proposal_pk'] - result['start']['proposal_pk'],
+                    proposal_end[result['name']] - result['start']['proposal_pk']))
+            move_meeting_part(result, pks)
+            yield result
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+        # Parts that were merged are gone already
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+
+# Objects to load per round trip to the storage
+PREFETCH_BATCH_SIZE = 500
+
+
+def prefetch(objects):
+    """
+    Load objects that aren't loaded yet in batches, in OID order. Over ZEO that's a few large requests
+    instead of one round trip per object. Does nothing with ZODB versions that can't prefetch.
+    """
+    ghosts = [x for x in objects if getattr(x, '_p_changed', False) is None]
+    if not ghosts:
+        return
+    conn_prefetch = getattr(ghosts[0]._p_jar, 'prefetch', None)
+    if conn_prefetch is None:
+        return
+    ghosts.sort(key=lambda x: x._p_oid)
+    for i in range(0, len(ghosts), PREFETCH_BATCH_SIZE):
+        conn_prefetch(ghosts[i:i + PREFETCH_BATCH_SIZE])
+
+
+class MeetingLikes:
+    """
+    Likes of proposals and discussion posts in a meeting.
+
+    The likes index tells which objects have likes, so only their like storage is read. Userids are
+    converted to pks for the whole meeting at once, only userids that aren't meeting users go through
+    get_pk_for_userid to report errors.
+    """
+
+    def __init__(self, root, request, meeting, meeting_pk):
+        self.request = request
+        self.meeting_pk = meeting_pk
+        # uid -> userids, None when the index is missing
+        self.uid_to_userids = None
+        self.userid_to_pk = {}
+        index = root.catalog.get(LIKES_INDEX) if LIKES_INDEX else None
+        if index is None:
+            return
+        self.uid_to_userids = {}
+        # Only objects with likes, docids() has all objects the index knows about
+        indexed = index.indexed()
+        for type_name in ('Proposal', 'DiscussionPost'):
+            query = Eq('path', resource_path(meeting)) & Eq('type_name', type_name)
+            docids = [x for x in root.catalog.query(query)[1] if x in indexed]
+            for obj in request.resolve_docids(docids, perm=None):
+                userids = self.read(obj)
+                if userids:
+                    self.uid_to_userids[obj.uid] = userids
+        self.add_userids(set(chain.from_iterable(self.uid_to_userids.values())))
+
+    def read(self, obj):
+        """ Sorted userids from the like storage of obj. """
+        return sorted(self.request.registry.getAdapter(obj, IUserTags, name='like'))
+
+    def add_userids(self, userids):
+        meeting_user_pks = ctx.meeting_to_user_pks[self.meeting_pk]
+        found = []
+        for userid in userids:
+            user_pk = ctx.userid_to_pk.get(userid)
+            if user_pk is not None and user_pk in meeting_user_pks:
+                self.userid_to_pk[userid] = user_pk
+                found.append(user_pk)
+        ctx.needed_user_pks.update(found)
+
+    def get_user_pks(self, obj):
+        """
+        :return: list of user pks that like obj, sorted by userid. None for users that are missing.
+        """
+        if self.uid_to_userids is None:
+            userids = self.read(obj)
+        else:
+            userids = self.uid_to_userids.get(obj.uid)
+        if not userids:
+            return []
+        out = []
+        for userid in userids:
+            if userid in self.userid_to_pk:
+                out.append(self.userid_to_pk[userid])
             else:
-                add_error(meeting, 'Skipping meeting roles assigned to non-existing user: {userid}', userid=entry['userid'])
+                out.append(get_pk_for_userid(userid, ck_meeting_pk=self.meeting_pk, context=obj))
+        return out
 
-        # Export participant numbers
-        pn_to_userid = {}
 
-        pns = IParticipantNumbers(meeting)
-        if len(pns.number_to_userid):
-            pn_to_userid.update(pns.number_to_userid)
-            pk_to_old_pns[pn_system_pk] = pns
-            data.append(
-                export_pn_system(pn_system_pk, meeting_pk)
-            )
-            assigned_userids = set()
-            for pn, userid in pn_to_userid.items():
-                try:
-                    created_ts = pns[pn].created
-                except (KeyError, AttributeError):
-                    # The only fallback we have i guess
-                    created_ts = meeting.created
-                if userid in assigned_userids:
-                    add_error(meeting, "WARNING: {userid} has several participant numbers. Export won't work!", userid=userid)
-                    continue
-                assigned_userids.add(userid)
-                if userid != userid.lower():
-                    add_error(meeting, 'Upppercase userid in PN: %s' % userid)
+def find_content(root, request, context, type_name):
+    """ Objects of type_name within context, found through the catalog and prefetched. """
+    query = Eq('path', resource_path(context)) & Eq('type_name', type_name)
+    docids = root.catalog.query(query)[1]
+    found = list(request.resolve_docids(docids, perm=None))
+    prefetch(found)
+    return found
+
+
+def check_meeting(root, request, task):
+    """
+    Run the checks that would stop the export of a meeting, without exporting anything.
+    Records are built by the same functions as in export_meeting_content and checked with validate_record,
+    but pks only need to be unique within the meeting and nothing is written. Content is found through the
+    catalog and votes are only read for their checks.
+
+    :param task: tuple with meeting name and meeting pk
+    :return: dict with what was collected, see ExportContext.get_collected
+    """
+    meeting_name, meeting_pk = task
+    ctx.reset_meeting()
+    ctx.reset_collected()
+    meeting = root[meeting_name]
+    ctx.add_meeting(meeting_name, meeting_pk)
+
+    def check(record):
+        if record is not None and VALIDATE_RECORDS:
+            check_record(record)
+
+    meeting_out = export_meeting(meeting, meeting_pk)
+    adjust_meeting_dialect(meeting, meeting_out)
+    check(meeting_out)
+    userid_to_meeting_group_pk = {}
+    for userid in meeting.system_userids:
+        userid_to_meeting_group_pk[userid] = len(userid_to_meeting_group_pk) + 1
+        check_groupid(userid, meeting_pk, meeting)
+        ctx.need_userid(userid)
+    # Only users with roles are meeting users, like in the export
+    meeting_user_pks = set()
+    for entry in meeting.get_security():
+        if not entry['userid']:
+            continue
+        out = export_meeting_roles(0, entry, meeting_pk, meeting)
+        if out:
+            check(out)
+            meeting_user_pks.add(out['fields']['user'])
+    ctx.meeting_to_user_pks[meeting_pk] = IntSet(meeting_user_pks)
+
+    pns = IParticipantNumbers(meeting)
+    if len(pns.number_to_userid):
+        # Only used for reporting
+        ctx.pk_to_old_pns[0] = pns
+        ctx.pns_pn_check[0] = set()
+        for pn, userid in pns.number_to_userid.items():
+            check_pn(pn, 0)
+            get_pk_for_userid(userid, context=meeting, msg="Missing user '{userid}' in PNS")
+    for register in IElectoralRegister(meeting).registers.values():
+        for userid in register['userids']:
+            get_pk_for_userid(userid, context=meeting, ck_meeting_pk=meeting_pk, msg="Missing user '{userid}' in ER")
+
+    if MV_MEETING_NAMESPACE in meeting:
+        for va in meeting[MV_MEETING_NAMESPACE].values():
+            check(export_meeting_group_mv_origin(va, 0, meeting_pk, meeting))
+    if hasattr(meeting, VOTE_GROUPS_NAMESPACE):
+        for vg in getattr(meeting, VOTE_GROUPS_NAMESPACE).values():
+            check(export_meeting_group_vg_origin(vg, 0, meeting_pk, meeting))
+            for userid in vg.keys():
+                get_pk_for_userid(userid, context=vg)
+    if hasattr(meeting, SFS_DELEGATIONS_NAMESPACE):
+        for meeting_delegation in getattr(meeting, SFS_DELEGATIONS_NAMESPACE).values():
+            check(export_meeting_group_sfs_origin(meeting_delegation, 0, meeting_pk, meeting))
+            for userid in meeting_delegation.leaders:
+                get_pk_for_userid(userid, context=meeting_delegation)
+            for userid in meeting_delegation.members:
+                if userid not in meeting_delegation.leaders:
+                    get_pk_for_userid(userid, context=meeting_delegation)
+
+    ais = list(meeting.values())
+    prefetch(ais)
+    ai_name_to_pk = {}
+    for ai in ais:
+        if ai.type_name == 'AgendaItem':
+            ai_name_to_pk[ai.__name__] = len(ai_name_to_pk) + 1
+            check(export_ai(ai, ai_name_to_pk[ai.__name__], meeting_pk))
+
+    def get_author_kw(obj):
+        assert len(obj.creators) == 1
+        if obj.creators[0] in userid_to_meeting_group_pk:
+            return {'meeting_group_pk': userid_to_meeting_group_pk[obj.creators[0]]}
+        return {'author_pk': get_pk_for_userid(obj.creators[0], ck_meeting_pk=meeting_pk, context=obj)}
+
+    # The export only walks content within agenda items
+    proposals = [x for x in find_content(root, request, meeting, 'Proposal') if x.__parent__.__name__ in ai_name_to_pk]
+    discussion_posts = [x for x in find_content(root, request, meeting, 'DiscussionPost')
+                        if x.__parent__.__name__ in ai_name_to_pk]
+    for (pk, proposal) in enumerate(proposals, start=1):
+        ai_pk = ai_name_to_pk[proposal.__parent__.__name__]
+        check(export_proposal(proposal, pk, ai_pk, meeting_pk=meeting_pk, **get_author_kw(proposal)))
+        ctx.add_proposal(proposal.uid, pk, meeting_pk)
+    for (pk, discussion_post) in enumerate(discussion_posts, start=1):
+        ai_pk = ai_name_to_pk[discussion_post.__parent__.__name__]
+        check(export_discussion_post(discussion_post, pk, ai_pk, meeting_pk=meeting_pk,
+                                     **get_author_kw(discussion_post)))
+    # Likes from users that are missing stop the export too
+    likes = MeetingLikes(root, request, meeting, meeting_pk)
+    for obj in proposals + discussion_posts:
+        likes.get_user_pks(obj)
+    release_objects(meeting)
+
+    polls = [x for x in find_content(root, request, meeting, 'Poll') if x.__parent__.__name__ in ai_name_to_pk]
+    for (pk, poll) in enumerate(polls, start=1):
+        # Polls in all states, there's always an electoral register in the export
+        poll_out = export_poll(poll, pk, meeting_pk, ai_name_to_pk[poll.__parent__.__name__], request, er_pk=0)
+        if not poll_out:
+            continue
+        check(poll_out)
+        if poll.get_workflow_state() != 'closed':
+            continue
+        for userid in poll.voters_mark_closed or ():
+            get_pk_for_userid(userid, context=poll, ck_meeting_pk=meeting_pk, msg="Missing user '{userid}' in poll")
+        max_vote = 0
+        votes = list(poll.values())
+        prefetch(votes)
+        for vote in votes:
+            if not vote.creator[0]:
+                add_error(vote, "has no creator", critical=True)
+                continue
+            if vote.__name__ != vote.creator[0]:
+                continue
+            get_pk_for_userid(vote.creator[0], ck_meeting_pk=meeting_pk, context=vote)
+            if vote.__name__ not in ctx.userid_to_pk:
+                add_error(vote, "Duplicate vote or deleted user", critical=True)
+            elif poll.poll_plugin in ('schulze_pr', 'schulze', 'schulze_stv', 'sorted_schulze'):
+                for ranking in vote.get_vote_data().values():
+                    max_vote = max(max_vote, int(ranking))
+        check_schulze_max_vote(poll, max_vote)
+        release_objects(meeting)
+    release_objects(meeting, minimize=True)
+    result = ctx.get_collected()
+    result['name'] = meeting_name
+    return result
+
+
+def _check_meeting_task(task):
+    return check_meeting(_worker_env['root'], _worker_env['request'], task)
+
+
+def iter_meeting_checks(config_uri, root, request, meeting_tasks, workers=1, cache_size=None):
+    """
+    Check meetings, in parallel with a pool of worker processes if workers is more than 1.
+
+    :param meeting_tasks: list of (meeting name, meeting pk)
+    :return: generator with results from check_meeting, in the order they're done
+    """
+    if workers < 2:
+        for task in meeting_tasks:
+            yield check_meeting(root, request, task)
+        return
+    pool = Pool(workers, initializer=_init_worker,
+                initargs=(config_uri, cache_size, ctx.userid_to_pk, ctx.user_pk_to_fullname))
+    try:
+        for result in pool.imap_unordered(_check_meeting_task, meeting_tasks):
+            yield result
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def meeting_fingerprint(root, request, meeting):
+    """
+    Changes when the meeting or any cataloged content within it is added, removed or modified.
+    Votes aren't cataloged, but they don't change once a poll is closed. Users are checked by the checkpoint,
+    see users_fingerprint.
+    """
+    res, docids = root.catalog.query(Eq('path', resource_path(meeting)), sort_index='modified', reverse=True, limit=1)
+    newest = None
+    for obj in request.resolve_docids(docids, perm=None):
+        newest = obj.modified
+    return "%s|%s|%s" % (django_format_datetime(meeting.modified), res.total, django_format_datetime(newest))
+
+
+def users_fingerprint(user_pks):
+    """ Changes when any of the users is removed or changes name, which is what meetings use of them. """
+    digest = sha1()
+    for user_pk in sorted(user_pks):
+        digest.update(("%s|%s\n" % (user_pk, ctx.user_pk_to_fullname.get(user_pk))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ExportCheckpoint:
+    """
+    Keeps what's needed to resume an export in a directory:
+
+    - state.json with the pks of users and meetings
+    - <meeting pk>.part with the exported records of a finished meeting
+    - <meeting pk>.json with the fingerprint, pks used and what was collected during that meeting's export
+
+    Meetings that changed, had critical errors or use users that were removed or renamed are exported
+    again, starting at the next free pks.
+    The pks they used before are simply left unused, which doesn't matter to the import.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.state = self._read('state.json') or {
+            'userid_to_pk': {},
+            'meeting_name_to_pk': {},
+            'next_user_pk': 1,
+            'next_meeting_pk': 1,
+        }
+        self.meetings = {}
+        for (name, meeting_pk) in self.state['meeting_name_to_pk'].items():
+            entry = self._read('%s.json' % meeting_pk)
+            # Meetings saved before errors were counted or models were kept are exported again
+            if entry is not None and isinstance(entry['errors'], dict) and 'models' in entry:
+                self.meetings[name] = entry
+
+    def _read(self, fn):
+        fn = os.path.join(self.path, fn)
+        if os.path.isfile(fn):
+            with open(fn) as stream:
+                return load(stream)
+
+    def _write(self, fn, data):
+        # Write and move, so we never end up with half a file
+        fn = os.path.join(self.path, fn)
+        with open(fn + '.tmp', 'w') as stream:
+            dump(data, stream)
+        os.rename(fn + '.tmp', fn)
+
+    def save(self):
+        self._write('state.json', self.state)
+
+    def user_pk(self, userid):
+        if userid not in self.state['userid_to_pk']:
+            self.state['userid_to_pk'][userid] = self.state['next_user_pk']
+            self.state['next_user_pk'] += 1
+        return self.state['userid_to_pk'][userid]
+
+    def meeting_pk(self, name):
+        if name not in self.state['meeting_name_to_pk']:
+            self.state['meeting_name_to_pk'][name] = self.state['next_meeting_pk']
+            self.state['next_meeting_pk'] += 1
+        return self.state['meeting_name_to_pk'][name]
+
+    def part_fn(self, name):
+        return os.path.join(self.path, '%s.part' % self.state['meeting_name_to_pk'][name])
+
+    def next_pks(self):
+        """ PKCounters past anything used by any meeting so far. """
+        pks = PKCounters()
+        for entry in self.meetings.values():
+            for (k, v) in entry['end'].items():
+                setattr(pks, k, max(getattr(pks, k), v))
+        return pks
+
+    def is_current(self, name, fingerprint):
+        entry = self.meetings.get(name)
+        return bool(
+            entry and entry['fingerprint'] == fingerprint and not entry['errors']['critical']
+            and entry.get('users') == users_fingerprint(entry['needed_user_pks'])
+            and os.path.isfile(self.part_fn(name))
+        )
+
+    def save_meeting(self, result, fingerprint):
+        name = result['name']
+        os.rename(result['part'], self.part_fn(name))
+        entry = {
+            'fingerprint': fingerprint,
+            'start': result['start'],
+            'end': result['end'],
+            'errors': result['errors'].as_dict(),
+            'needed_user_pks': list(result['needed_user_pks']),
+            'users': users_fingerprint(result['needed_user_pks']),
+            'long_tag_to_trunc': result['long_tag_to_trunc'],
+            'ai_uid_to_pk': result['ai_uid_to_pk'],
+            'proposal_uid_to_pk': result['proposal_uid_to_pk'],
+            'models': result['models'],
+        }
+        self._write('%s.json' % self.state['meeting_name_to_pk'][name], entry)
+        self.meetings[name] = entry
+
+    def get_result(self, name):
+        """ What was collected when the meeting was exported, see ExportContext.get_collected, and the models of its part. """
+        entry = self.meetings[name]
+        return {
+            'errors': ErrorLog.from_dict(entry['errors']),
+            'needed_user_pks': PKBitmap(entry['needed_user_pks']),
+            'long_tag_to_trunc': entry['long_tag_to_trunc'],
+            'models': entry['models'],
+        }
+
+
+def export_meeting_content(meeting, meeting_pk, pks, request, users, data, spool_dir=None):
+    """
+    Export a meeting and everything within it.
+
+    :param pks: PKCounters with the next pk to use for each model. Updated in place.
+    :param data: ExportWriter or anything else with append and extend
+    :param spool_dir: where to keep temporary files
+    """
+    ctx.phases.start('meeting')
+    # Adjust data before it's written
+    meeting_out = export_meeting(meeting, meeting_pk)
+    adjust_meeting_dialect(meeting, meeting_out)
+    data.append(meeting_out)
+    ctx.add_meeting(meeting.__name__, meeting_pk)
+    # Meeting groups are meeting local objects within VoteIT4
+    # System users are global within VoteIT3, so if we convert sys users -> meeting group
+    # we need to create several of them and replace them differently within meetings.
+    userid_to_meeting_group_pk = {}
+    for userid in meeting.system_userids:
+        userid_to_meeting_group_pk[userid] = pks.meeting_group_pk
+        ctx.need_userid(userid)
+        sys_user = users[userid]
+        data.append(
+            export_meeting_group_system_user_like(sys_user, pks.meeting_group_pk, meeting_pk, meeting)
+        )
+        # End meeting group loop
+        pks.meeting_group_pk += 1
+
+    if meeting.system_userids:
+        print(meeting.__name__ + ' has system users that will be groups: ' + ", ".join(meeting.system_userids))
+
+    # keep track of users in meeting
+    meeting_user_pks = set()
+
+    # Export meeting roles
+    ctx.phases.start('roles')
+    maybe_new_er_userids = set()  # In case there's no ER, create one with these
+    for entry in meeting.get_security():
+        if entry['userid'].lower() != entry['userid']:
+            add_error(meeting, 'UserID with uppercase in get_security(): {userid}', userid=entry['userid'])
+        if not entry['userid']:
+            add_error(meeting, 'Empty userid in get_security()')
+            continue
+        out = export_meeting_roles(pks.meeting_roles_pk, entry, meeting_pk, meeting)
+        if out:
+            data.append(out)
+            if ROLE_VOTER in entry['groups']:
+                maybe_new_er_userids.add(entry['userid'])
+            meeting_user_pks.add(get_pk_for_userid(entry['userid'], context=meeting))
+            # End roles loop
+            pks.meeting_roles_pk += 1
+        else:
+            add_error(meeting, 'Skipping meeting roles assigned to non-existing user: {userid}', userid=entry['userid'])
+
+    # Missing users are reported above
+    meeting_user_pks.discard(None)
+    ctx.meeting_to_user_pks[meeting_pk] = IntSet(meeting_user_pks)
+
+    # Export participant numbers
+    ctx.phases.start('participant numbers')
+    pn_to_userid = {}
+
+    pns = IParticipantNumbers(meeting)
+    if len(pns.number_to_userid):
+        pn_to_userid.update(pns.number_to_userid)
+        ctx.pk_to_old_pns[pks.pn_system_pk] = pns
+        data.append(
+            export_pn_system(pks.pn_system_pk, meeting_pk)
+        )
+        assigned_userids = set()
+        for pn, userid in pn_to_userid.items():
+            try:
+                created_ts = pns[pn].created
+            except (KeyError, AttributeError):
+                # The only fallback we have i guess
+                created_ts = meeting.created
+            if userid in assigned_userids:
+                add_error(meeting, "WARNING: {userid} has several participant numbers. Export won't work!", userid=userid)
+                continue
+            assigned_userids.add(userid)
+            if userid != userid.lower():
+                add_error(meeting, 'Upppercase userid in PN: %s' % userid)
 
-                data.append(
-                    export_pn(pn_pk, pn, get_pk_for_userid(userid, context=meeting, msg="Missing user '{userid}' in PNS"), pn_system_pk, created_ts)
-                )
-                # End pn loop
-                pn_pk += 1
-            # End pn system
-            pn_system_pk += 1
-
-        # ERs created via votes and maybe original ers
-        er_handler = ERHandler()
-
-        # Electoral registers - might not exist
-        electoral_registers = IElectoralRegister(meeting)
-        lastest_er_pk = None
-        # Note about ERs here, they may not reflect actual voters used during polls.
-        # We'll use vote data later on to simply construct an ER to get voter weight right.
-        for register in electoral_registers.registers.values():
-            vw_data = []
-            for userid in register['userids']:
-                vw_data.append(
-                    export_voter_weight(voter_weight_pk, electoral_register_pk,
-                                        get_pk_for_userid(userid, context=meeting, ck_meeting_pk = meeting_pk, msg="Missing user '{userid}' in ER"))
-                )
-                # end voter weight loop
-                voter_weight_pk += 1
-            er_data = export_electoral_register(electoral_register_pk, created_ts=register['time'], meeting_pk=meeting_pk)
-            er_handler.track_original_er(er_data, vw_data)
-            data.append(er_data)
-            data.extend(vw_data)
-            lastest_er_pk = electoral_register_pk
-            # end er loop
-            electoral_register_pk += 1
-
-        # In case we have no ERs
-        if lastest_er_pk is None:
-            vw_data = []
-            for userid in maybe_new_er_userids:
-                vw_data.append(
-                    export_voter_weight(voter_weight_pk, electoral_register_pk,
-                                        get_pk_for_userid(userid, context=meeting, ck_meeting_pk=meeting_pk,
-                                                          msg="Missing user '{userid}' in ER"))
-                )
-                # end voter weight loop
-                voter_weight_pk += 1
-            er_data = export_electoral_register(electoral_register_pk, created_ts=meeting.start_time or meeting.created,
-                                                meeting_pk=meeting_pk)
-            er_handler.track_original_er(er_data, vw_data)
-            data.append(er_data)
-            data.extend(vw_data)
-            lastest_er_pk = electoral_register_pk
-            # end er loop
-            electoral_register_pk += 1
-
-        if MV_MEETING_NAMESPACE in meeting:
-            print("Multivotes meeting: %s" % meeting.__name__)
-            meeting_out['fields']['er_policy_name'] = 'group_auto_eq_rnd_bf'
-            meeting_out['fields']['group_votes_active'] = True
-            meeting_out['fields']['installed_dialect'] = 'groupvotes'
-            multivotes=meeting[MV_MEETING_NAMESPACE]
-            for va in multivotes.values():
-                data.append(
-                    export_meeting_group_mv_origin(va, meeting_group_pk, meeting_pk, meeting)
-                )
-                # END MV loop
-                meeting_group_pk += 1
-        if hasattr(meeting, VOTE_GROUPS_NAMESPACE):
-            # Adjust exported meeting
-            meeting_out['fields']['er_policy_name'] = 'main_subst_active'
-            meeting_out['fields']['installed_dialect'] = 'ordinarie_och_ersattare'
-            meeting_out['fields']['group_roles_active'] = True
-            meeting_out['fields']['group_votes_active'] = True
-            # Create group roles for this specific dialect
-            from_vg_roles = ['proposer', 'potential_voter', 'discusser']
             data.append(
-                export_group_role(group_role_pk, meeting_pk,
-                                  title='Ordinarie', role_id='main', roles=from_vg_roles)
+                export_pn(pks.pn_pk, pn, get_pk_for_userid(userid, context=meeting, msg="Missing user '{userid}' in PNS"), pks.pn_system_pk, created_ts)
             )
-            old_role_to_pk = {ROLE_PRIMARY: group_role_pk}
-            group_role_pk += 1
-            data.append(
-                export_group_role(group_role_pk, meeting_pk,
-                                  title='Ersättare', role_id='substitute', roles=from_vg_roles)
+            # End pn loop
+            pks.pn_pk += 1
+        # End pn system
+        pks.pn_system_pk += 1
+
+    # ERs created via votes and maybe original ers
+    ctx.phases.start('electoral registers')
+    er_handler = ERHandler()
+
+    # Electoral registers - might not exist
+    electoral_registers = IElectoralRegister(meeting)
+    lastest_er_pk = None
+    # Note about ERs here, they may not reflect actual voters used during polls.
+    # We'll use vote data later on to simply construct an ER to get voter weight right.
+    for register in electoral_registers.registers.values():
+        vw_data = []
+        for userid in register['userids']:
+            vw_data.append(
+                export_voter_weight(pks.voter_weight_pk, pks.electoral_register_pk,
+                                    get_pk_for_userid(userid, context=meeting, ck_meeting_pk = meeting_pk, msg="Missing user '{userid}' in ER"))
             )
-            old_role_to_pk[ROLE_STANDIN] = group_role_pk
-            group_role_pk += 1
-
-            vg_data = getattr(meeting, VOTE_GROUPS_NAMESPACE)
-            for vg in vg_data.values():
-                data.append(export_meeting_group_vg_origin(vg, meeting_group_pk, meeting_pk, meeting))
-                # Create membership with roles
-                for userid, old_role in vg.items():
-                    data.append(
-                        export_group_membership(
-                            group_membership_pk, get_pk_for_userid(userid, context=vg), meeting_group_pk, role_pk=old_role_to_pk.get(old_role)
-                        )
-                    )
-                    group_membership_pk += 1
-                # end VG loop
-                meeting_group_pk+=1
-
-        if hasattr(meeting, SFS_DELEGATIONS_NAMESPACE):
-            import sfs_ga  # This is just a guard to avoid broken objects!
-            meeting_out['fields']['er_policy_name'] = 'gv_auto_before_p'
-            meeting_out['fields']['installed_dialect'] = 'sfsfum'
-            meeting_out['fields']['group_roles_active'] = True
-            meeting_out['fields']['group_votes_active'] = True
-            # Create group roles for this specific dialect
-            from_delegations_roles = ['proposer', 'potential_voter', 'discusser']
-            data.append(
-                export_group_role(group_role_pk, meeting_pk,
-                                  title='Delegationsledare', role_id='leader', roles=from_delegations_roles)
+            # end voter weight loop
+            pks.voter_weight_pk += 1
+        er_data = export_electoral_register(pks.electoral_register_pk, created_ts=register['time'], meeting_pk=meeting_pk)
+        er_handler.track_original_er(er_data, vw_data, get_userids_roll(register['userids']))
+        data.append(er_data)
+        data.extend(vw_data)
+        lastest_er_pk = pks.electoral_register_pk
+        # end er loop
+        pks.electoral_register_pk += 1
+
+    # In case we have no ERs
+    if lastest_er_pk is None:
+        vw_data = []
+        for userid in sorted(maybe_new_er_userids):
+            vw_data.append(
+                export_voter_weight(pks.voter_weight_pk, pks.electoral_register_pk,
+                                    get_pk_for_userid(userid, context=meeting, ck_meeting_pk=meeting_pk,
+                                                      msg="Missing user '{userid}' in ER"))
             )
-            delegation_leader_pk = group_role_pk
-            group_role_pk += 1
+            # end voter weight loop
+            pks.voter_weight_pk += 1
+        er_data = export_electoral_register(pks.electoral_register_pk, created_ts=meeting.start_time or meeting.created,
+                                            meeting_pk=meeting_pk)
+        er_handler.track_original_er(er_data, vw_data, get_userids_roll(maybe_new_er_userids))
+        data.append(er_data)
+        data.extend(vw_data)
+        lastest_er_pk = pks.electoral_register_pk
+        # end er loop
+        pks.electoral_register_pk += 1
+
+    ctx.phases.start('meeting groups')
+    if MV_MEETING_NAMESPACE in meeting:
+        print("Multivotes meeting: %s" % meeting.__name__)
+        multivotes=meeting[MV_MEETING_NAMESPACE]
+        for va in multivotes.values():
             data.append(
-                export_group_role(group_role_pk, meeting_pk,
-                                  title='Medlem', role_id='member', roles=from_delegations_roles)
+                export_meeting_group_mv_origin(va, pks.meeting_group_pk, meeting_pk, meeting)
             )
-            delegation_member_pk = group_role_pk
-            group_role_pk += 1
-
-            delegations_data = getattr(meeting, SFS_DELEGATIONS_NAMESPACE)
-            for meeting_delegation in delegations_data.values():
+            # END MV loop
+            pks.meeting_group_pk += 1
+    if hasattr(meeting, VOTE_GROUPS_NAMESPACE):
+        # Create group roles for this specific dialect
+        from_vg_roles = ['proposer', 'potential_voter', 'discusser']
+        data.append(
+            export_group_role(pks.group_role_pk, meeting_pk,
+                              title='Ordinarie', role_id='main', roles=from_vg_roles)
+        )
+        old_role_to_pk = {ROLE_PRIMARY: pks.group_role_pk}
+        pks.group_role_pk += 1
+        data.append(
+            export_group_role(pks.group_role_pk, meeting_pk,
+                              title='Ersättare', role_id='substitute', roles=from_vg_roles)
+        )
+        old_role_to_pk[ROLE_STANDIN] = pks.group_role_pk
+        pks.group_role_pk += 1
+
+        vg_data = getattr(meeting, VOTE_GROUPS_NAMESPACE)
+        for vg in vg_data.values():
+            data.append(export_meeting_group_vg_origin(vg, pks.meeting_group_pk, meeting_pk, meeting))
+            # Create membership with roles
+            for userid, old_role in vg.items():
                 data.append(
-                    export_meeting_group_sfs_origin(meeting_delegation, meeting_group_pk, meeting_pk, meeting)
-                )
-                # Create membership with roles - leaders
-                for userid in meeting_delegation.leaders:
-                    data.append(
-                        export_group_membership(
-                            group_membership_pk, get_pk_for_userid(userid, context=meeting_delegation), meeting_group_pk,
-                            role_pk=delegation_leader_pk, votes=meeting_delegation.voters.get(userid),
-                        )
+                    export_group_membership(
+                        pks.group_membership_pk, get_pk_for_userid(userid, context=vg), pks.meeting_group_pk, role_pk=old_role_to_pk.get(old_role)
                     )
-                    group_membership_pk += 1
-                # Create membership with roles - members
-                for userid in meeting_delegation.members:
-                    if userid in meeting_delegation.leaders:
-                        # Only one role in v4!
-                        continue
-                    data.append(
-                        export_group_membership(
-                            group_membership_pk, get_pk_for_userid(userid, context=meeting_delegation), meeting_group_pk,
-                            role_pk=delegation_member_pk, votes=meeting_delegation.voters.get(userid),
-                        )
-                    )
-                    group_membership_pk += 1
-
-                # end VG loop
-                meeting_group_pk += 1
-            #END SFS
-
-        # Prep for reactions (like button)
-        reaction_data = []
+                )
+                pks.group_membership_pk += 1
+            # end VG loop
+            pks.meeting_group_pk+=1
+
+    if hasattr(meeting, SFS_DELEGATIONS_NAMESPACE):
+        # Create group roles for this specific dialect
+        from_delegations_roles = ['proposer', 'potential_voter', 'discusser']
+        data.append(
+            export_group_role(pks.group_role_pk, meeting_pk,
+                              title='Delegationsledare', role_id='leader', roles=from_delegations_roles)
+        )
+        delegation_leader_pk = pks.group_role_pk
+        pks.group_role_pk += 1
+        data.append(
+            export_group_role(pks.group_role_pk, meeting_pk,
+                              title='Medlem', role_id='member', roles=from_delegations_roles)
+        )
+        delegation_member_pk = pks.group_role_pk
+        pks.group_role_pk += 1
 
-        # Walk all AIs and meeting content
-        for ai in meeting.values():
-            if ai.type_name != 'AgendaItem':
-                continue
+        delegations_data = getattr(meeting, SFS_DELEGATIONS_NAMESPACE)
+        for meeting_delegation in delegations_data.values():
             data.append(
-                export_ai(ai, ai_pk, meeting_pk)
+                export_meeting_group_sfs_origin(meeting_delegation, pks.meeting_group_pk, meeting_pk, meeting)
             )
-            ai_name_to_pk[ai.__name__] = ai_pk
-            ai_uid_to_pk[ai.uid] = ai_pk
-
-            # First the diff-text stuff if it exists
-            diff_text = IDiffText(ai)
-            if diff_text.hashtag:
+            # Create membership with roles - leaders
+            for userid in meeting_delegation.leaders:
                 data.append(
-                    export_text_document(diff_text, text_document_pk, ai_pk)
+                    export_group_membership(
+                        pks.group_membership_pk, get_pk_for_userid(userid, context=meeting_delegation), pks.meeting_group_pk,
+                        role_pk=delegation_leader_pk, votes=meeting_delegation.voters.get(userid),
+                    )
                 )
-                # Note! paragraph_id starts at 0 while proposal.diff_text_para starts at 0!
-                for para_i, paragraph in enumerate(diff_text.get_paragraphs(), start=0):
-                    data.append(
-                        export_text_paragraph(paragraph, text_paragraph_pk, diff_text.context.modified, para_i + 1,
-                                              text_document_pk, ai_pk)
+                pks.group_membership_pk += 1
+            # Create membership with roles - members
+            for userid in meeting_delegation.members:
+                if userid in meeting_delegation.leaders:
+                    # Only one role in v4!
+                    continue
+                data.append(
+                    export_group_membership(
+                        pks.group_membership_pk, get_pk_for_userid(userid, context=meeting_delegation), pks.meeting_group_pk,
+                        role_pk=delegation_member_pk, votes=meeting_delegation.voters.get(userid),
                     )
-                    diff_key = "{}:{}".format(ai_pk, para_i)
-                    diff_text_ai_pk_and_paragraph_to_pk[diff_key] = text_paragraph_pk
-                    # End paragraph loop
-                    text_paragraph_pk += 1
-                # END text document loop
-                text_document_pk += 1
-
-            items = {'Poll': [], 'Proposal': [], 'DiscussionPost': []}
-            for obj in ai.values():
-                items[obj.type_name].append(obj)
-            #FIXME: Export LIKES for props and discussions
-            for proposal in items['Proposal']:
-                assert len(proposal.creators) == 1
-                author_userid = proposal.creators[0]
-                if author_userid in userid_to_meeting_group_pk:
-                    kw = {'meeting_group_pk': userid_to_meeting_group_pk[author_userid]}
-                else:
-                    kw = {'author_pk': get_pk_for_userid(author_userid, ck_meeting_pk=meeting_pk, context=proposal)}
+                )
+                pks.group_membership_pk += 1
+
+            # end VG loop
+            pks.meeting_group_pk += 1
+        #END SFS
+
+    # Prep for reactions (like button)
+    reaction_data = RecordSpool(spool_dir)
+
+    # Load content in bulk before walking it, instead of one object at a time.
+    # Content within agenda items is loaded per agenda item, since it's released after each one.
+    ctx.phases.start('prefetch')
+    root = find_root(meeting)
+    ais = list(meeting.values())
+    prefetch(ais)
+    ctx.phases.start('reactions')
+    likes = MeetingLikes(root, request, meeting, meeting_pk)
+
+    # Walk all AIs and meeting content
+    for ai in ais:
+        if ai.type_name != 'AgendaItem':
+            continue
+        ctx.phases.start('agenda items')
+        data.append(
+            export_ai(ai, pks.ai_pk, meeting_pk)
+        )
+        ctx.ai_name_to_pk[ai.__name__] = pks.ai_pk
+        ctx.ai_uid_to_pk[ai.uid] = pks.ai_pk
+
+        # First the diff-text stuff if it exists
+        diff_text = IDiffText(ai)
+        if diff_text.hashtag:
+            data.append(
+                export_text_document(diff_text, pks.text_document_pk, pks.ai_pk)
+            )
+            # Note! paragraph_id starts at 0 while proposal.diff_text_para starts at 0!
+            for para_i, paragraph in enumerate(diff_text.get_paragraphs(), start=0):
                 data.append(
-                    export_proposal(proposal, proposal_pk, ai_pk, meeting_pk=meeting_pk, **kw)
+                    export_text_paragraph(paragraph, pks.text_paragraph_pk, diff_text.context.modified, para_i + 1,
+                                          pks.text_document_pk, pks.ai_pk)
                 )
-                proposal_uid_to_pk[proposal.uid] = proposal_pk
-                # Likes
-                for like_userid in request.registry.getAdapter(proposal, IUserTags, name='like'):
-                    local_reaction = export_reaction(reaction_pk, proposal, proposal_pk, reaction_button_pk, ai_pk, like_userid, meeting_pk = meeting_pk)
+                ctx.diff_text_ai_pk_and_paragraph_to_pk[(pks.ai_pk, para_i)] = pks.text_paragraph_pk
+                # End paragraph loop
+                pks.text_paragraph_pk += 1
+            # END text document loop
+            pks.text_document_pk += 1
+
+        ctx.phases.start('prefetch')
+        contents = list(ai.values())
+        prefetch(contents)
+        items = {'Poll': [], 'Proposal': [], 'DiscussionPost': []}
+        for obj in contents:
+            items[obj.type_name].append(obj)
+        ctx.phases.start('proposals')
+        for proposal in items['Proposal']:
+            assert len(proposal.creators) == 1
+            author_userid = proposal.creators[0]
+            if author_userid in userid_to_meeting_group_pk:
+                kw = {'meeting_group_pk': userid_to_meeting_group_pk[author_userid]}
+            else:
+                kw = {'author_pk': get_pk_for_userid(author_userid, ck_meeting_pk=meeting_pk, context=proposal)}
+            data.append(
+                export_proposal(proposal, pks.proposal_pk, pks.ai_pk, meeting_pk=meeting_pk, **kw)
+            )
+            ctx.add_proposal(proposal.uid, pks.proposal_pk, meeting_pk)
+            # Likes
+            like_user_pks = likes.get_user_pks(proposal)
+            if like_user_pks:
+                ctx.phases.start('reactions')
+                for like_user_pk in like_user_pks:
+                    local_reaction = export_reaction(pks.reaction_pk, proposal, pks.proposal_pk, pks.reaction_button_pk, pks.ai_pk, like_user_pk)
                     if local_reaction:
-                        reaction_pk += 1
+                        pks.reaction_pk += 1
                         reaction_data.append(local_reaction)
+                ctx.phases.start('proposals')
 
-                # But there might be more! Is this proposal a difftext one?
-                if proposal.diff_text_para is not None:
-                    # Diff proposals have a 1-1 relation with their parent proposal. They prefer to use the same pk.
-                    data.append(
-                        export_diff_proposal(proposal_pk, proposal.diff_text_para, ai_pk)
-                    )
-                    # End diff prop
-                # End proposal loop
-                proposal_pk += 1
-            for discussion_post in items['DiscussionPost']:
-                assert len(discussion_post.creators) == 1
-                author_userid = discussion_post.creators[0]
-                if author_userid in userid_to_meeting_group_pk:
-                    kw = {'meeting_group_pk': userid_to_meeting_group_pk[author_userid]}
-                else:
-                    kw = {'author_pk': get_pk_for_userid(author_userid, ck_meeting_pk=meeting_pk, context=discussion_post)}
+            # But there might be more! Is this proposal a difftext one?
+            if proposal.diff_text_para is not None:
+                # Diff proposals have a 1-1 relation with their parent proposal. They prefer to use the same pk.
                 data.append(
-                    export_discussion_post(discussion_post, discussion_post_pk, ai_pk, meeting_pk=meeting_pk, **kw)
+                    export_diff_proposal(pks.proposal_pk, proposal.diff_text_para, pks.ai_pk)
                 )
-                # Likes
-                for like_userid in request.registry.getAdapter(discussion_post, IUserTags, name='like'):
-                    local_reaction = export_reaction(reaction_pk, discussion_post, discussion_post_pk, reaction_button_pk, ai_pk, like_userid, meeting_pk = meeting_pk)
+                # End diff prop
+            # End proposal loop
+            pks.proposal_pk += 1
+        ctx.phases.start('discussion posts')
+        for discussion_post in items['DiscussionPost']:
+            assert len(discussion_post.creators) == 1
+            author_userid = discussion_post.creators[0]
+            if author_userid in userid_to_meeting_group_pk:
+                kw = {'meeting_group_pk': userid_to_meeting_group_pk[author_userid]}
+            else:
+                kw = {'author_pk': get_pk_for_userid(author_userid, ck_meeting_pk=meeting_pk, context=discussion_post)}
+            data.append(
+                export_discussion_post(discussion_post, pks.discussion_post_pk, pks.ai_pk, meeting_pk=meeting_pk, **kw)
+            )
+            # Likes
+            like_user_pks = likes.get_user_pks(discussion_post)
+            if like_user_pks:
+                ctx.phases.start('reactions')
+                for like_user_pk in like_user_pks:
+                    local_reaction = export_reaction(pks.reaction_pk, discussion_post, pks.discussion_post_pk, pks.reaction_button_pk, pks.ai_pk, like_user_pk)
                     if local_reaction:
-                        reaction_pk += 1
+                        pks.reaction_pk += 1
                         reaction_data.append(local_reaction)
-                # End post loop
-                discussion_post_pk += 1
-
-            for poll in items['Poll']:
-                poll_out = export_poll(poll, poll_pk, meeting_pk, ai_pk, request, er_pk=lastest_er_pk)
-                if not poll_out:
-                    continue
+                ctx.phases.start('discussion posts')
+            # End post loop
+            pks.discussion_post_pk += 1
+
+        ctx.phases.start('polls')
+        for poll in items['Poll']:
+            poll_out = export_poll(poll, pks.poll_pk, meeting_pk, pks.ai_pk, request, er_pk=lastest_er_pk)
+            if not poll_out:
+                continue
 
-                # Try to figure out voter weight and ER from poll
-                if poll.get_workflow_state() == 'closed':
-                    # We only care about this for closed - supporting ongoing polls is a bit too weird
-
-                    # And export votes - find unique ones
-                    non_cloned_votes = set()
-                    clone_weight = Counter()
-
-                    for vote in poll.values():
-                        if vote.__name__ == vote.creator[0]:
-                            non_cloned_votes.add(vote)
-                        elif vote.creator[0]:
-                            clone_weight[vote.creator[0]] += 1
-                        else:
-                            add_error(vote, "has no creator", critical=True)
-                            continue
-
-                    # Create ERs based on votes if there's nothing else to go on
-                    er_out = export_electoral_register(electoral_register_pk, poll.start_time, meeting_pk, was_er=False)
-                    vw_out = []
-                    er_userids = set([x.__name__ for x in non_cloned_votes])
-                    if clone_weight:
-                        # We have to settle with the votes we've got
-                        for userid in er_userids:
-                            vw_out.append(
-                                export_voter_weight(
-                                    voter_weight_pk, electoral_register_pk,
-                                    get_pk_for_userid(userid, context=poll, ck_meeting_pk=meeting_pk, msg="Missing user '{userid}' in poll"),
-                                    weight=1 + clone_weight[userid]
-                                )
-                            )
-                            voter_weight_pk += 1
-                    else:
-                        # We can create an ER from the users who had voting permission when the poll closed +
-                        # any others that may have added a vote
-                        if poll.voters_mark_closed:
-                            er_userids.update(poll.voters_mark_closed)
-                        for userid in er_userids:
-                            vw_out.append(
-                                export_voter_weight(
-                                    voter_weight_pk, electoral_register_pk,
-                                    get_pk_for_userid(userid, context=poll, ck_meeting_pk=meeting_pk, msg="Missing user '{userid}' in poll")
-                                )
-                            )
-                            voter_weight_pk += 1
-                    for vote in non_cloned_votes:
-                        out = export_vote(vote, vote_pk, poll_pk, get_pk_for_userid(vote.creator[0], ck_meeting_pk=meeting_pk, context=vote))
-                        if out:
-                            data.append(out)
-                            # End vote loop
-                            vote_pk += 1
-
-                    # We'll swap polls ER if needed
-                    if er_handler.create_or_reuse(poll_out, er_out, vw_out, data):
-                        # Returns None if a new was created
-                        electoral_register_pk += 1
-
-                # Finally append the poll data
-                data.append(poll_out)
-                # End poll loop
-                poll_pk += 1
-
-            # END AI block - keep this last!
-            ai_pk += 1
-
-        # Finish up reaction exports since we've collected all now.
-        if reaction_data:
-            data.append(
-                export_reaction_button(reaction_button_pk, meeting, meeting_pk)
-            )
-            data.extend(reaction_data)
-            #End reaction/like stuff
-            reaction_button_pk += 1
-
-        # Speaker lists - we can only export one speaker list system since we don't know about relations to
-        # categories for voteit3
-        sls = speaker_lists(request, meeting)
-
-        if len(sls.data):
-            # System has lists
-            # Schema and settings lookup doesn't seem to work as it should
-
-            v3_settings = ISpeakerListSettings(meeting)
-            method_name = ''
-            # Cherry-pick settings...
-            settings = {}
-            safe_positions = v3_settings.get('safe_positions', 1)
-            speaker_list_count = v3_settings.get('speaker_list_count', 0)
-            if speaker_list_count == 1:
+            # Try to figure out voter weight and ER from poll
+            if poll.get_workflow_state() == 'closed':
+                # We only care about this for closed - supporting ongoing polls is a bit too weird
+
+                # And export votes - find unique ones
+                # A list, so votes are exported in the same order each run
+                ctx.phases.start('votes')
+                votes = list(poll.values())
+                prefetch(votes)
+                non_cloned_votes, voter_weights, no_creator = get_poll_voter_weights(poll, votes)
+                for vote in no_creator:
+                    add_error(vote, "has no creator", critical=True)
+
+                # Create ERs based on votes if there's nothing else to go on
+                er_out = export_electoral_register(pks.electoral_register_pk, poll.start_time, meeting_pk, was_er=False)
+                vw_out = []
+                for userid in sorted(voter_weights):
+                    vw_out.append(
+                        export_voter_weight(
+                            pks.voter_weight_pk, pks.electoral_register_pk,
+                            get_pk_for_userid(userid, context=poll, ck_meeting_pk=meeting_pk, msg="Missing user '{userid}' in poll"),
+                            weight=voter_weights[userid]
+                        )
+                    )
+                    pks.voter_weight_pk += 1
+                convert = non_cloned_votes and get_vote_converter(poll)
+                if convert:
+                    for i in range(0, len(non_cloned_votes), VOTE_BATCH_SIZE):
+                        out = export_votes(non_cloned_votes[i:i + VOTE_BATCH_SIZE], convert, pks.vote_pk,
+                                           pks.poll_pk, meeting_pk)
+                        data.extend(out)
+                        # End vote batch loop
+                        pks.vote_pk += len(out)
+                    convert.check()
+                ctx.phases.start('polls')
+
+                # We'll swap polls ER if needed
+                if er_handler.create_or_reuse(poll_out, er_out, vw_out, data, get_poll_roll(poll)):
+                    # Returns None if a new was created
+                    pks.electoral_register_pk += 1
+
+            # Finally append the poll data
+            data.append(poll_out)
+            # End poll loop
+            pks.poll_pk += 1
+
+        # Nothing within the agenda item is needed again
+        release_objects(meeting)
+
+        # END AI block - keep this last!
+        pks.ai_pk += 1
+
+    # Finish up reaction exports since we've collected all now.
+    ctx.phases.start('reactions')
+    if reaction_data:
+        data.append(
+            export_reaction_button(pks.reaction_button_pk, meeting, meeting_pk)
+        )
+        data.extend(reaction_data)
+        #End reaction/like stuff
+        pks.reaction_button_pk += 1
+    reaction_data.close()
+
+    # Speaker lists - we can only export one speaker list system since we don't know about relations to
+    # categories for voteit3
+    ctx.phases.start('speaker lists')
+    sls = speaker_lists(request, meeting)
+
+    if len(sls.data):
+        # System has lists
+        # Schema and settings lookup doesn't seem to work as it should
+
+        v3_settings = ISpeakerListSettings(meeting)
+        method_name = ''
+        # Cherry-pick settings...
+        settings = {}
+        safe_positions = v3_settings.get('safe_positions', 1)
+        speaker_list_count = v3_settings.get('speaker_list_count', 0)
+        if speaker_list_count == 1:
+            method_name = 'simple'
+        else:
+            if v3_settings.get('speaker_list_plugin', '') == '':
+                method_name = 'priority'
+                settings['max_times'] = speaker_list_count
+                assert isinstance(settings['max_times'], int)
+            elif v3_settings['speaker_list_plugin'] == 'female_priority':
+                add_error(meeting, "'female_priority' speaker lists exported as priority.")
+                method_name = 'priority'
+                settings['max_times'] = speaker_list_count
+                assert isinstance(settings['max_times'], int)
+            elif v3_settings['speaker_list_plugin'] == 'global_lists':
+                add_error(meeting, "'global_lists' speaker lists aren't handled, exported as 'simple'. (path is meeting)",) # We might not need to care about this
                 method_name = 'simple'
+        if not method_name:
+            import pdb;pdb.set_trace()
+        data.append(
+            export_speaker_list_system(pks.speaker_system_pk, meeting_pk, method_name, settings, safe_positions)
+        )
+        # We're not exporting active lists, queues or anything like that. Everything should be finished.
+        for (k, sl) in sls.items():
+            if '/' in k:
+                ai_uid, _ = k.split('/')
             else:
-                if v3_settings.get('speaker_list_plugin', '') == '':
-                    method_name = 'priority'
-                    settings['max_times'] = speaker_list_count
-                    assert isinstance(settings['max_times'], int)
-                elif v3_settings['speaker_list_plugin'] == 'female_priority':
-                    add_error(meeting, "'female_priority' speaker lists exported as priority.")
-                    method_name = 'priority'
-                    settings['max_times'] = speaker_list_count
-                    assert isinstance(settings['max_times'], int)
-                elif v3_settings['speaker_list_plugin'] == 'global_lists':
-                    add_error(meeting, "'global_lists' speaker lists aren't handled, exported as 'simple'. (path is meeting)",) # We might not need to care about this
-                    method_name = 'simple'
-            if not method_name:
-                import pdb;pdb.set_trace()
+                ai_uid = k
+            if ai_uid not in ctx.ai_uid_to_pk:
+                # print("UID %s belongs to a deleted agenda item, won't export that speaker list" % ai_uid)
+                continue
+            for user_pn, spoken_times in sl.speaker_log.items():
+                if not spoken_times:
+                    continue
+                if user_pn not in pn_to_userid:
+                    continue  # We can't export historic items that are from an anonymous user
+                # This is certainly wrong, but we don't have any other data to use :(
+                try:
+                    created_ts = sl.__parent__.modified
+                except AttributeError:
+                    ai = resolve_uid(request, ai_uid, perm=None)
+                    created_ts = ai.created
+                for seconds in spoken_times:
+                    data.append(
+                        export_speaker(pks.speaker_pk, get_pk_for_userid(pn_to_userid[user_pn], ck_meeting_pk=meeting_pk),
+                                       pks.speaker_list_pk, created_ts, seconds)
+                    )
+                    # end speaker loop
+                    pks.speaker_pk += 1
             data.append(
-                export_speaker_list_system(speaker_system_pk, meeting_pk, method_name, settings, safe_positions)
+                export_speaker_list(pks.speaker_list_pk, pks.speaker_system_pk, ctx.ai_uid_to_pk[ai_uid], sl.title)
             )
-            # We're not exporting active lists, queues or anything like that. Everything should be finished.
-            for (k, sl) in sls.items():
-                if '/' in k:
-                    ai_uid, _ = k.split('/')
-                else:
-                    ai_uid = k
-                if ai_uid not in ai_uid_to_pk:
-                    # print("UID %s belongs to a deleted agenda item, won't export that speaker list" % ai_uid)
-                    continue
-                for user_pn, spoken_times in sl.speaker_log.items():
-                    if not spoken_times:
-                        continue
-                    if user_pn not in pn_to_userid:
-                        continue  # We can't export historic items that are from an anonymous user
-                    # This is certainly wrong, but we don't have any other data to use :(
-                    try:
-                        created_ts = sl.__parent__.modified
-                    except AttributeError:
-                        ai = resolve_uid(request, ai_uid, perm=None)
-                        created_ts = ai.created
-                    for seconds in spoken_times:
-                        data.append(
-                            export_speaker(speaker_pk, get_pk_for_userid(pn_to_userid[user_pn], ck_meeting_pk=meeting_pk),
-                                           speaker_list_pk, created_ts, seconds)
-                        )
-                        # end speaker loop
-                        speaker_pk += 1
-                data.append(
-                    export_speaker_list(speaker_list_pk, speaker_system_pk, ai_uid_to_pk[ai_uid], sl.title)
-                )
-                # End speaker list loop
-                speaker_list_pk += 1
+            # End speaker list loop
+            pks.speaker_list_pk += 1
 
-            # END speaker system block
-            speaker_system_pk += 1
+        # END speaker system block
+        pks.speaker_system_pk += 1
 
-    # Append users we care about
-    skipped = 0
-    for userid, usr_data in maybe_export_users.items():
-        if userid in needed_userids:
-            data.insert(0, usr_data)
-        else:
-            skipped += 1
-    if skipped:
-        print("Maybe we can skip export of %s users" % skipped)
-    # FIXME: Vad gör vi med ballot_data för historiska omröstningar?
-    # ALREADY FIXED: Exporten av resultatdata för schulze använder ranking istället för rating, så vi måste vända på siffrorna!
 
-    if not critical_errors and long_tag_to_trunc:
+def print_errors(errors):
+    """ Report what was collected, see ExportContext.merge_collected and ErrorLog """
+    if not errors.critical and ctx.long_tag_to_trunc:
         print("The following tags are too long and need to be adjusted:")
         print("-"*40)
-        for longtag,truncated in long_tag_to_trunc.items():
+        for longtag,truncated in ctx.long_tag_to_trunc.items():
             print(truncated.ljust(53) + "->  " + longtag)
 
-    if errors:
+    if errors.counts:
         print("-"*80)
         print("There were errors during import:")
         print("="*80)
-        for k, v in errors.items():
-            print(k)
-            for err in v:
-                print(" - " + err)
-        if SINGLE_ERROR:
-            print("!!! NOTE !!! Errors were omitted, unset SINGLE_ERROR to display all")
+        for (msg, count, samples) in errors.iter_summary():
+            print("%s  (%s times)" % (msg, count))
+            for (path, text) in samples:
+                print(" - " + path + "   " + text)
+            if count > len(samples):
+                print("   ... and %s more" % (count - len(samples)))
+        if errors.filename:
+            print("Errors were logged to %s" % errors.filename)
     else:
         print("Everything worked as expected!")
-    if critical_errors:
-        sys.exit("!!! %s critical error types - won't write!" % len(critical_errors))
-    filename = 'voteit4_export.json'
-    print("Writing %s" % filename)
-    with open(filename, "w") as stream:
-        dump(data, stream)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_uri", help="Paster ini file to load settings from")
+    parser.add_argument("-o", "--output",
+                        help="File to write the export to, or directory with --chunked. "
+                             "Defaults to voteit4_export.json or voteit4_export.")
+    parser.add_argument("--chunked", action='store_true',
+                        help="Write gzipped chunks per model and a manifest to a directory instead of one file")
+    parser.add_argument("--csv", action='store_true',
+                        help="Like --chunked but with CSV files per table, to be loaded with PostgreSQL COPY")
+    parser.add_argument("--chunk-size", type=int, default=100000, help="Max records per chunk")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Export meetings in parallel with this many processes. "
+                             "Each process opens its own connection, so the database must be served by ZEO.")
+    parser.add_argument("-c", "--checkpoint-dir",
+                        help="Keep finished meetings here, so a new run only exports meetings "
+                             "that changed or had critical errors")
+    parser.add_argument("--validate-only", action='store_true',
+                        help="Only run the checks that would stop the export and report errors. "
+                             "Nothing is written. Use --workers to check meetings in parallel.")
+    parser.add_argument("--cache-size", type=int,
+                        help="Number of objects to keep in the connection cache. Objects are released "
+                             "after each agenda item and meeting, so this decides memory use. "
+                             "Defaults to the cache size in the ini file.")
+    parser.add_argument("--stats",
+                        help="Write timing, objects and ZODB loads per phase and meeting as json to this file. "
+                             "Defaults to the export name with .stats.json")
+    parser.add_argument("--trace-loads", action='store_true',
+                        help="Record every object loaded from the database with its class, size and the "
+                             "export code that caused it. Ranked in the output and the stats file. Slow.")
+    parser.add_argument("--error-log",
+                        help="Write errors to this file as each meeting is done, one json object per line, "
+                             "and a count for each message at the end. Defaults to the export name with .errors.ndjson. "
+                             "Not written with --validate-only.")
+    args = parser.parse_args(argv)
+    if not args.output:
+        args.output = (args.chunked or args.csv) and 'voteit4_export' or 'voteit4_export.json'
+    if not args.stats:
+        args.stats = os.path.splitext(args.output.rstrip(os.sep))[0] + '.stats.json'
+    if not args.error_log:
+        args.error_log = os.path.splitext(args.output.rstrip(os.sep))[0] + '.errors.ndjson'
+    started = default_timer()
+    env = bootstrap(args.config_uri)
+    root = env['root']
+    request = env['request']
+    users = root['users']
+    load_counter.install(root._p_jar)
+    if args.trace_loads:
+        ctx.tracer = ActivationTracer()
+        ctx.tracer.install(root._p_jar)
+    phases = PhaseStats(conn=root._p_jar)
+    if args.cache_size:
+        root._p_jar.db().setCacheSize(args.cache_size)
+    print("Exporting %s" % root.title)
+    checkpoint = None
+    if args.checkpoint_dir and not args.validate_only:
+        checkpoint = ExportCheckpoint(args.checkpoint_dir)
+
+    if args.validate_only:
+        data = NullWriter()
+    elif args.csv:
+        data = CSVExportWriter(args.output, chunk_size=args.chunk_size)
+    elif args.chunked:
+        data = ChunkedExportWriter(args.output, chunk_size=args.chunk_size)
+    else:
+        # Records are written to disk as they're created
+        data = ExportWriter(args.output)
+    data.append(export_root(root))
+
+    print("Exporting %s users" % len(users))
+    phases.start('users')
+    # Export users and map userids. Whether they're needed is decided when all meetings are done.
+    user_count = 0
+    for user_pk, user in enumerate(users.values(), start=1):
+        if checkpoint:
+            # Keep pks from previous runs
+            user_pk = checkpoint.user_pk(user.userid)
+        ctx.add_user(user.userid, user_pk, user.title)
+        data.add_user(export_user(user, user_pk))
+        user_count += 1
+    release_objects(users, minimize=True)
+    phases.stop(objects=user_count)
+    # Errors from users. Errors from meetings are added to the log as each meeting is done.
+    # Checks only print what they found.
+    errors = ErrorLog(None if args.validate_only else args.error_log)
+    collected = [ctx.get_collected()]
+    errors.merge(collected[0]['errors'])
+
+    if LIKES_INDEX and root.catalog.get(LIKES_INDEX) is None:
+        print("No catalog index '%s', all proposals and discussion posts are read for likes" % LIKES_INDEX)
+
+    # Walk meetings and export contents
+    meetings = [x for x in root.values() if x.type_name == 'Meeting']
+    print("Exporting %s meetings" % len(meetings))
+    meeting_tasks = []
+    for meeting_pk, meeting in enumerate(meetings, start=1):
+        # Limit to a few meetings?
+        if ONLY_MEETING_NAMES and meeting.__name__ not in ONLY_MEETING_NAMES:
+            print("SKIPPING: %s" % meeting.__name__)
+            continue
+        if checkpoint:
+            meeting_pk = checkpoint.meeting_pk(meeting.__name__)
+        ctx.add_meeting(meeting.__name__, meeting_pk)
+        meeting_tasks.append((meeting.__name__, meeting_pk))
+
+    if args.validate_only:
+        for result in iter_meeting_checks(args.config_uri, root, request, meeting_tasks,
+                                          workers=args.workers, cache_size=args.cache_size):
+            print("Checked: %s" % result['name'])
+            errors.merge(result['errors'])
+            collected.append(result)
+        ctx.reset_collected()
+        for result in collected:
+            ctx.merge_collected(result)
+        errors.close()
+        print_errors(errors)
+        if errors.critical:
+            sys.exit("!!! %s critical error types - fix them before exporting" % len(errors.critical))
+        return
+
+    if checkpoint:
+        checkpoint.save()
+        part_dir = args.checkpoint_dir
+        pks = checkpoint.next_pks()
+        export_tasks = []
+        fingerprints = {}
+        for (name, meeting_pk) in meeting_tasks:
+            fingerprint = meeting_fingerprint(root, request, root[name])
+            if checkpoint.is_current(name, fingerprint):
+                print("Unchanged since last run: %s" % name)
+                continue
+            fingerprints[name] = fingerprint
+            export_tasks.append((name, meeting_pk))
+    else:
+        part_dir = os.path.dirname(os.path.abspath(args.output))
+        pks = PKCounters()
+        export_tasks = meeting_tasks
+
+    if args.workers > 1:
+        results = iter_meeting_parts_parallel(args.config_uri, export_tasks, pks, part_dir, args.workers,
+                                              cache_size=args.cache_size, trace=args.trace_loads)
+    else:
+        results = iter_meeting_parts(root, request, export_tasks, pks, part_dir)
+    meeting_stats = []
+    for result in results:
+        print_memory_stats(result)
+        if ctx.tracer:
+            ctx.tracer.merge(result['activations'])
+        meeting_stats.append(
+            dict((k, result[k]) for k in ('name', 'pk', 'seconds', 'peak_rss', 'memory', 'phases'))
+        )
+        phases.start('merge')
+        if checkpoint:
+            # Saved right away, so it's kept even if a later meeting fails
+            checkpoint.save_meeting(result, fingerprints[result['name']])
+        else:
+            part = RecordSpool(stream=open(result['part'], 'rb'), models=result['models'])
+            data.extend(part)
+            part.close()
+            os.remove(result['part'])
+            errors.merge(result['errors'])
+            collected.append(result)
+        phases.stop()
+
+    if checkpoint:
+        phases.start('merge')
+        for (name, meeting_pk) in meeting_tasks:
+            result = checkpoint.get_result(name)
+            part = RecordSpool(stream=open(checkpoint.part_fn(name), 'rb'), models=result['models'])
+            data.extend(part)
+            part.close()
+            errors.merge(result['errors'])
+            collected.append(result)
+        phases.stop()
+
+    ctx.reset_collected()
+    for result in collected:
+        ctx.merge_collected(result)
+
+    # FIXME: Vad gör vi med ballot_data för historiska omröstningar?
+    # ALREADY FIXED: Exporten av resultatdata för schulze använder ranking istället för rating, så vi måste vända på siffrorna!
+
+    errors.close()
+    print_errors(errors)
+    if errors.critical:
+        data.close()
+        sys.exit("!!! %s critical error types - won't write!" % len(errors.critical))
+    print("Writing %s" % args.output)
+    phases.start('write')
+    # Only users we care about
+    skipped = data.write(ctx.needed_user_pks)
+    data.close()
+    phases.stop()
+    if skipped:
+        print("Skipped export of %s users that weren't needed" % skipped)
+    if ctx.tracer:
+        ctx.tracer.print_summary()
+    write_stats(args, started, phases, meeting_stats)
+
+
+def write_stats(args, started, phases, meeting_stats):
+    """
+    Write the json report of an export.
+
+    :param phases: PhaseStats from the main process
+    :param meeting_stats: list of dicts with timing and phases of each exported meeting
+    """
+    total = add_phases(OrderedDict(), phases.as_dict())
+    for meeting in meeting_stats:
+        add_phases(total, meeting['phases'])
+    peak_rss = [x for x in [get_peak_rss()] + [x['peak_rss'] for x in meeting_stats] if x is not None]
+    report = OrderedDict([
+        ('output', args.output),
+        ('workers', args.workers),
+        ('cache_size', args.cache_size),
+        ('seconds', default_timer() - started),
+        # The highest of any process
+        ('peak_rss', peak_rss and max(peak_rss) or None),
+        ('phases', total),
+        ('meetings', meeting_stats),
+    ])
+    if ctx.tracer:
+        report['activations'] = ctx.tracer.as_list()
+    with open(args.stats, 'w') as stream:
+        dump(report, stream, indent=2)
+    print("Wrote stats to %s" % args.stats)
 
 
 if __name__ == '__main__':
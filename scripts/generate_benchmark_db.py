@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Fill a site with made up meetings, to benchmark scripts like export_to_voteit4.py without a copy of
+production data. Use a database of its own, see etc/benchmark.ini.
+
+Everything is random but decided by --seed, so the same arguments create the same content.
+"""
+from __future__ import unicode_literals
+
+import argparse
+import random
+from datetime import timedelta
+
+import transaction
+from arche.utils import utcnow
+from arche_usertags.interfaces import IUserTags
+from pyramid.paster import bootstrap
+from voteit.core.security import ROLE_DISCUSS
+from voteit.core.security import ROLE_PROPOSE
+from voteit.core.security import ROLE_VIEWER
+from voteit.core.security import ROLE_VOTER
+from voteit.irl.models.interfaces import IElectoralRegister
+from voteit.irl.models.interfaces import IParticipantNumbers
+
+from demo_users import add_users
+
+
+# Polls in each agenda item cycle through these
+POLL_PLUGINS = (
+    'schulze',
+    'sorted_schulze',
+    'schulze_pr',
+    'schulze_stv',
+    'scottish_stv',
+    'combined_simple',
+    'dutt_poll',
+    'majority_poll',
+    'irv',
+    'repeated_irv',
+)
+SCHULZE_PLUGINS = ('schulze', 'sorted_schulze', 'schulze_pr', 'schulze_stv')
+RANKED_PLUGINS = ('scottish_stv', 'irv', 'repeated_irv')
+
+WORDS = (
+    "styrelsen", "föreslår", "att", "årsmötet", "beslutar", "om", "en", "ny", "budget", "för", "verksamhetsåret",
+    "motionen", "bifalles", "avslås", "med", "ändringen", "och", "medlemmar", "ska", "kunna", "rösta", "digitalt",
+    "stadgarna", "paragraf", "ersätts", "av", "följande", "text", "distrikten", "får", "ett", "större", "ansvar",
+)
+
+
+def make_text(rnd, userids, tags, words=40):
+    """ Some paragraphs of text with a few mentions and hashtags, like proposals and discussion posts. """
+    out = []
+    for i in range(rnd.randint(words // 2, words * 2)):
+        roll = rnd.random()
+        if roll < 0.02:
+            out.append("@" + rnd.choice(userids))
+        elif roll < 0.04:
+            out.append("#" + rnd.choice(tags))
+        elif roll < 0.06:
+            out.append("\n\n")
+            continue
+        out.append(rnd.choice(WORDS))
+    return " ".join(out)
+
+
+def make_vote_data(poll_plugin, uids, rnd):
+    if poll_plugin == 'majority_poll':
+        return {'proposal': rnd.choice(uids)}
+    if poll_plugin in SCHULZE_PLUGINS:
+        return dict((uid, rnd.randint(1, len(uids))) for uid in uids)
+    if poll_plugin == 'combined_simple':
+        return dict((uid, rnd.choice(('approve', 'deny', 'abstain'))) for uid in uids)
+    if poll_plugin == 'dutt_poll':
+        return {'proposals': set(rnd.sample(uids, rnd.randint(0, len(uids))))}
+    if poll_plugin in RANKED_PLUGINS:
+        ranking = list(uids)
+        rnd.shuffle(ranking)
+        return {'proposals': ranking[:rnd.randint(1, len(ranking))]}
+    raise ValueError("No vote data for %s" % poll_plugin)
+
+
+def add_likes(request, obj, userids, rnd, max_likes):
+    likes = request.registry.getAdapter(obj, IUserTags, name='like')
+    for userid in rnd.sample(userids, rnd.randint(0, min(max_likes, len(userids)))):
+        likes.add(userid)
+
+
+def add_poll(request, ai, name, poll_plugin, proposals, voters, rnd):
+    factories = request.content_factories
+    now = utcnow()
+    uids = [x.uid for x in proposals]
+    poll = ai[name] = factories['Poll'](
+        title="Omröstning %s" % name,
+        poll_plugin=poll_plugin,
+        proposals=set(uids),
+        start_time=now,
+        end_time=now + timedelta(hours=1),
+    )
+    poll.set_workflow_state(request, 'upcoming')
+    poll.set_workflow_state(request, 'ongoing')
+    for userid in voters:
+        vote = factories['Vote'](creator=[userid])
+        vote.set_vote_data(make_vote_data(poll_plugin, uids, rnd), notify=False)
+        poll[userid] = vote
+    poll.set_workflow_state(request, 'closed')
+    return poll
+
+
+def add_meeting(root, request, name, userids, args, rnd):
+    """
+    A meeting where everyone in userids is a voter, with participant numbers and an electoral register.
+    """
+    factories = request.content_factories
+    meeting = root[name] = factories['Meeting'](title="Möte %s" % name)
+    for userid in userids:
+        meeting.local_roles.add(userid, [ROLE_VIEWER, ROLE_DISCUSS, ROLE_PROPOSE, ROLE_VOTER])
+    pns = IParticipantNumbers(meeting)
+    pns.new_tickets('admin', 1, len(userids))
+    for number, userid in enumerate(userids, start=1):
+        pns.claim_ticket(userid, pns.tickets[number].token)
+    IElectoralRegister(meeting).new_register(userids)
+    tags = ["tag-%s" % i for i in range(10)]
+    poll_count = 0
+    for ai_i in range(args.agenda_items):
+        ai = meeting['ai-%s' % ai_i] = factories['AgendaItem'](title="Punkt %s" % ai_i)
+        ai.set_workflow_state(request, 'upcoming')
+        ai.set_workflow_state(request, 'ongoing')
+        proposals = []
+        for i in range(args.proposals):
+            creator = rnd.choice(userids)
+            proposal = ai['proposal-%s' % i] = factories['Proposal'](
+                text=make_text(rnd, userids, tags),
+                creator=[creator],
+                aid='%s-%s' % (creator, i + 1),
+            )
+            add_likes(request, proposal, userids, rnd, args.likes)
+            proposals.append(proposal)
+        for i in range(args.discussion_posts):
+            post = ai['post-%s' % i] = factories['DiscussionPost'](
+                text=make_text(rnd, userids, tags, words=20),
+                creator=[rnd.choice(userids)],
+            )
+            add_likes(request, post, userids, rnd, args.likes)
+        for i in range(args.polls):
+            poll_plugin = POLL_PLUGINS[poll_count % len(POLL_PLUGINS)]
+            poll_count += 1
+            in_poll = rnd.sample(proposals, min(len(proposals), rnd.randint(2, 6)))
+            voters = [x for x in userids if rnd.random() < args.participation]
+            add_poll(request, ai, 'poll-%s' % i, poll_plugin, in_poll, voters, rnd)
+    return meeting
+
+
+def add_arguments(parser):
+    """ Options for populate. """
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--users", type=int, default=1000, help="Users on the site")
+    parser.add_argument("--meetings", type=int, default=5)
+    parser.add_argument("--meeting-users", type=int, default=300,
+                        help="Participants, voters and participant numbers in each meeting")
+    parser.add_argument("--agenda-items", type=int, default=20, help="Per meeting")
+    parser.add_argument("--proposals", type=int, default=10, help="Per agenda item")
+    parser.add_argument("--discussion-posts", type=int, default=15, help="Per agenda item")
+    parser.add_argument("--polls", type=int, default=2, help="Per agenda item")
+    parser.add_argument("--likes", type=int, default=10, help="Max likes per proposal or discussion post")
+    parser.add_argument("--participation", type=float, default=0.9, help="Part of the voters that vote in a poll")
+
+
+def populate(root, request, args):
+    """
+    Add users and meetings, committing as it goes.
+
+    :return: names of the meetings that were added
+    """
+    rnd = random.Random(args.seed)
+    start = len(root['users']) + 1
+    userids = add_users(root, request, start=start, count=args.users)
+    transaction.commit()
+    names = []
+    for i in range(args.meetings):
+        name = 'benchmark-%s' % (len(root) + 1)
+        print("Adding meeting %s" % name)
+        meeting_userids = rnd.sample(userids, min(args.meeting_users, len(userids)))
+        add_meeting(root, request, name, meeting_userids, args, rnd)
+        transaction.commit()
+        root._p_jar.cacheMinimize()
+        names.append(name)
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_uri", help="Paster ini file to load settings from, like etc/benchmark.ini")
+    add_arguments(parser)
+    args = parser.parse_args()
+    env = bootstrap(args.config_uri)
+    populate(env['root'], env['request'], args)
+    print("Done")
+
+
+if __name__ == '__main__':
+    main()
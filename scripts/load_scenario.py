@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Play a meeting against a running server, to see how it handles the burst of votes when a poll opens.
+
+- Participants log in and poll the meeting, like in load_test.py.
+- A moderator opens the poll.
+- The first of the participants vote. Most votes arrive within a minute or two, following a histogram
+  of votes per minute, like the output of voting_timestamps.py for a real poll.
+- The moderator closes the poll when everyone voted, and participants keep polling for a while.
+
+Latency and errors are reported per phase of the meeting. Responses that mention ConflictError are
+counted as such, and ballots that fail are sent again. Conflicts that pyramid_retry resolves on the
+server aren't visible here, they only show as slower responses.
+
+The poll must be upcoming, with the demo users as voters. The views used to change the state of the poll
+and to vote are settings below, since they depend on the VoteIT version.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import random
+import re
+import threading
+from collections import OrderedDict
+from time import sleep
+from timeit import default_timer
+
+from load_test import Client
+from load_test import LoadStats
+from load_test import VirtualUser
+from load_test import add_result_arguments
+from load_test import demo_userids
+from load_test import report
+from load_test import start_users
+from load_test import stop_users
+
+
+# Views of the poll
+OPEN_POLL = 'state?state=ongoing'
+CLOSE_POLL = 'state?state=closed'
+VOTE_VIEW = 'vote'
+# Name and value of the button that submits a ballot
+VOTE_BUTTON = ('vote', 'vote')
+# Times to send a ballot again if it fails
+VOTE_RETRIES = 3
+# Votes per minute since the poll opened, used without --histogram
+DEFAULT_HISTOGRAM = [(1, 120), (2, 45), (3, 15), (4, 8), (5, 4), (6, 2), (8, 1)]
+
+FORM_FIELD_PATTERN = re.compile(r'<input\b[^>]*>|<select\b.*?</select>', flags=re.DOTALL | re.IGNORECASE)
+ATTRIBUTE_PATTERN = re.compile(r'([\w-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+OPTION_PATTERN = re.compile(r'<option\b[^>]*>', flags=re.IGNORECASE)
+
+
+class Phase:
+    """ Name of the phase of the meeting that's going on, shared by all users. """
+
+    def __init__(self, name):
+        self.name = name
+
+
+class PhasedStats(LoadStats):
+    """ Adds requests under the phase they were made in, like 'voting: reload_data.json' """
+
+    def __init__(self, phase):
+        LoadStats.__init__(self)
+        self.phase = phase
+
+    def add(self, endpoint, seconds, error=None):
+        LoadStats.add(self, "%s: %s" % (self.phase.name, endpoint), seconds, error)
+
+
+def check_conflict(response):
+    # Body is checked since a ConflictError that wasn't retried is an error page
+    if b'ConflictError' in response.content:
+        return 'ConflictError'
+
+
+def read_histogram(fn):
+    """
+    Votes per minute from voting_timestamps.py output, or any file with lines of minute and votes.
+    Other lines are ignored.
+    """
+    histogram = []
+    with open(fn) as stream:
+        for line in stream:
+            cols = line.split()
+            if len(cols) == 2 and cols[0].isdigit() and cols[1].isdigit():
+                histogram.append((int(cols[0]), int(cols[1])))
+    if not histogram:
+        raise ValueError("No minutes with votes in %s" % fn)
+    return histogram
+
+
+def vote_times(histogram, voters, rnd=random):
+    """
+    Seconds after the poll opens for each voter to vote, with the same shape as histogram.
+    Each minute gets its share of voters, rounded so the total is right, spread out within the minute.
+    """
+    total = float(sum(votes for (minute, votes) in histogram))
+    shares = [(minute, votes * voters / total) for (minute, votes) in histogram]
+    counts = dict((minute, int(share)) for (minute, share) in shares)
+    # Largest remainders get the voters left after rounding down
+    by_remainder = sorted(shares, key=lambda x: x[1] - int(x[1]), reverse=True)
+    for (minute, share) in by_remainder[:voters - sum(counts.values())]:
+        counts[minute] += 1
+    times = []
+    for (minute, count) in sorted(counts.items()):
+        times.extend((minute - 1 + rnd.random()) * 60 for i in range(count))
+    rnd.shuffle(times)
+    return times
+
+
+def parse_form(html):
+    """
+    Fields of a form in the order they're in, as (name, value) pairs to post back.
+    Hidden fields are kept. Radio buttons and selects get a random choice, so any kind of poll gets a
+    valid ballot. Checkboxes and text fields are left out.
+    """
+    data = []
+    radios = OrderedDict()
+    for match in FORM_FIELD_PATTERN.finditer(html):
+        tag = match.group(0)
+        attrs = dict((k.lower(), a or b) for (k, a, b) in ATTRIBUTE_PATTERN.findall(tag.split('>', 1)[0]))
+        name = attrs.get('name')
+        if not name:
+            continue
+        if tag[:7].lower() == '<select':
+            values = [dict((k.lower(), a or b) for (k, a, b) in ATTRIBUTE_PATTERN.findall(x)).get('value')
+                      for x in OPTION_PATTERN.findall(tag)]
+            values = [x for x in values if x]
+            if values:
+                data.append((name, random.choice(values)))
+        elif attrs.get('type', '').lower() == 'hidden':
+            data.append((name, attrs.get('value', '')))
+        elif attrs.get('type', '').lower() == 'radio':
+            if name not in radios:
+                radios[name] = []
+                # Keep the position, deform needs fields within its start and end markers
+                data.append((name, radios[name]))
+            radios[name].append(attrs.get('value', ''))
+    return [(name, isinstance(value, list) and random.choice(value) or value) for (name, value) in data]
+
+
+class PollState:
+    """ Whether the poll is open, shared by all users. """
+
+    def __init__(self, path):
+        self.path = path
+        self.opened = threading.Event()
+        self.opened_at = None
+        self.closed = False
+
+    def open(self):
+        self.opened_at = default_timer()
+        self.opened.set()
+
+    def close(self):
+        self.closed = True
+
+
+class Participant(VirtualUser):
+    """ Polls the meeting, and votes vote_at seconds after the poll opens if given. """
+
+    def __init__(self, host, userid, paths, think, stop, phase, poll=None, vote_at=None):
+        super(Participant, self).__init__(host, userid, paths, think, stop)
+        self.stats = PhasedStats(phase)
+        self.poll = poll
+        self.vote_at = vote_at
+        self.voted = False
+        self.retries = 0
+        self.conflicts = 0
+
+    def wait(self, client, seconds):
+        until = default_timer() + seconds
+        if self.vote_at is not None and not self.voted and not self.poll.closed:
+            # Wakes up when the poll opens, so voting doesn't wait for the think time
+            self.poll.opened.wait(seconds)
+            if self.poll.opened.is_set():
+                vote_time = self.poll.opened_at + self.vote_at
+                if vote_time < until:
+                    if self.stop.wait(max(0, vote_time - default_timer())):
+                        return
+                    if not self.poll.closed:
+                        self.vote(client)
+        self.stop.wait(max(0, until - default_timer()))
+
+    def vote(self, client):
+        for attempt in range(VOTE_RETRIES + 1):
+            if attempt:
+                self.retries += 1
+            response = client.get('vote form', self.poll.path + '/' + VOTE_VIEW, check=check_conflict)
+            if response is None or response.status_code != 200:
+                continue
+            data = parse_form(response.text)
+            data.append(VOTE_BUTTON)
+            response = client.post('vote', self.poll.path + '/' + VOTE_VIEW, data=data, check=check_conflict)
+            if response is not None and check_conflict(response):
+                self.conflicts += 1
+            if response is not None and response.status_code < 400 and not check_conflict(response):
+                self.voted = True
+                return
+
+
+def run_scenario(args, histogram):
+    phase = Phase('joining')
+    stop = threading.Event()
+    poll = PollState(args.poll.strip('/'))
+    meeting = args.meeting.strip('/')
+    paths = [('reload_data.json', meeting + '/reload_data.json')]
+    times = vote_times(histogram, args.voters)
+    times = [x / args.speed for x in times]
+    participants = []
+    for (i, userid) in enumerate(demo_userids(args.first_user, args.users)):
+        vote_at = times[i] if i < len(times) else None
+        participants.append(
+            Participant(args.host, userid, paths, args.think, stop, phase, poll, vote_at)
+        )
+    moderator = Client(args.host, PhasedStats(phase))
+    if not moderator.login(args.moderator, args.password):
+        raise SystemExit("Moderator %s couldn't log in" % args.moderator)
+
+    print("Starting %s participants over %s seconds" % (len(participants), args.ramp_up))
+    start = start_users(participants, args.ramp_up)
+    phase.name = 'before poll'
+    sleep(args.before)
+
+    print("Opening poll, %s voters over %.0f seconds" % (len(times), max(times or [0])))
+    phase.name = 'opening poll'
+    moderator.get('open poll', poll.path + '/' + OPEN_POLL, check=check_conflict)
+    poll.open()
+    phase.name = 'voting'
+    deadline = poll.opened_at + max(times or [0]) + args.vote_timeout
+    voters = [x for x in participants if x.vote_at is not None]
+    while default_timer() < deadline and not all(x.voted for x in voters):
+        sleep(0.5)
+
+    print("Closing poll")
+    phase.name = 'closing poll'
+    poll.close()
+    moderator.get('close poll', poll.path + '/' + CLOSE_POLL, check=check_conflict)
+    phase.name = 'after poll'
+    sleep(args.after)
+    stats = stop_users(participants)
+    stats.merge(moderator.stats)
+    seconds = default_timer() - start
+    print("Voted: %s of %s" % (len([x for x in voters if x.voted]), len(voters)))
+    print("Ballots sent again: %s" % sum(x.retries for x in voters))
+    print("Ballots that failed with ConflictError: %s" % sum(x.conflicts for x in voters))
+    return stats, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("host", help="Like http://localhost:6543/")
+    parser.add_argument("meeting", help="Meeting name, the demo users must be participants")
+    parser.add_argument("poll", help="Path to an upcoming poll in the meeting, like meeting/agenda-item/poll")
+    parser.add_argument("-u", "--users", type=int, default=200, help="Participants, demo-N users")
+    parser.add_argument("-v", "--voters", type=int, default=150, help="How many of the participants that vote")
+    parser.add_argument("--first-user", type=int, default=1, help="Start with this demo-N user")
+    parser.add_argument("--moderator", default='admin', help="Userid of someone that can open and close the poll")
+    parser.add_argument("--password", default='admin', help="Password of the moderator")
+    parser.add_argument("--histogram", help="Votes per minute, like the output of voting_timestamps.py. "
+                                            "Defaults to a typical poll.")
+    parser.add_argument("-s", "--speed", type=float, default=1.0,
+                        help="Speed up voting, 2 is twice as fast as in the histogram")
+    parser.add_argument("-r", "--ramp-up", type=float, default=30.0, help="Seconds to start all participants over")
+    parser.add_argument("-t", "--think", type=float, default=5.0,
+                        help="Average seconds each participant waits between polls")
+    parser.add_argument("--before", type=float, default=30.0, help="Seconds between the ramp-up and opening the poll")
+    parser.add_argument("--after", type=float, default=30.0, help="Seconds to keep polling after closing the poll")
+    parser.add_argument("--vote-timeout", type=float, default=60.0,
+                        help="Seconds to wait for the last voters before closing the poll")
+    add_result_arguments(parser)
+    args = parser.parse_args()
+    if args.voters > args.users:
+        parser.error("There can't be more voters than participants")
+    histogram = args.histogram and read_histogram(args.histogram) or DEFAULT_HISTOGRAM
+    stats, seconds = run_scenario(args, histogram)
+    report(stats, seconds, args)
+
+
+if __name__ == '__main__':
+    main()
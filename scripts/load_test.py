@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+"""
+Load a running server the way a meeting does: lots of participants logged in at the same time,
+all of them polling the meeting. This replaces the single session loop in common.py.
+
+Participants are the demo-N users from demo_users.py. Their passwords are the same as their userids.
+The users are started evenly spread over the ramp-up time. Each one then requests the endpoints in
+turn and waits for the think time, until the run is over. Latency percentiles, errors and throughput
+are reported for each endpoint. Latencies include the failed requests.
+
+With --save, latency histograms and errors are written to a results file. A later run with --baseline,
+or compare_load_results.py, flags endpoints that got significantly slower or failed more often.
+
+Example, 300 participants during 2 minutes, started over the first 30 seconds:
+
+    python scripts/load_test.py http://localhost:6543/ arsmote-for-ffl -u 300 -r 30 -d 120
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import random
+import sys
+import threading
+from collections import Counter
+from collections import OrderedDict
+from math import ceil
+from math import erfc
+from math import sqrt
+from time import sleep
+from timeit import default_timer
+
+import requests
+
+
+# Relative to the meeting. Name in the report -> path
+DEFAULT_ENDPOINTS = OrderedDict([
+    ('reload_data.json', 'reload_data.json'),
+])
+REQUEST_TIMEOUT = 60
+# Values up to 2 ** HISTOGRAM_BITS microseconds are exact, larger ones are in buckets 1/2 ** (HISTOGRAM_BITS - 1) wide
+HISTOGRAM_BITS = 8
+# Changes must be this unlikely to be chance, and percentiles must have grown this much, to count as regressions
+SIGNIFICANCE = 0.01
+REGRESSION_THRESHOLD = 0.05
+
+
+class LatencyHistogram:
+    """
+    Latencies counted in buckets, like HdrHistogram. Buckets are at most 1/128 of their values wide,
+    so percentiles are within a percent, and memory doesn't grow with the number of requests.
+    Values are whole microseconds, and a bucket is known by the lowest value in it.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def bucket(value):
+        shift = value.bit_length() - HISTOGRAM_BITS
+        if shift <= 0:
+            return value
+        return (value >> shift) << shift
+
+    @staticmethod
+    def middle(bucket):
+        """ Value in the middle of a bucket, to report for anything in it. """
+        shift = bucket.bit_length() - HISTOGRAM_BITS
+        return shift > 0 and bucket + (1 << shift) // 2 or bucket
+
+    def add(self, seconds):
+        value = int(seconds * 1000000)
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """ Nearest rank percentile, in seconds. """
+        if not self.count:
+            return None
+        rank = max(1, int(ceil(percent / 100.0 * self.count)))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.middle(bucket), self.max) / 1000000.0
+
+    def as_dict(self):
+        return {'counts': sorted(self.counts.items()), 'total': self.total, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        for (bucket, count) in data['counts']:
+            histogram.counts[bucket] = count
+            histogram.count += count
+        histogram.total = data['total']
+        histogram.max = data['max']
+        return histogram
+
+
+class EndpointStats:
+    """ Latencies of all requests to an endpoint, and the errors among them. """
+
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        # Status code or exception name -> count
+        self.errors = Counter()
+
+    def add(self, seconds, error=None):
+        self.histogram.add(seconds)
+        if error is not None:
+            self.errors[error] += 1
+
+    def merge(self, other):
+        self.histogram.merge(other.histogram)
+        self.errors.update(other.errors)
+
+    @property
+    def requests(self):
+        return self.histogram.count
+
+    def summary(self, seconds):
+        """ Report numbers for a run that took seconds. Latencies in ms. """
+        failed = sum(self.errors.values())
+        summary = OrderedDict([
+            ('requests', self.requests),
+            ('errors', failed),
+            ('error_rate', self.requests and float(failed) / self.requests or 0.0),
+            ('per_second', seconds and self.requests / seconds or None),
+        ])
+        for p in (50, 95, 99):
+            value = self.histogram.percentile(p)
+            summary['p%s' % p] = value is not None and value * 1000 or None
+        summary['max'] = self.requests and self.histogram.max / 1000.0 or None
+        return summary
+
+    def as_dict(self):
+        return {'errors': dict(self.errors), 'histogram': self.histogram.as_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.errors.update(data['errors'])
+        stats.histogram = LatencyHistogram.from_dict(data['histogram'])
+        return stats
+
+
+class LoadStats:
+    """ EndpointStats by endpoint name. Each thread keeps its own, they're merged when it's done. """
+
+    def __init__(self):
+        self.endpoints = OrderedDict()
+
+    def get(self, endpoint):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = EndpointStats()
+        return stats
+
+    def add(self, endpoint, seconds, error=None):
+        self.get(endpoint).add(seconds, error)
+
+    def merge(self, other):
+        for (endpoint, stats) in other.endpoints.items():
+            self.get(endpoint).merge(stats)
+
+    def print_report(self, seconds):
+        print("-" * 100)
+        print("Endpoint".ljust(30) + "Requests".rjust(10) + "Errors".rjust(8) + "Err %".rjust(7) +
+              "Req/s".rjust(9) + "p50 ms".rjust(9) + "p95 ms".rjust(9) + "p99 ms".rjust(9) + "Max ms".rjust(9))
+        print("=" * 100)
+        total = EndpointStats()
+        rows = list(self.endpoints.items())
+        for stats in self.endpoints.values():
+            total.merge(stats)
+        rows.append(('TOTAL', total))
+        for (endpoint, stats) in rows:
+            s = stats.summary(seconds)
+            print(
+                endpoint[:29].ljust(30) +
+                str(s['requests']).rjust(10) +
+                str(s['errors']).rjust(8) +
+                ("%.1f" % (s['error_rate'] * 100)).rjust(7) +
+                ("%.1f" % (s['per_second'] or 0)).rjust(9) +
+                "".join(("%.0f" % s[k] if s[k] is not None else "-").rjust(9) for k in ('p50', 'p95', 'p99', 'max'))
+            )
+        for (endpoint, stats) in rows[:-1]:
+            for (error, count) in stats.errors.most_common():
+                print("%s failed with %s: %s times" % (endpoint, error, count))
+        print("Took %.1f seconds" % seconds)
+
+    def save(self, fn, seconds, args=None):
+        """ Write a results file, to compare other runs with. """
+        data = OrderedDict([
+            ('seconds', seconds),
+            ('args', args),
+            ('endpoints', OrderedDict((name, stats.as_dict()) for (name, stats) in self.endpoints.items())),
+        ])
+        with open(fn, 'w') as stream:
+            json.dump(data, stream, indent=2)
+        print("Saved results to %s" % fn)
+
+    @classmethod
+    def load(cls, fn):
+        """ :return: (LoadStats, seconds) from a results file """
+        with open(fn) as stream:
+            data = json.load(stream, object_pairs_hook=OrderedDict)
+        stats = cls()
+        for (name, entry) in data['endpoints'].items():
+            stats.endpoints[name] = EndpointStats.from_dict(entry)
+        return stats, data['seconds']
+
+
+def mann_whitney(baseline, current):
+    """
+    One sided Mann-Whitney U test on two LatencyHistograms, with values in the same bucket as ties.
+
+    :return: probability that current is as slow as it is by chance, if it's really no slower than baseline
+    """
+    n1, n2 = baseline.count, current.count
+    n = n1 + n2
+    if not n1 or not n2:
+        return None
+    rank = 0
+    rank_sum = 0.0
+    ties = 0
+    for bucket in sorted(set(baseline.counts) | set(current.counts)):
+        tied = baseline.counts[bucket] + current.counts[bucket]
+        rank_sum += current.counts[bucket] * (rank + (tied + 1) / 2.0)
+        ties += tied ** 3 - tied
+        rank += tied
+    u = rank_sum - n2 * (n2 + 1) / 2.0
+    variance = n1 * n2 / 12.0 * ((n + 1) - ties / float(n * (n - 1) or 1))
+    if variance <= 0:
+        return 1.0
+    z = (u - n1 * n2 / 2.0) / sqrt(variance)
+    return 0.5 * erfc(z / sqrt(2))
+
+
+def error_rate_test(baseline, current):
+    """
+    One sided test of two proportions, for errors among requests.
+
+    :return: probability that current has as many errors as it has by chance, or None if it can't be tested
+    """
+    e1, n1 = sum(baseline.errors.values()), baseline.requests
+    e2, n2 = sum(current.errors.values()), current.requests
+    if not n1 or not n2:
+        return None
+    pooled = float(e1 + e2) / (n1 + n2)
+    variance = pooled * (1 - pooled) * (1.0 / n1 + 1.0 / n2)
+    if variance <= 0:
+        return 1.0
+    z = (float(e2) / n2 - float(e1) / n1) / sqrt(variance)
+    return 0.5 * erfc(z / sqrt(2))
+
+
+def compare(baseline, current, significance=SIGNIFICANCE, threshold=REGRESSION_THRESHOLD):
+    """
+    Compare endpoints in both LoadStats. A regression is slower latencies that are unlikely to be chance
+    and where p50 or p95 grew more than threshold, or more errors that are unlikely to be chance.
+
+    :return: list of dicts with the numbers of each endpoint and what regressed
+    """
+    rows = []
+    for (name, cur) in current.endpoints.items():
+        base = baseline.endpoints.get(name)
+        if base is None:
+            continue
+        row = OrderedDict([('endpoint', name)])
+        for p in (50, 95):
+            before, after = base.histogram.percentile(p), cur.histogram.percentile(p)
+            change = after / before - 1 if before and after is not None else None
+            row['p%s' % p] = (before, after, change)
+        row['latency_p'] = mann_whitney(base.histogram, cur.histogram)
+        row['errors'] = (base.summary(None)['error_rate'], cur.summary(None)['error_rate'])
+        row['errors_p'] = error_rate_test(base, cur)
+        grew = any(row[k][2] is not None and row[k][2] > threshold for k in ('p50', 'p95'))
+        row['slower'] = bool(grew and row['latency_p'] is not None and row['latency_p'] < significance)
+        row['more_errors'] = bool(
+            row['errors'][1] > row['errors'][0] and row['errors_p'] is not None and row['errors_p'] < significance
+        )
+        rows.append(row)
+    return rows
+
+
+def print_comparison(rows):
+    """ :return: number of endpoints that regressed """
+    print("-" * 100)
+    print("Compared with baseline".ljust(30) + "p50 ms".rjust(16) + "p95 ms".rjust(16) + "P(chance)".rjust(11) +
+          "Err %".rjust(14) + "P(chance)".rjust(11))
+    print("=" * 100)
+    regressions = 0
+    for row in rows:
+        cols = [row['endpoint'][:29].ljust(30)]
+        for k in ('p50', 'p95'):
+            before, after, change = row[k]
+            cols.append((before is not None and after is not None and "%.0f->%.0f" % (before * 1000, after * 1000) or "-").rjust(10))
+            cols.append((change is not None and "%+.0f%%" % (change * 100) or "").rjust(6))
+        cols.append((row['latency_p'] is not None and "%.3f" % row['latency_p'] or "-").rjust(11))
+        cols.append(("%.1f->%.1f" % (row['errors'][0] * 100, row['errors'][1] * 100)).rjust(14))
+        cols.append((row['errors_p'] is not None and "%.3f" % row['errors_p'] or "-").rjust(11))
+        flags = [x for x in ('slower', 'more_errors') if row[x]]
+        if flags:
+            regressions += 1
+            cols.append("  REGRESSION: " + ", ".join(flags).replace('_', ' '))
+        print("".join(cols))
+    return regressions
+
+
+def add_result_arguments(parser):
+    parser.add_argument("--save", help="Save latency histograms and errors per endpoint as json to this file")
+    parser.add_argument("-b", "--baseline",
+                        help="Compare with results saved by an earlier run, and exit with an error on regressions")
+
+
+def report(stats, seconds, args):
+    """ Print, save and compare results as asked for with add_result_arguments. """
+    stats.print_report(seconds)
+    if args.save:
+        stats.save(args.save, seconds, sys.argv[1:])
+    if args.baseline:
+        baseline, _ = LoadStats.load(args.baseline)
+        if print_comparison(compare(baseline, stats)):
+            sys.exit("!!! Slower or more errors than %s" % args.baseline)
+
+
+class Client:
+    """ One logged in user, with the stats of its requests. """
+
+    def __init__(self, host, stats, timeout=REQUEST_TIMEOUT):
+        self.host = host.rstrip('/') + '/'
+        self.stats = stats
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def request(self, endpoint, method, path, check=None, **kwargs):
+        """
+        Make a request and add it to stats under endpoint.
+
+        :param check: callable that gets the response and returns an error or None.
+            Errors it finds are reported instead of the status code.
+        :return: the response, or None if there wasn't one
+        """
+        start = default_timer()
+        try:
+            response = self.session.request(method, self.host + path.lstrip('/'), timeout=self.timeout, **kwargs)
+        except requests.RequestException as exc:
+            self.stats.add(endpoint, default_timer() - start, exc.__class__.__name__)
+            return None
+        seconds = default_timer() - start
+        error = check is not None and check(response) or None
+        if error is None and response.status_code >= 400:
+            error = str(response.status_code)
+        self.stats.add(endpoint, seconds, error)
+        return response
+
+    def get(self, endpoint, path, **kwargs):
+        return self.request(endpoint, 'GET', path, **kwargs)
+
+    def post(self, endpoint, path, **kwargs):
+        return self.request(endpoint, 'POST', path, **kwargs)
+
+    def login(self, userid, password):
+        """ :return: True if it worked. A failed login shows the form again instead of redirecting. """
+        response = self.post(
+            'login', 'login',
+            data={'userid': userid, 'password': password, 'login': 'login'},
+            check=lambda r: r.url.rstrip('/').endswith('/login') and 'rejected' or None,
+        )
+        return response is not None and not response.url.rstrip('/').endswith('/login')
+
+
+class VirtualUser(threading.Thread):
+    """ Logs in and polls the endpoints until stop is set. """
+
+    def __init__(self, host, userid, paths, think, stop):
+        super(VirtualUser, self).__init__(name=userid)
+        self.daemon = True
+        self.host = host
+        self.userid = userid
+        self.paths = paths
+        self.think = think
+        self.stop = stop
+        self.stats = LoadStats()
+
+    def make_client(self):
+        return Client(self.host, self.stats)
+
+    def run(self):
+        client = self.make_client()
+        # demo_users.py sets the password to the userid
+        if not client.login(self.userid, self.userid):
+            return
+        while not self.stop.is_set():
+            for (endpoint, path) in self.paths:
+                if self.stop.is_set():
+                    return
+                client.get(endpoint, path)
+            # Some randomness, so users don't end up in step with each other
+            self.wait(client, self.think * random.uniform(0.5, 1.5))
+
+    def wait(self, client, seconds):
+        """ Between polls. Subclasses can do other things meanwhile. """
+        self.stop.wait(seconds)
+
+
+def start_users(users, ramp_up):
+    """
+    Start users spread over ramp_up seconds.
+
+    :return: time of the start
+    """
+    start = default_timer()
+    for (i, user) in enumerate(users):
+        wait = start + ramp_up * i / len(users) - default_timer()
+        if wait > 0:
+            sleep(wait)
+        user.start()
+    return start
+
+
+def stop_users(users):
+    """
+    Set the stop event that users share and wait for them to finish.
+
+    :return: LoadStats with everything
+    """
+    users[0].stop.set()
+    stats = LoadStats()
+    for user in users:
+        user.join()
+        stats.merge(user.stats)
+    return stats
+
+
+def run_users(users, ramp_up, duration):
+    """
+    Start users spread over ramp_up seconds and stop them all when duration seconds have passed since the start.
+
+    :return: (LoadStats with everything, seconds it took)
+    """
+    start = start_users(users, ramp_up)
+    wait = start + duration - default_timer()
+    if wait > 0:
+        sleep(wait)
+    stats = stop_users(users)
+    return stats, default_timer() - start
+
+
+def demo_userids(first, count):
+    return ["demo-%s" % i for i in range(first, first + count)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("host", help="Like http://localhost:6543/")
+    parser.add_argument("meeting", help="Meeting name, the demo users must be participants")
+    parser.add_argument("-u", "--users", type=int, default=100, help="Number of demo users to log in")
+    parser.add_argument("--first-user", type=int, default=1, help="Start with this demo-N user")
+    parser.add_argument("-r", "--ramp-up", type=float, default=10.0, help="Seconds to start all users over")
+    parser.add_argument("-d", "--duration", type=float, default=60.0, help="Seconds to run, including the ramp-up")
+    parser.add_argument("-t", "--think", type=float, default=2.0, help="Average seconds each user waits between polls")
+    parser.add_argument("-e", "--endpoint", action='append',
+                        help="Path within the meeting to poll, can be given more than once. "
+                             "Defaults to %s" % ", ".join(DEFAULT_ENDPOINTS.values()))
+    add_result_arguments(parser)
+    args = parser.parse_args()
+    if args.endpoint:
+        endpoints = OrderedDict((x or 'meeting', x) for x in args.endpoint)
+    else:
+        endpoints = DEFAULT_ENDPOINTS
+    paths = [(name, args.meeting.strip('/') + '/' + path) for (name, path) in endpoints.items()]
+    stop = threading.Event()
+    users = [VirtualUser(args.host, userid, paths, args.think, stop)
+             for userid in demo_userids(args.first_user, args.users)]
+    print("Running %s users against %s for %s seconds" % (len(users), args.host, args.duration))
+    stats, seconds = run_users(users, args.ramp_up, args.duration)
+    report(stats, seconds, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Like load_test.py, but the app runs in this process, without a server, ZEO or Redis. Hot request paths
+like reload_data.json can then be profiled the same way each time, on any machine.
+
+The app is built from an ini file like etc/development.ini, with its database replaced by a FileStorage
+in a temporary directory. That database gets the same made up content as generate_benchmark_db.py
+creates, and the users poll the first meeting in it. The debug toolbar and Redis are turned off,
+since they aren't what's being measured.
+
+    bin/py scripts/load_test_wsgi.py etc/development.ini -c 50 -d 30 -t 0.5 --profile reload.prof
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import cProfile
+import os
+import pstats
+import random
+import shutil
+import threading
+import traceback
+from tempfile import mkdtemp
+
+import transaction
+from pyramid.paster import get_appsettings
+from pyramid.scripting import prepare
+from voteit.core import main as make_app
+from webtest import TestApp
+
+from generate_benchmark_db import add_arguments
+from generate_benchmark_db import populate
+from load_test import Client
+from load_test import DEFAULT_ENDPOINTS
+from load_test import VirtualUser
+from load_test import add_result_arguments
+from load_test import report
+from load_test import run_users
+
+
+HOST = 'http://localhost/'
+# Left out of pyramid.includes
+SKIP_INCLUDES = ('pyramid_debugtoolbar',)
+# Functions to print from the profile, by cumulative time
+PROFILE_ROWS = 40
+
+
+def build_app(config_uri, directory):
+    """ The app from config_uri with a database in directory. """
+    settings = get_appsettings(config_uri)
+    settings['zodbconn.uri'] = 'file://%s?blobstorage_dir=%s' % (
+        os.path.join(directory, 'Data.fs'), os.path.join(directory, 'blob'))
+    settings.pop('voteit.redis_url', None)
+    settings['pyramid.includes'] = "\n".join(
+        x for x in settings.get('pyramid.includes', '').split() if x not in SKIP_INCLUDES)
+    global_config = getattr(settings, 'global_conf', None) or {
+        '__file__': os.path.abspath(config_uri),
+        'here': os.path.dirname(os.path.abspath(config_uri)),
+    }
+    return make_app(global_config, **settings)
+
+
+class WSGIResponse:
+    """ The parts of a requests response that Client and the scripts use. """
+
+    def __init__(self, status_code, url, content):
+        self.status_code = status_code
+        self.url = url
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+
+class WSGISession:
+    """ Stands in for requests.Session and calls the app directly. Keeps cookies like a browser. """
+
+    def __init__(self, app):
+        self.app = TestApp(app, extra_environ={'HTTP_HOST': 'localhost'}, lint=False)
+
+    def request(self, method, url, timeout=None, data=None, params=None, allow_redirects=True):
+        path = '/' + url[len(HOST):]
+        try:
+            if method == 'GET':
+                response = self.app.get(path, params=params, expect_errors=True)
+            else:
+                response = self.app.post(path, params=data or {}, expect_errors=True)
+            if allow_redirects:
+                response = response.maybe_follow(expect_errors=True)
+        except Exception:
+            # What would have been an error page from the server, like a ConflictError that wasn't retried
+            return WSGIResponse(500, url, traceback.format_exc().encode('utf-8'))
+        return WSGIResponse(response.status_int, response.request.url, response.body)
+
+
+class WSGIUser(VirtualUser):
+    """ A VirtualUser that calls the app in this process. """
+
+    def __init__(self, app, userid, paths, think, stop):
+        super(WSGIUser, self).__init__(HOST, userid, paths, think, stop)
+        self.app = app
+
+    def make_client(self):
+        client = Client(self.host, self.stats)
+        client.session = WSGISession(self.app)
+        return client
+
+
+class ProfileMiddleware:
+    """
+    Profiles requests in each thread that handles them, and nothing in between.
+    The profiles of all threads are added up when the run is over.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.profiles = []
+
+    def __call__(self, environ, start_response):
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profile)
+        profile.enable()
+        try:
+            result = self.app(environ, start_response)
+            try:
+                return list(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        finally:
+            profile.disable()
+
+    def save(self, fn, rows=PROFILE_ROWS):
+        if not self.profiles:
+            return
+        stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(fn)
+        stats.sort_stats('cumulative').print_stats(rows)
+        print("Saved profile to %s, for pstats or snakeviz" % fn)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_uri", help="Paster ini file to build the app from, like etc/development.ini")
+    parser.add_argument("-c", "--concurrent", type=int, default=50,
+                        help="Participants of the meeting that poll it, each in a thread of its own")
+    parser.add_argument("-r", "--ramp-up", type=float, default=5.0, help="Seconds to start all users over")
+    parser.add_argument("-d", "--duration", type=float, default=30.0, help="Seconds to run, including the ramp-up")
+    parser.add_argument("-t", "--think", type=float, default=1.0, help="Average seconds each user waits between polls")
+    parser.add_argument("-e", "--endpoint", action='append',
+                        help="Path within the meeting to poll, can be given more than once. "
+                             "Defaults to %s" % ", ".join(DEFAULT_ENDPOINTS.values()))
+    parser.add_argument("--profile", help="Profile requests and save the profile to this file")
+    parser.add_argument("--keep", action='store_true', help="Keep the database and print where it is")
+    add_arguments(parser)
+    add_result_arguments(parser)
+    # Less content than generate_benchmark_db.py, so it's quick to create
+    parser.set_defaults(users=300, meetings=1, meeting_users=200, agenda_items=10)
+    args = parser.parse_args()
+    # The same content and think times each run
+    random.seed(args.seed)
+    directory = mkdtemp()
+    try:
+        app = build_app(args.config_uri, directory)
+        env = prepare(registry=app.registry)
+        print("Adding content to %s" % directory)
+        meeting_name = populate(env['root'], env['request'], args)[0]
+        userids = sorted(env['root'][meeting_name].local_roles)[:args.concurrent]
+        if len(userids) < args.concurrent:
+            parser.error("The meeting only has %s participants, see --meeting-users" % len(userids))
+        env['closer']()
+        transaction.abort()
+
+        if args.profile:
+            app = ProfileMiddleware(app)
+        if args.endpoint:
+            endpoints = [(x or 'meeting', x) for x in args.endpoint]
+        else:
+            endpoints = DEFAULT_ENDPOINTS.items()
+        paths = [(name, meeting_name + '/' + path) for (name, path) in endpoints]
+        stop = threading.Event()
+        users = [WSGIUser(app, userid, paths, args.think, stop) for userid in userids]
+        print("Running %s users against %s for %s seconds" % (len(users), meeting_name, args.duration))
+        stats, seconds = run_users(users, args.ramp_up, args.duration)
+        if args.profile:
+            app.save(args.profile)
+        report(stats, seconds, args)
+    finally:
+        if args.keep:
+            print("Database kept in %s" % directory)
+        else:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
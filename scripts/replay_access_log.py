@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Replay requests from an nginx access log against a local server, so load tests get the same mix of
+requests as production. See etc/nginx.conf for where the log is, it's in the default combined format.
+
+Sessions in the log are told apart by address and user agent, and each one is given one of the demo-N
+users from demo_users.py. With more sessions than users, users get several sessions. Requests keep the
+time between them, or a part of it with --speed. A user that's still waiting for an earlier response is
+late with the next request, and the report says how late users got.
+
+Only GET requests are replayed, since the log doesn't have what was posted. Static resources and login
+are left out unless --include-static. Paths can be rewritten to match meetings on the local server.
+
+    python scripts/replay_access_log.py http://localhost:6543/ voteit-dev-access.log -u 200 -s 2 \\
+        --rewrite /arsmote-2019/ /arsmote-for-ffl/
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import gzip
+import re
+import threading
+from datetime import datetime
+from time import sleep
+from timeit import default_timer
+
+from load_test import VirtualUser
+from load_test import add_result_arguments
+from load_test import demo_userids
+from load_test import report
+from load_test import stop_users
+
+
+LOG_PATTERN = re.compile(
+    r'(?P<addr>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] "(?P<method>[A-Z]+) (?P<path>\S+)[^"]*" (?P<status>\d{3}) \S+'
+    r'(?: "(?P<referer>[^"]*)" "(?P<agent>[^"]*)")?'
+)
+MONTHS = dict((name, i) for (i, name) in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], start=1))
+# Left out unless --include-static
+SKIP_PATHS = re.compile(r'^/(static|fanstatic|favicon\.ico)|^/(login|logout)\b')
+
+
+def parse_time(text):
+    """ Time of a log line, like 10/Oct/2019:13:55:36 +0200. The timezone is the same for all lines. """
+    day, month, rest = text.split(' ')[0].split('/')
+    year, hour, minute, second = rest.split(':')
+    return datetime(int(year), MONTHS[month], int(day), int(hour), int(minute), int(second))
+
+
+def iter_log(fn):
+    """ Parsed lines of an access log, gzipped or not. Lines that can't be parsed are skipped. """
+    opener = fn.endswith('.gz') and gzip.open or open
+    with opener(fn, 'rb') as stream:
+        for line in stream:
+            match = LOG_PATTERN.match(line.decode('utf-8', 'replace'))
+            if match:
+                yield match.groupdict()
+
+
+def endpoint_name(path):
+    """
+    Name in the report. Views with a dot or underscore in the name, like reload_data.json, are named by themselves.
+    Anything else is counted as a resource, like a meeting or an agenda item.
+    """
+    path = path.split('?', 1)[0]
+    if path.startswith('/static/') or path.startswith('/fanstatic/'):
+        return 'static'
+    last = path.rsplit('/', 1)[-1]
+    if '.' in last or last.startswith('_'):
+        return last
+    return 'resource'
+
+
+def read_schedules(fn, users, rewrites=(), include_static=False, limit=None):
+    """
+    Requests for each user, as lists of (seconds since the first request, endpoint, path).
+
+    :return: (schedules, sessions, skipped lines)
+    """
+    schedules = [[] for i in range(users)]
+    session_to_user = {}
+    first = None
+    skipped = 0
+    count = 0
+    for entry in iter_log(fn):
+        path = entry['path']
+        if entry['method'] != 'GET' or (not include_static and SKIP_PATHS.match(path)):
+            skipped += 1
+            continue
+        for (old, new) in rewrites:
+            if path.startswith(old):
+                path = new + path[len(old):]
+                break
+        when = parse_time(entry['time'])
+        if first is None:
+            first = when
+        session = (entry['addr'], entry['agent'])
+        if session not in session_to_user:
+            session_to_user[session] = len(session_to_user) % users
+        offset = (when - first).total_seconds()
+        schedules[session_to_user[session]].append((offset, endpoint_name(path), path))
+        count += 1
+        if limit and count >= limit:
+            break
+    for schedule in schedules:
+        # Logs are written when requests end, so they're almost but not quite in order
+        schedule.sort(key=lambda x: x[0])
+    return [x for x in schedules if x], len(session_to_user), skipped
+
+
+class ReplayStart:
+    """ When the replay started, set when all users have logged in. """
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.event = threading.Event()
+        self.time = None
+
+    def set(self):
+        self.time = default_timer()
+        self.event.set()
+
+
+class ReplayUser(VirtualUser):
+    """ Logs in and makes the requests of its schedule at the same pace as in the log. """
+
+    def __init__(self, host, userid, schedule, start, stop):
+        super(ReplayUser, self).__init__(host, userid, [], 0, stop)
+        self.schedule = schedule
+        self.start_at = start
+        self.logged_in = threading.Event()
+        self.max_late = 0.0
+
+    def run(self):
+        client = self.make_client()
+        ok = client.login(self.userid, self.userid)
+        self.logged_in.set()
+        if not ok:
+            return
+        self.start_at.event.wait()
+        for (offset, endpoint, path) in self.schedule:
+            wait = self.start_at.time + offset / self.start_at.speed - default_timer()
+            if wait > 0:
+                if self.stop.wait(wait):
+                    return
+            else:
+                self.max_late = max(self.max_late, -wait)
+            client.get(endpoint, path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("host", help="Like http://localhost:6543/")
+    parser.add_argument("log", help="nginx access log, may be gzipped")
+    parser.add_argument("-u", "--users", type=int, default=100, help="Number of demo users to give sessions to")
+    parser.add_argument("--first-user", type=int, default=1, help="Start with this demo-N user")
+    parser.add_argument("-s", "--speed", type=float, default=1.0,
+                        help="Replay this many times faster than the log")
+    parser.add_argument("--rewrite", nargs=2, action='append', default=[], metavar=('OLD', 'NEW'),
+                        help="Replace the start of paths, like a meeting name. Can be given more than once.")
+    parser.add_argument("--include-static", action='store_true', help="Replay static resources and login too")
+    parser.add_argument("-l", "--limit", type=int, help="Only replay this many requests from the start of the log")
+    add_result_arguments(parser)
+    args = parser.parse_args()
+    schedules, sessions, skipped = read_schedules(
+        args.log, args.users, rewrites=args.rewrite, include_static=args.include_static, limit=args.limit)
+    requests = sum(len(x) for x in schedules)
+    log_seconds = max(x[-1][0] for x in schedules) if schedules else 0
+    print("Replaying %s requests from %s sessions over %.0f seconds, %s lines skipped" % (
+        requests, sessions, log_seconds / args.speed, skipped))
+    start = ReplayStart(args.speed)
+    stop = threading.Event()
+    users = [ReplayUser(args.host, userid, schedule, start, stop)
+             for (userid, schedule) in zip(demo_userids(args.first_user, len(schedules)), schedules)]
+    print("Logging in %s users" % len(users))
+    for user in users:
+        user.start()
+    for user in users:
+        user.logged_in.wait()
+    start.set()
+    while any(user.is_alive() for user in users):
+        sleep(0.5)
+    stats = stop_users(users)
+    print("Users were at most %.1f seconds behind the log" % max([x.max_late for x in users] or [0]))
+    report(stats, default_timer() - start.time, args)
+
+
+if __name__ == '__main__':
+    main()
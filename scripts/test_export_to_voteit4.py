@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Run with: bin/nosetests scripts/test_export_to_voteit4.py
+"""
+from __future__ import unicode_literals
+
+import os
+import shutil
+import unittest
+from json import load
+from tempfile import mkdtemp
+
+import export_to_voteit4 as export
+
+
+class _Obj(object):
+
+    def __init__(self, meeting=None, name=None):
+        self.meeting = meeting
+        self.__name__ = name
+
+
+class _Request(object):
+
+    def __init__(self, uid_to_obj):
+        self.uid_to_obj = uid_to_obj
+
+    def resolve_uid(self, uid, perm=None):
+        return self.uid_to_obj.get(uid)
+
+
+class GetProposalWithCheckTests(unittest.TestCase):
+
+    def setUp(self):
+        self.meeting = _Obj(name='meeting')
+        self.other_meeting = _Obj(name='other')
+        self._patched = {}
+        self._patch('find_interface', lambda obj, iface: obj.meeting)
+        self._patch('resource_path', lambda obj: obj is self.other_meeting and '/other' or '/meeting')
+        self._patch('ctx', export.ExportContext())
+        export.ctx.add_meeting('meeting', 1)
+        export.ctx.add_meeting('other', 2)
+
+    def tearDown(self):
+        for (k, v) in self._patched.items():
+            setattr(export, k, v)
+
+    def _patch(self, name, value):
+        self._patched[name] = getattr(export, name)
+        setattr(export, name, value)
+
+    def test_proposal_in_other_meeting(self):
+        poll = _Obj(self.meeting)
+        request = _Request({'uid': _Obj(self.other_meeting)})
+        self.assertEqual(export.get_proposal_with_check(poll, 'uid', request), None)
+        # Cached the second time around
+        self.assertEqual(export.get_proposal_with_check(poll, 'uid', request), None)
+        self.assertEqual(export.ctx.errors.critical,
+                         {"CRIT: Must skip export: Proposal from another meeting: {meeting}"})
+
+    def test_exported_proposal(self):
+        poll = _Obj(self.meeting)
+        export.ctx.add_proposal('uid', 3, 1)
+        self.assertEqual(export.get_proposal_with_check(poll, 'uid', _Request({})), 3)
+        self.assertEqual(export.ctx.errors.critical, set())
+
+    def test_proposal_exported_in_other_meeting(self):
+        poll = _Obj(self.meeting)
+        export.ctx.add_proposal('uid', 3, 2)
+        request = _Request({'uid': _Obj(self.other_meeting)})
+        self.assertEqual(export.get_proposal_with_check(poll, 'uid', request), None)
+        self.assertEqual(export.ctx.errors.critical,
+                         {"CRIT: Must skip export: Proposal from another meeting: {meeting}"})
+
+    def test_deleted_proposal(self):
+        poll = _Obj(self.meeting)
+        self.assertEqual(export.get_proposal_with_check(poll, 'uid', _Request({})), None)
+        self.assertEqual(export.ctx.errors.critical, {"CRIT: Must skip export: Proposal {uid} doesn't exist"})
+
+
+class ChunkedManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self._ctx = export.ctx
+        export.ctx = export.ExportContext()
+
+    def tearDown(self):
+        export.ctx = self._ctx
+        shutil.rmtree(self.directory)
+
+    def _record(self, pk, model, **fields):
+        return {'pk': pk, 'model': model, 'fields': fields}
+
+    def test_models_after_the_models_they_refer_to(self):
+        writer = export.ChunkedExportWriter(self.directory)
+        writer.add_user(self._record(1, 'core.user', organisation=1))
+        # Votes, registers and speakers are added before what they refer to
+        writer.extend([
+            self._record(1, 'meeting.meeting', organisation=1),
+            self._record(1, 'agenda.agendaitem', meeting=1),
+            self._record(1, 'proposal.proposal', agenda_item=1, author=1),
+            self._record(1, 'poll.vote', poll=1, user=1),
+            self._record(1, 'poll.electoralregister', meeting=1),
+            self._record(1, 'poll.voterweight', register=1, user=1),
+            self._record(1, 'poll.poll', agenda_item=1, electoral_register=1, proposals=[1]),
+            self._record(1, 'speaker.speaker', speaker_list=1, user=1),
+            self._record(1, 'speaker.speakerlist', agenda_item=1),
+            self._record(1, 'speaker.speakerlistsystem', meeting=1),
+        ])
+        writer.write(set([1]))
+        writer.close()
+        with open(os.path.join(self.directory, writer.manifest_name)) as stream:
+            models = [x['model'] for x in load(stream)['models']]
+        self.assertEqual(len(models), 11)
+        for (i, model) in enumerate(models):
+            for referenced in export.get_references(model):
+                if referenced in models:
+                    self.assertLess(models.index(referenced), i, "%s before %s" % (model, referenced))
+
+    def test_all_models_can_be_ordered(self):
+        models = export.order_by_references(sorted(export.RECORD_SCHEMAS))
+        self.assertEqual(sorted(models), sorted(export.RECORD_SCHEMAS))
+
+
+def _export_meeting(pks, meeting_pk, size):
+    """ Records that refer to each other like those of export_meeting_content, pks is advanced past them. """
+    records = [
+        {'pk': meeting_pk, 'model': 'meeting.meeting', 'fields': {}},
+        {'pk': pks.meeting_group_pk, 'model': 'meeting.meetinggroup', 'fields': {'meeting': meeting_pk}},
+        {'pk': pks.group_role_pk, 'model': 'meeting.grouprole', 'fields': {'meeting': meeting_pk}},
+        {'pk': pks.group_membership_pk, 'model': 'meeting.groupmembership',
+         'fields': {'user': 1, 'meeting_group': pks.meeting_group_pk, 'role': pks.group_role_pk}},
+        {'pk': pks.meeting_roles_pk, 'model': 'meeting.meetingroles', 'fields': {'context': meeting_pk, 'user': 1}},
+        {'pk': pks.pn_system_pk, 'model': 'participant_number.pnsystem', 'fields': {'meeting': meeting_pk}},
+        {'pk': pks.pn_pk, 'model': 'participant_number.participantnumber',
+         'fields': {'number': 1, 'user': 1, 'pns': pks.pn_system_pk}},
+        {'pk': pks.speaker_system_pk, 'model': 'speaker.speakerlistsystem', 'fields': {'meeting': meeting_pk}},
+    ]
+    pks.group_membership_pk += 1
+    pks.meeting_roles_pk += 1
+    pks.pn_pk += 1
+    for i in range(size):
+        proposal_pk = pks.proposal_pk
+        records.extend([
+            {'pk': pks.ai_pk, 'model': 'agenda.agendaitem', 'fields': {'meeting': meeting_pk, 'order': pks.ai_pk}},
+            {'pk': pks.text_document_pk, 'model': 'proposal.textdocument', 'fields': {'agenda_item': pks.ai_pk}},
+            {'pk': pks.text_paragraph_pk, 'model': 'proposal.textparagraph',
+             'fields': {'text_document': pks.text_document_pk, 'agenda_item': pks.ai_pk}},
+            {'pk': proposal_pk, 'model': 'proposal.proposal',
+             'fields': {'agenda_item': pks.ai_pk, 'meeting_group': pks.meeting_group_pk}},
+            {'pk': proposal_pk, 'model': 'proposal.diffproposal', 'fields': {'paragraph': pks.text_paragraph_pk}},
+            {'pk': pks.discussion_post_pk, 'model': 'discussion.discussionpost',
+             'fields': {'agenda_item': pks.ai_pk, 'author': 1}},
+            {'pk': pks.reaction_pk, 'model': 'reactions.reaction',
+             'fields': {'content_type': ['proposal', 'proposal'], 'object_id': proposal_pk,
+                        'button': pks.reaction_button_pk, 'user': 1, 'agenda_item': pks.ai_pk}},
+            {'pk': pks.reaction_pk + 1, 'model': 'reactions.reaction',
+             'fields': {'content_type': ['discussion', 'discussionpost'], 'object_id': pks.discussion_post_pk,
+                        'button': pks.reaction_button_pk, 'user': 1, 'agenda_item': pks.ai_pk}},
+            {'pk': pks.electoral_register_pk, 'model': 'poll.electoralregister', 'fields': {'meeting': meeting_pk}},
+            {'pk': pks.voter_weight_pk, 'model': 'poll.voterweight',
+             'fields': {'register': pks.electoral_register_pk, 'user': 1, 'weight': 1}},
+            {'pk': pks.poll_pk, 'model': 'poll.poll',
+             'fields': {'agenda_item': pks.ai_pk, 'electoral_register': pks.electoral_register_pk,
+                        'proposals': [proposal_pk], 'result_data': {'approved': [proposal_pk]}}},
+            {'pk': pks.vote_pk, 'model': 'poll.vote',
+             'fields': {'poll': pks.poll_pk, 'user': 1, 'vote_data': '{"choice": %d}' % proposal_pk}},
+            {'pk': pks.speaker_list_pk, 'model': 'speaker.speakerlist',
+             'fields': {'speaker_system': pks.speaker_system_pk, 'agenda_item': pks.ai_pk}},
+            {'pk': pks.speaker_pk, 'model': 'speaker.speaker', 'fields': {'speaker_list': pks.speaker_list_pk, 'user': 1}},
+        ])
+        for name in ('ai_pk', 'text_document_pk', 'text_paragraph_pk', 'proposal_pk', 'discussion_post_pk',
+                     'electoral_register_pk', 'voter_weight_pk', 'poll_pk', 'vote_pk', 'speaker_list_pk', 'speaker_pk'):
+            setattr(pks, name, getattr(pks, name) + 1)
+        pks.reaction_pk += 2
+    records.append({'pk': pks.reaction_button_pk, 'model': 'reactions.reactionbutton', 'fields': {'meeting': meeting_pk}})
+    for name in ('meeting_group_pk', 'group_role_pk', 'pn_system_pk', 'speaker_system_pk', 'reaction_button_pk'):
+        setattr(pks, name, getattr(pks, name) + 1)
+    return records
+
+
+class MoveMeetingPartTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self._ctx = export.ctx
+        export.ctx = export.ExportContext()
+
+    def tearDown(self):
+        export.ctx = self._ctx
+        shutil.rmtree(self.directory)
+
+    def test_moved_parts_same_as_sequential(self):
+        sizes = [(1, 2), (2, 1), (3, 3)]
+        pks = export.PKCounters()
+        sequential = []
+        for (meeting_pk, size) in sizes:
+            sequential.extend(_export_meeting(pks, meeting_pk, size))
+        pks = export.PKCounters()
+        parallel = []
+        for (meeting_pk, size) in sizes:
+            # Each meeting starts at 1, except for proposals that are decided in advance
+            part_pks = export.PKCounters(proposal_pk=pks.proposal_pk)
+            start = part_pks.as_dict()
+            fn = os.path.join(self.directory, '%s.part' % meeting_pk)
+            part = export.RecordSpool(stream=open(fn, 'wb'))
+            part.extend(_export_meeting(part_pks, meeting_pk, size))
+            part.close()
+            result = {'start': start, 'end': part_pks.as_dict(), 'part': fn, 'ai_uid_to_pk': {}}
+            export.move_meeting_part(result, pks)
+            pks.proposal_pk = result['end']['proposal_pk']
+            part = export.RecordSpool(stream=open(fn, 'rb'))
+            parallel.extend(export.loads(line.decode('utf-8')) for line in part)
+            part.close()
+        self.assertEqual(parallel, sequential)
+
+
+class ConvertRichtextParasTests(unittest.TestCase):
+
+    def setUp(self):
+        self._ctx = export.ctx
+        export.ctx = export.ExportContext()
+        export.ctx.userid_to_pk.update({'anna': 1, 'bertil': 2})
+        export.ctx.user_pk_to_fullname.update({1: 'Anna', 2: 'Bertil #tag'})
+
+    def tearDown(self):
+        export.ctx = self._ctx
+
+    def test_same_as_add_paras(self):
+        texts = [
+            "",
+            "  \n ",
+            "One row",
+            "One\ntwo\n\nthree  \n \n four\r\n\r\nfive\n",
+            "@anna\n\n#tag after\n@anna #tag\n @nobody\n\n\n",
+            "#tag\n \n \n@anna\xa0\n\n\xa0x\x85y",
+            "Hej @bertil\n\nmed tagg",
+            "Html <b>kept</b>\n\nas <p>is</p>",
+        ]
+        for text in texts:
+            for tag_map in ({}, {'tag': 'short'}):
+                expected = export.add_paras(export.convert_richtext_body(text, tag_map))
+                self.assertEqual(export.convert_richtext_body(text, tag_map, paras=True), expected, repr(text))